@@ -0,0 +1,76 @@
+# MDE-AgriVLN - Benchmark: orchestration overhead with a fake model backend
+#
+# Runs real episodes (STL, decide, evaluate) against the fake backend, so the
+# only time not spent "in the model" is the pipeline's own work: depth
+# sampling, rendering, image encoding, prompts, journals and evaluation.
+# With --http the fake backend sits behind the local mock server and the
+# ollama client, adding the HTTP path. Run from the repository root.
+#
+# Example:
+#    python benchmarks/bench_orchestration.py -p farm -i 1 3 -r hybrid -e depth_pro
+#    python benchmarks/bench_orchestration.py -p farm -i 1 3 -r matrix -e depth_pro --latency 0.2 -c 3 --http
+#    python benchmarks/bench_orchestration.py -p farm -i 1 3 -r matrix -e depth_pro --latency 0.2 -c 3 --inflight 2
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mde_agrivln.backend import FakeBackend, OllamaBackend
+from mde_agrivln.mock_server import serve
+from mde_agrivln.runner import run_episode, run_episodes_async
+
+
+if __name__ == '__main__':
+
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-p", "--place", type=str, required=True, help="Place")
+   parser.add_argument("-i", "--id_range", type=int, nargs='+', required=True, help="ID range")
+   parser.add_argument("-r", "--representation", type=str, required=False, default='matrix', help="Representation: matrix, map or hybrid")
+   parser.add_argument("-e", "--estimater", type=str, required=False, default='depth_pro', help="Monocular depth estimation model")
+   parser.add_argument("-c", "--concurrency", type=int, required=False, default=1, help="Number of episodes run at the same time")
+   parser.add_argument("--inflight", type=int, required=False, help="Queue the calls through the step scheduler with this in-flight cap")
+   parser.add_argument("--latency", type=str, required=False, default='0', help="Latency distribution of the fake backend in seconds")
+   parser.add_argument("--if_pipeline", type=str, required=False, default='False', help="Prepare the next frame while the VLM is answering")
+   parser.add_argument("--http", action='store_true', help="Go through the mock server and the ollama client")
+   args = parser.parse_args()
+
+   id_range = list(range(args.id_range[0], args.id_range[1] + 1)) if len(args.id_range) == 2 else args.id_range
+   depth_matrix_ratio = None if args.representation == 'map' else [16, 9]
+   exp = f'bench-orchestration-{args.representation}'
+   shutil.rmtree(f'runs/{exp}', ignore_errors=True)
+
+   fake = FakeBackend(args.latency)
+   if args.http:
+      server = serve('127.0.0.1', 0, fake)
+      threading.Thread(target=server.serve_forever, daemon=True).start()
+      backend = OllamaBackend(f'http://127.0.0.1:{server.server_address[1]}')
+   else:
+      backend = fake
+
+   start = time.perf_counter()
+   if args.concurrency > 1 or args.inflight is not None:
+      asyncio.run(run_episodes_async('deepseek-r1:32b', 'qwen2.5vl:32b', exp, args.place, id_range, args.representation, depth_matrix_ratio, args.estimater, 'True', args.concurrency, args.if_pipeline, backend.async_client(), inflight=args.inflight))
+   else:
+      for id in id_range:
+         run_episode('deepseek-r1:32b', 'qwen2.5vl:32b', exp, args.place, id, args.representation, depth_matrix_ratio, args.estimater, 'True', args.if_pipeline, backend.chat)
+   wall = time.perf_counter() - start
+   if args.http:
+      server.shutdown()
+
+   print(f'[INFO] Episodes: {len(id_range)}, representation: {args.representation}, concurrency: {args.concurrency}, inflight: {args.inflight}, http: {args.http}')
+   print(f'[INFO] Model calls: {fake.calls}, model time: {fake.model_time:.2f} s')
+   if args.concurrency == 1 and args.inflight is None and fake.calls:
+      # run_episode sleeps 1.2 s per episode between the modules
+      sleeps = 1.2 * len(id_range)
+      print(f'[INFO] Wall time: {wall:.2f} s (of which runner sleeps {sleeps:.1f} s)')
+      overhead = wall - fake.model_time - sleeps
+      print(f'[INFO] Orchestration overhead: {overhead:.2f} s, {overhead / fake.calls * 1000:.1f} ms per call')
+   else:
+      print(f'[INFO] Wall time: {wall:.2f} s')
+      print(f'[INFO] Throughput: {fake.calls / wall:.1f} calls/s')
@@ -0,0 +1,82 @@
+# MDE-AgriVLN - Benchmark: LUT depth map renderer v.s. matplotlib renderer
+#
+# Example:
+#    python benchmarks/bench_render.py -p greenhouse -i 1 -e depth_pro
+#    python benchmarks/bench_render.py --synthetic 20
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mde_agrivln.depth_store import list_depth_times, load_depth
+from mde_agrivln.render import render_depth_array, render_depth_array_matplotlib
+
+
+def time_renderer(renderer, depths, out_dir, cmap):
+   paths = []
+   start = time.perf_counter()
+   for i, depth in enumerate(depths):
+      path = os.path.join(out_dir, f"frame_{i}.png")
+      renderer(depth, path, cmap)
+      paths.append(path)
+   elapsed = time.perf_counter() - start
+   return elapsed / len(depths), paths
+
+
+if __name__ == '__main__':
+
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-p", "--place", type=str, required=False, help="Place")
+   parser.add_argument("-i", "--id", type=int, required=False, help="Episode ID")
+   parser.add_argument("-e", "--estimater", type=str, required=False, default='depth_pro', help="Monocular depth estimation model")
+   parser.add_argument("-c", "--cmap", type=str, required=False, default='turbo_r', help="Colormap: turbo_r, Spectral or viridis")
+   parser.add_argument("-n", "--frames", type=int, required=False, default=20, help="Maximum number of frames")
+   parser.add_argument("--synthetic", type=int, required=False, help="Use N synthetic 640x360 depth frames instead of an episode")
+   args = parser.parse_args()
+
+   if args.synthetic:
+      # ground plane getting farther towards the horizon, plus sensor noise
+      rng = np.random.default_rng(0)
+      ground = 1.0 + 30.0 * np.linspace(1.0, 0.0, 360)[:, None] ** 2 * np.ones((1, 640))
+      depths = [(ground + rng.normal(0.0, 0.05, ground.shape)).astype(np.float32) for _ in range(args.synthetic)]
+   elif args.place is not None and args.id is not None:
+      time_keys = list_depth_times(args.place, args.id, args.estimater)[:args.frames]
+      depths = [load_depth(args.place, args.id, time_key, args.estimater) for time_key in time_keys]
+   else:
+      print('[ERROR] Give --place and --id, or --synthetic.')
+      sys.exit(1)
+   if len(depths) == 0:
+      print('[ERROR] No depth frames found.')
+      sys.exit(1)
+
+   with tempfile.TemporaryDirectory() as out_dir:
+      os.makedirs(os.path.join(out_dir, "lut"))
+      os.makedirs(os.path.join(out_dir, "matplotlib"))
+      # warm up both paths (colormap table, matplotlib import)
+      render_depth_array(depths[0], os.path.join(out_dir, "warmup.png"), args.cmap)
+      render_depth_array_matplotlib(depths[0], os.path.join(out_dir, "warmup.png"), args.cmap)
+
+      lut_time, lut_paths = time_renderer(render_depth_array, depths, os.path.join(out_dir, "lut"), args.cmap)
+      mpl_time, mpl_paths = time_renderer(render_depth_array_matplotlib, depths, os.path.join(out_dir, "matplotlib"), args.cmap)
+
+      same_size = 0
+      mismatch = []
+      for lut_path, mpl_path in zip(lut_paths, mpl_paths):
+         lut_image = np.asarray(Image.open(lut_path).convert('RGB'))
+         mpl_image = np.asarray(Image.open(mpl_path).convert('RGB'))
+         if lut_image.shape == mpl_image.shape:
+            same_size += 1
+            mismatch.append(float(np.any(lut_image != mpl_image, axis=-1).mean()))
+
+   print(f'[INFO] Frames: {len(depths)}, shape: {depths[0].shape}, colormap: {args.cmap}')
+   print(f'[INFO] matplotlib: {mpl_time * 1000:.1f} ms/frame')
+   print(f'[INFO] LUT:        {lut_time * 1000:.1f} ms/frame ({mpl_time / lut_time:.1f}x faster)')
+   print(f'[INFO] Same output size: {same_size}/{len(depths)}')
+   if mismatch:
+      print(f'[INFO] Differing pixels: {np.mean(mismatch) * 100:.4f}% on average')
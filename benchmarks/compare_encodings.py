@@ -0,0 +1,94 @@
+# MDE-AgriVLN - Benchmark: prompt tokens of the depth matrix encodings
+#
+# Reads token.json (written with --if_token True) and evaluate.json of the
+# runs of every encoding and compares the prompt tokens per step against the
+# json encoding, next to SR and NE. The size of the depth matrix block of
+# each encoding is also measured offline from the depth of the episodes.
+#
+# Example:
+#    for enc in json dm row bucket; do python home_mde_agrivln.py -p farm -i 1 5 -r matrix -e depth_pro -t True --encoding $enc; done
+#    python benchmarks/compare_encodings.py -p farm -i 1 5 -r matrix -e depth_pro
+
+import argparse
+import json
+import os
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mde_agrivln.depth_encoding import ENCODINGS, format_depth_matrix
+from mde_agrivln.depth_store import list_depth_times
+from mde_agrivln.read_depth import read_depth_episode
+
+
+def get_exp(representation, estimater, encoding):
+   exp = f'token-MDE-AgriVLN-{representation}-{estimater}'
+   return exp if encoding == 'json' else f'{exp}-{encoding}'
+
+
+def load_run(exp, place, id_range):
+   prompt, completion, SR, NE = [], [], [], []
+   for id in id_range:
+      dir_path = f"runs/{exp}/{place}_{id}"
+      token_path = os.path.join(dir_path, "token.json")
+      if not os.path.exists(token_path):
+         continue
+      with open(token_path, "r") as f:
+         tokens = json.load(f)
+      prompt += [r["token_prompt"] for r in tokens if r["token_prompt"] is not None]
+      completion += [r["token_completion"] for r in tokens if r["token_completion"] is not None]
+      evaluate_path = os.path.join(dir_path, "evaluate.json")
+      if os.path.exists(evaluate_path):
+         with open(evaluate_path, "r") as f:
+            result = json.load(f)
+         SR.append(result["SR"])
+         NE.append(result["NE"])
+   return prompt, completion, SR, NE
+
+
+def mean_or_none(values):
+   return statistics.mean(values) if values else None
+
+
+def format_value(value, digits=1):
+   return '-' if value is None else f'{value:.{digits}f}'
+
+
+if __name__ == '__main__':
+
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-p", "--place", type=str, required=True, help="Place")
+   parser.add_argument("-i", "--id_range", type=int, nargs='+', required=True, help="ID range")
+   parser.add_argument("-r", "--representation", type=str, required=False, default='matrix', help="Representation: matrix or hybrid")
+   parser.add_argument("-e", "--estimater", type=str, required=False, default='depth_pro', help="Monocular depth estimation model")
+   args = parser.parse_args()
+
+   id_range = list(range(args.id_range[0], args.id_range[1] + 1)) if len(args.id_range) == 2 else args.id_range
+
+   # depth matrix block sizes, without any model
+   sizes = {encoding: [] for encoding in ENCODINGS}
+   for id in id_range:
+      time_keys = list_depth_times(args.place, id, args.estimater)
+      if not time_keys:
+         continue
+      depth_matrices = read_depth_episode(args.place, id, [16, 9], args.estimater, time_keys)
+      for depth_matrix in depth_matrices.values():
+         for encoding in ENCODINGS:
+            sizes[encoding].append(len(format_depth_matrix(depth_matrix, encoding)))
+
+   print(f'{"encoding":<10}{"matrix chars":>14}{"steps":>8}{"prompt tok":>12}{"vs json":>9}{"compl tok":>11}{"SR":>7}{"NE":>8}')
+   baseline = None
+   for encoding in ENCODINGS:
+      prompt, completion, SR, NE = load_run(get_exp(args.representation, args.estimater, encoding), args.place, id_range)
+      prompt_mean = mean_or_none(prompt)
+      if encoding == 'json':
+         baseline = prompt_mean
+      saving = None
+      if prompt_mean is not None and baseline:
+         saving = (prompt_mean / baseline - 1) * 100
+      print(
+         f'{encoding:<10}{format_value(mean_or_none(sizes[encoding])):>14}{len(prompt):>8}'
+         f'{format_value(prompt_mean):>12}{format_value(saving) + "%" if saving is not None else "-":>9}'
+         f'{format_value(mean_or_none(completion)):>11}{format_value(mean_or_none(SR), 2):>7}{format_value(mean_or_none(NE), 2):>8}'
+      )
@@ -1,32 +1,20 @@
 # MDE-AgriVLN - Home
 
 import argparse
-import time
-import os
-import json
+import asyncio
 import sys
 
-from mde_agrivln.STL import STL
-from mde_agrivln.decide import decide
-from mde_agrivln.evaluate import evaluate
-
-
-def check_label_format(label_path):
-   valid_actions = {"[FORWARD]", "[LEFT ROTATE]", "[RIGHT ROTATE]", "[STOP]", "[WAIT]"}
-   with open(label_path, "r") as f:
-      labels = json.load(f)
-   for i in range(len(labels)):
-      entry = labels[i]
-      if entry["action"] not in valid_actions:
-         print(f"[ERROR] Action NO. {i} is invalid: {entry['action']}")
-         return False
-      if i < len(labels) - 1:
-         end_time = round(labels[i]["time_range"][1], 3)
-         next_start_time = round(labels[i + 1]["time_range"][0], 3)
-         if end_time != next_start_time:
-            print(f"[ERROR] Time steps {i} and {i+1} are not connected: {end_time} ≠ {next_start_time}")
-            return False
-   return True
+from mde_agrivln.backend import BACKENDS, get_backend
+from mde_agrivln.endpoint_pool import EndpointPool
+from mde_agrivln.runner import preload_models, run_episode, run_episodes_async
+from mde_agrivln.render_cache import prerender_depth_maps
+from mde_agrivln.image_cache import configure_image_cache
+from mde_agrivln.depth_encoding import ENCODINGS
+from mde_agrivln.read_depth import POOLINGS, get_frame_ratio
+from mde_agrivln.streaming import STREAM_MODES
+from mde_agrivln.response_cache import ResponseCache
+from mde_agrivln.dataset_index import ESTIMATERS, select_episodes
+from mde_agrivln.step_gate import StepGate
 
 
 if __name__ == '__main__':
@@ -36,15 +24,71 @@ if __name__ == '__main__':
    parser.add_argument("-i", "--id_range", type=int, nargs='+', required=True, help="ID range")
    parser.add_argument("-r", "--representation", type=str, required=True, help="Representation: matrix, map or hybrid")
    parser.add_argument("-e", "--estimater", type=str, required=True, help="Monocular depth estimation model")
-   parser.add_argument("-w", "--depth_matrix_width", type=int, required=False, help="Depth matrix width")
+   parser.add_argument("-w", "--depth_matrix_width", type=int, required=False, default=16, help="Depth matrix width, the height follows the 16:9 frame")
+   parser.add_argument("--pooling", type=str, required=False, default='point', help="Depth matrix pooling: point, mean or median")
+   parser.add_argument("--encoding", type=str, required=False, default='json', help="Depth matrix encoding: json, dm, row or bucket")
+   parser.add_argument("--min_length", type=float, required=False, help="Only episodes with at least this path length")
+   parser.add_argument("--max_length", type=float, required=False, help="Only episodes with at most this path length")
+   parser.add_argument("--if_check", type=str, required=False, default='True', help="Skip episodes with wrong labels or missing frames or depth before running")
+   parser.add_argument("--if_resume", type=str, required=False, default='False', help="Skip evaluated episodes and resume unfinished ones")
+   parser.add_argument("--if_trace", type=str, required=False, default='False', help="Write the stage spans of every episode to trace.json")
+   parser.add_argument("--if_gate", type=str, required=False, default='False', help="Reuse the previous decision while the scene does not change")
+   parser.add_argument("--gate_image", type=float, required=False, default=0.03, help="Image change below which a step is skipped, 0 to 1")
+   parser.add_argument("--gate_depth", type=float, required=False, default=0.05, help="Relative depth change below which a step is skipped")
+   parser.add_argument("--gate_max_skip", type=int, required=False, default=4, help="Maximum number of steps skipped in a row")
    parser.add_argument("-t", "--if_token", type=str, required=False, default='False', help="Token calculation")
+   parser.add_argument("--prerender", type=str, required=False, default='False', help="Render all depth maps of the ID range before deciding")
+   parser.add_argument("--render_workers", type=int, required=False, help="Number of pre-render processes")
+   parser.add_argument("-c", "--concurrency", type=int, required=False, default=1, help="Number of episodes run at the same time")
+   parser.add_argument("--inflight", type=int, required=False, help="Queue the calls of the running episodes and send at most this many per host at once")
+   parser.add_argument("--host", type=str, nargs='+', required=False, help="Ollama host, or several hosts to spread the calls over")
+   parser.add_argument("--keep_alive", type=str, required=False, default='30m', help="How long ollama keeps a model loaded after a call, e.g. 30m or -1 (forever)")
+   parser.add_argument("--if_preload", type=str, required=False, default='True', help="Load the LLM and the VLM before the first episode")
+   parser.add_argument("--stream", type=str, required=False, default='False', help="Stream responses: False, True (stop once the needed tags are closed) or probe")
+   parser.add_argument("--num_predict", type=int, required=False, help="Maximum number of completion tokens per call")
+   parser.add_argument("--backend", type=str, required=False, default='ollama', help="Model backend: ollama or fake")
+   parser.add_argument("--fake_latency", type=str, required=False, default='0', help="Latency distribution of the fake backend in seconds")
+   parser.add_argument("--fake_tokens", type=str, required=False, default='normal:150,40', help="Completion token distribution of the fake backend")
+   parser.add_argument("--image_cache_dir", type=str, required=False, help="Directory of encoded images shared by all runs")
+   parser.add_argument("--image_cache_mb", type=float, required=False, default=256, help="In-memory image cache size in MB")
+   parser.add_argument("--if_pipeline", type=str, required=False, default='False', help="Prepare the next frame while the VLM is answering")
+   parser.add_argument("--response_cache", type=str, required=False, help="Directory of cached model responses")
+   parser.add_argument("--replay", type=str, required=False, default='False', help="Answer only from the response cache, fail on a miss")
    args = parser.parse_args()
    place = args.place
    id_range = args.id_range
    representation = args.representation
    estimater = args.estimater
    depth_matrix_width = args.depth_matrix_width
+   pooling = args.pooling
+   encoding = args.encoding
+   min_length = args.min_length
+   max_length = args.max_length
+   if_check = args.if_check
+   if_resume = args.if_resume
+   if_trace = args.if_trace
+   if_gate = args.if_gate
+   gate_image = args.gate_image
+   gate_depth = args.gate_depth
+   gate_max_skip = args.gate_max_skip
    if_token = args.if_token
+   prerender = args.prerender
+   render_workers = args.render_workers
+   concurrency = args.concurrency
+   inflight = args.inflight
+   hosts = args.host
+   keep_alive = args.keep_alive
+   if_preload = args.if_preload
+   stream = args.stream
+   num_predict = args.num_predict
+   backend_name = args.backend
+   fake_latency = args.fake_latency
+   fake_tokens = args.fake_tokens
+   if_pipeline = args.if_pipeline
+   image_cache_dir = args.image_cache_dir
+   image_cache_mb = args.image_cache_mb
+   response_cache_dir = args.response_cache
+   replay = args.replay
 
    # check all the input information
    if len(id_range) == 1:
@@ -57,25 +101,115 @@ if __name__ == '__main__':
       print('[ERROR] Invalid ID range.')
       sys.exit(1)
 
+   if depth_matrix_width < 1 or depth_matrix_width > 640:
+      print('[ERROR] Invalid depth matrix width.')
+      sys.exit(1)
+
+   if pooling not in POOLINGS:
+      print('[ERROR] Invalid pooling.')
+      sys.exit(1)
+
    if representation == 'matrix' or representation == 'hybrid':
-      depth_matrix_ratio = [16, 9]
+      depth_matrix_ratio = get_frame_ratio(depth_matrix_width)
    elif representation == 'map':
       depth_matrix_ratio = None
 
-   if estimater not in ['depth_pro', 'depth_anything_v2', 'pixel-perfect-depth']:
+   if estimater not in ESTIMATERS:
       print('[ERROR] Invalid estimater.')
       sys.exit(1)
 
+   if encoding not in ENCODINGS:
+      print('[ERROR] Invalid encoding.')
+      sys.exit(1)
+
+   if if_check not in ['True', 'False']:
+      print('[ERROR] Invalid if_check.')
+      sys.exit(1)
+
+   if if_check == 'False' and (min_length is not None or max_length is not None):
+      print('[ERROR] Path length filters need if_check.')
+      sys.exit(1)
+
+   if if_resume not in ['True', 'False']:
+      print('[ERROR] Invalid if_resume.')
+      sys.exit(1)
+
+   if if_trace not in ['True', 'False']:
+      print('[ERROR] Invalid if_trace.')
+      sys.exit(1)
+
+   if if_gate not in ['True', 'False']:
+      print('[ERROR] Invalid if_gate.')
+      sys.exit(1)
+
+   if gate_image < 0 or gate_depth < 0 or gate_max_skip < 1:
+      print('[ERROR] Invalid gate.')
+      sys.exit(1)
+
    if if_token not in ['True', 'False']:
       print('[ERROR] Invalid if_token.')
       sys.exit(1)
 
+   if prerender not in ['True', 'False']:
+      print('[ERROR] Invalid prerender.')
+      sys.exit(1)
+
+   if if_pipeline not in ['True', 'False']:
+      print('[ERROR] Invalid if_pipeline.')
+      sys.exit(1)
+
+   if if_preload not in ['True', 'False']:
+      print('[ERROR] Invalid if_preload.')
+      sys.exit(1)
+
+   if stream not in STREAM_MODES:
+      print('[ERROR] Invalid stream.')
+      sys.exit(1)
+
+   if num_predict is not None and num_predict < 1:
+      print('[ERROR] Invalid num_predict.')
+      sys.exit(1)
+
+   if backend_name not in BACKENDS:
+      print('[ERROR] Invalid backend.')
+      sys.exit(1)
+
+   if hosts is not None and len(hosts) > 1 and backend_name != 'ollama':
+      print('[ERROR] Several hosts need the ollama backend.')
+      sys.exit(1)
+
+   if replay not in ['True', 'False']:
+      print('[ERROR] Invalid replay.')
+      sys.exit(1)
+
+   if replay == 'True' and response_cache_dir is None:
+      print('[ERROR] Replay needs a response cache.')
+      sys.exit(1)
+
+   if concurrency < 1:
+      print('[ERROR] Invalid concurrency.')
+      sys.exit(1)
+
+   if inflight is not None and inflight < 1:
+      print('[ERROR] Invalid inflight.')
+      sys.exit(1)
+
    # Running information
    method = 'MDE-AgriVLN'
    if if_token == 'True':
       exp = f'token-{method}-{representation}-{estimater}'
    else:
       exp = f'{method}-{representation}-{estimater}'
+   if representation != 'map':
+      if depth_matrix_ratio != [16, 9]:
+         exp = f'{exp}-{depth_matrix_ratio[0]}x{depth_matrix_ratio[1]}'
+      if pooling != 'point':
+         exp = f'{exp}-{pooling}'
+      if encoding != 'json':
+         exp = f'{exp}-{encoding}'
+   gate = StepGate(gate_image, gate_depth, gate_max_skip) if if_gate == 'True' else None
+   if gate is not None:
+      exp = f'{exp}-{gate.name()}'
    LLM = 'deepseek-r1:32b'
    VLM = 'qwen2.5vl:32b'
    
@@ -84,41 +218,61 @@ if __name__ == '__main__':
    print(f'[INFO] VLM: {VLM}')
    print(f'[INFO] Representation: {representation}')
    print(f'[INFO] Estimater: {estimater}')
+   if backend_name != 'ollama':
+      print(f'[INFO] Backend: {backend_name}')
    if representation == 'matrix' or representation == 'hybrid':
       print(f'[INFO] Depth matrix ratio: {depth_matrix_ratio}')
+      print(f'[INFO] Depth matrix pooling: {pooling}')
+      print(f'[INFO] Depth matrix encoding: {encoding}')
    print(f'[INFO] Place: {place}')
    print(f'[INFO] ID range: {id_range}')
+   print(f'[INFO] Keep alive: {keep_alive}')
+   if hosts is not None and len(hosts) > 1:
+      print(f'[INFO] Hosts: {hosts}')
+   if stream != 'False':
+      print(f'[INFO] Stream: {stream}')
+   if num_predict is not None:
+      print(f'[INFO] Completion token cap: {num_predict}')
+   if concurrency > 1:
+      print(f'[INFO] Concurrency: {concurrency}')
+   if inflight is not None:
+      print(f'[INFO] In-flight calls per host: {inflight}')
+   if gate is not None:
+      print(f'[INFO] Step gate: image change < {gate_image}, depth change < {gate_depth}, at most {gate_max_skip} steps in a row')
+   if if_resume == 'True':
+      print('[INFO] Resume: True')
+   if response_cache_dir is not None:
+      print(f'[INFO] Response cache: {response_cache_dir}' + (' (replay)' if replay == 'True' else ''))
+
+   # episodes are checked against the dataset index before any model time is spent
+   if if_check == 'True':
+      id_range = select_episodes(place, id_range, estimater, min_length, max_length)
+      if len(id_range) == 0:
+         print('[ERROR] No episode to run.')
+         sys.exit(1)
+
+   configure_image_cache(image_cache_mb, image_cache_dir)
+   if hosts is not None and len(hosts) > 1:
+      backend = EndpointPool(hosts, keep_alive, stream, num_predict, max_outstanding=inflight)
+   else:
+      backend = get_backend(backend_name, hosts[0] if hosts else None, fake_latency, fake_tokens, keep_alive=keep_alive, stream=stream, num_predict=num_predict)
+   response_cache = ResponseCache(response_cache_dir, replay == 'True', num_predict) if response_cache_dir is not None else None
+
+   # render every needed depth map up front, decide then only hits the render cache
+   if prerender == 'True' and representation != 'matrix':
+      prerender_depth_maps(place, id_range, estimater, workers=render_workers)
+
+   if if_preload == 'True' and replay == 'False':
+      preload_models(backend, [LLM, VLM])
    
-   for id in id_range:
-      dir_path = f"runs/{exp}/{place}_{id}"
-      os.makedirs(dir_path, exist_ok=True)
-      label_path = f"dataset/{place}_{id}/label.json"
-      if check_label_format(label_path) == False:
-         print(f'[ERROR] {place}_{id} label is wrong.')
-      else:
-         print(f"[INFO] {place}_{id} label is correct.")
-         print(f'--- {place}_{id} starts ---')
-
-         # the subtask list module
-         STL_state = False
-         STL_run = 1
-         STL_run_max = 3
-         while STL_state == False:
-            STL_state = STL(LLM, exp, place, id)
-            STL_run += 1
-            if STL_run > STL_run_max:
-               print('[ERROR] Fail to generate STL.')
-               break
-            elif STL_state == False:
-               print('[ERROR] Fail to generate STL. Ready to regenerate.')
-            time.sleep(0.1)
-
-         # the decision making module
-         decide(VLM, exp, place, id, representation, depth_matrix_ratio, estimater, if_token)
-         time.sleep(0.1)
-
-         # the evaluation module
-         evaluate(exp, place, id)
-         time.sleep(1.0)
-
-         print(f'--- {place}_{id} ends ---')
\ No newline at end of file
+   if concurrency > 1 or inflight is not None:
+      asyncio.run(run_episodes_async(LLM, VLM, exp, place, id_range, representation, depth_matrix_ratio, estimater, if_token, concurrency, if_pipeline, backend.async_client(), response_cache, encoding, pooling, if_resume, if_trace, inflight, len(hosts) if hosts else 1, gate))
+   else:
+      for id in id_range:
+         run_episode(LLM, VLM, exp, place, id, representation, depth_matrix_ratio, estimater, if_token, if_pipeline, backend.chat, response_cache, encoding, pooling, if_resume, if_trace, gate)
+
+   if response_cache is not None:
+      print(response_cache.summary())
+   if isinstance(backend, EndpointPool):
+      print(backend.summary())
+      backend.close()
@@ -1,10 +1,14 @@
 # MDE-AgriVLN - The Subtask List Module
 
-import ollama
 import json
 import re
 import os
 
+from mde_agrivln.chat import run_chat
+from mde_agrivln.episode import load_episode
+from mde_agrivln.journal import get_journal_path, reset_journal
+from mde_agrivln.tracing import span
+
 
 def load_instruction_from_info(file_path):
    with open(file_path, 'r') as f:
@@ -39,13 +43,19 @@ def generate_initial_stl_state(stl_path, output_path):
    }
    with open(output_path, "w") as f:
       json.dump([state], f, indent=3)
+   reset_journal(get_journal_path(output_path), [state])
    print(f"[INFO] Initial state of Subtask List is generated to: {output_path}.")
 
 
-def STL(my_model, exp, place, id):
+def STL(my_model, exp, place, id, chat=None, episode=None):
+   return run_chat(STL_requests(my_model, exp, place, id, episode), chat)
+
+
+def STL_requests(my_model, exp, place, id, episode=None):
 
-   with open(f"dataset/{place}_{id}/info.json", 'r') as f:
-      instruction = json.load(f)['instruction']
+   if episode is None:
+      episode = load_episode(place, id)
+   instruction = episode.instruction
 
    my_system = """
    You are an expert in Vision-and-Language Navigation (VLN) for guiding an agricultural robot. Normally, instruction is directly sent to robot. In our setup, the instruction is not directly given to the robot. Instead, we first decompose it into a structured list of subtasks. This subtask list is easier for the robot to understand and execute.
@@ -94,7 +104,7 @@ def STL(my_model, exp, place, id):
          'content': my_user
       }
    ]
-   response = ollama.chat(model=my_model, messages=messages)
+   response = yield {'model': my_model, 'messages': messages, 'stop_tags': ['subtask_list']}
    message = response['message']['content']
    print(f'[INFO] {my_model} message:')
    print(message)
@@ -102,8 +112,9 @@ def STL(my_model, exp, place, id):
    STL_path = f"runs/{exp}/{place}_{id}/STL.json"
    log_path = f"runs/{exp}/{place}_{id}/log.json"
 
-   save_subtask_list(message, STL_path)
-   generate_initial_stl_state(STL_path, log_path)
+   with span('STL.save'):
+      save_subtask_list(message, STL_path)
+      generate_initial_stl_state(STL_path, log_path)
 
    if os.path.isfile(STL_path):
       return True
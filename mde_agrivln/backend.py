@@ -0,0 +1,234 @@
+# MDE-AgriVLN - The Model Backend Module
+#
+# A backend answers the chat requests yielded by STL_requests and
+# decide_requests. It gives a blocking chat(**request) for run_chat, an
+# async client (anything with `async chat(**request)`) for run_chat_async
+# and preload(model) to load a model before the first request. A request may
+# carry stop_tags, the tags the caller needs (see streaming.py); backends
+# take them out before calling the model.
+#
+#    ollama: the ollama server at --host (or OLLAMA_HOST)
+#    fake:   an in-process stand-in answering well-formed <subtask_list> and
+#            <thought>/<action>/<state> responses after a sampled latency,
+#            for running the pipeline without a GPU
+#
+# Latency and completion token distributions are given as "kind:args":
+#    0.5                  fixed (seconds or tokens)
+#    uniform:0.2,1.0      uniform between the two values
+#    normal:2.0,0.3       normal with mean and standard deviation
+#    lognormal:2.0,0.3    log-normal with median and sigma
+
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+
+import ollama
+
+from mde_agrivln.streaming import collect_stream, collect_stream_async
+
+
+BACKENDS = ['ollama', 'fake']
+
+FAKE_SUBTASK_LIST = [
+   {"step": 1, "subtask": "Go forward along the path", "start_condition": "always", "end_condition": "the target is visible"},
+   {"step": 2, "subtask": "Approach the target", "start_condition": "the target is visible", "end_condition": "the target is close ahead"},
+   {"step": 3, "subtask": "Stop when the target is close ahead", "start_condition": "the target is close ahead", "end_condition": "the robot has stopped"}
+]
+
+FAKE_ACTIONS = ['[FORWARD]'] * 6 + ['[LEFT ROTATE]', '[RIGHT ROTATE]', '[WAIT]']
+
+
+def parse_distribution(spec):
+   spec = str(spec)
+   if ':' not in spec:
+      value = float(spec)
+      return lambda rng: value
+   kind, args = spec.split(':', 1)
+   a, b = [float(x) for x in args.split(',')]
+   if kind == 'uniform':
+      return lambda rng: rng.uniform(a, b)
+   if kind == 'normal':
+      return lambda rng: max(0.0, rng.gauss(a, b))
+   if kind == 'lognormal':
+      return lambda rng: rng.lognormvariate(math.log(a), b)
+   raise ValueError(f"Invalid distribution: {spec}")
+
+
+def parse_keep_alive(keep_alive):
+   # ollama takes a duration ("30m") or a number of seconds (-1: forever)
+   if keep_alive is None:
+      return None
+   try:
+      return float(keep_alive)
+   except ValueError:
+      return keep_alive
+
+
+def prepare_request(request, keep_alive=None, num_predict=None):
+   request = dict(request)
+   stop_tags = request.pop('stop_tags', None)
+   if keep_alive is not None:
+      request.setdefault('keep_alive', keep_alive)
+   if num_predict is not None:
+      request['options'] = dict(request.get('options') or {}, num_predict=num_predict)
+   return request, stop_tags
+
+
+class OllamaBackend:
+
+   def __init__(self, host=None, keep_alive=None, stream='False', num_predict=None):
+      self.host = host
+      self.keep_alive = parse_keep_alive(keep_alive)
+      self.stream = stream
+      self.num_predict = num_predict
+      self.client = ollama.Client(host=host) if host is not None else None
+
+   def chat(self, **request):
+      request, stop_tags = prepare_request(request, self.keep_alive, self.num_predict)
+      # ollama.chat is looked up per call, so it can be swapped at runtime
+      chat = self.client.chat if self.client is not None else ollama.chat
+      if self.stream == 'False' or not stop_tags:
+         return chat(**request)
+      return collect_stream(chat(**request, stream=True), stop_tags, self.stream, request.get('model'))
+
+   def preload(self, model):
+      # an empty prompt only loads the model, returns the load time in seconds
+      generate = self.client.generate if self.client is not None else ollama.generate
+      response = generate(model=model, prompt='', keep_alive=self.keep_alive)
+      return (response.load_duration or 0) / 1e9
+
+   def async_client(self):
+      return OllamaAsyncClient(ollama.AsyncClient(host=self.host), self.keep_alive, self.stream, self.num_predict)
+
+
+class OllamaAsyncClient:
+
+   def __init__(self, client, keep_alive=None, stream='False', num_predict=None):
+      self.client = client
+      self.keep_alive = keep_alive
+      self.stream = stream
+      self.num_predict = num_predict
+
+   async def chat(self, **request):
+      request, stop_tags = prepare_request(request, self.keep_alive, self.num_predict)
+      if self.stream == 'False' or not stop_tags:
+         return await self.client.chat(**request)
+      return await collect_stream_async(await self.client.chat(**request, stream=True), stop_tags, self.stream, request.get('model'))
+
+
+class FakeBackend:
+
+   def __init__(self, latency='0', completion_tokens='normal:150,40', image_tokens=1200, advance=0.25, seed=0, load_time=0.0, tail_words=0):
+      self.latency = parse_distribution(latency)
+      # the first call of a model not preloaded also pays load_time, like a cold start
+      self.load_time = load_time
+      self.loaded = set()
+      # text after the last tag, which a streamed response can skip
+      self.tail_words = tail_words
+      self.completion_tokens = parse_distribution(completion_tokens)
+      self.image_tokens = image_tokens
+      self.advance = advance
+      self.rng = random.Random(seed)
+      self.lock = threading.Lock()
+      self.calls = 0
+      self.model_time = 0.0
+
+   def sample_latency(self, model=None):
+      with self.lock:
+         latency = self.latency(self.rng)
+         load = 0.0 if model in self.loaded else self.load_time
+         self.loaded.add(model)
+         self.calls += 1
+         self.model_time += latency + load
+      return latency, load
+
+   def respond(self, request, latency=0.0, load=0.0):
+      messages = request.get('messages', [])
+      user = messages[-1] if messages else {}
+      with self.lock:
+         if '<instruction>' in user.get('content', ''):
+            content = self.subtask_list_content()
+         else:
+            content = self.decision_content(user.get('content', ''))
+         if self.tail_words:
+            content += "\n" + " ".join(["Double-checking the decision."] * (self.tail_words // 3 + 1))
+         completion = max(1, int(self.completion_tokens(self.rng)))
+      prompt = sum(len(m.get('content', '')) for m in messages) // 4 + self.image_tokens * len(user.get('images') or [])
+      return ollama.ChatResponse(
+         model=request.get('model'),
+         created_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+         done=True,
+         done_reason='stop',
+         message={'role': 'assistant', 'content': content},
+         total_duration=int((latency + load) * 1e9),
+         load_duration=int(load * 1e9),
+         prompt_eval_count=prompt,
+         prompt_eval_duration=int(latency * 0.2e9),
+         eval_count=completion,
+         eval_duration=int(latency * 0.8e9)
+      )
+
+   def subtask_list_content(self):
+      return (
+         "<thought> Fake backend: a fixed subtask list. </thought>\n"
+         f"<subtask_list>\n{json.dumps(FAKE_SUBTASK_LIST, indent=3)}\n</subtask_list>"
+      )
+
+   def decision_content(self, user_prompt):
+      # move the subtask list on like a model would: one state change at a time
+      match = re.search(r"<subtask_list>\s*(\[.*?\])\s*</subtask_list>", user_prompt, re.DOTALL)
+      subtasks = json.loads(match.group(1)) if match else []
+      doing = [s for s in subtasks if s.get('state') == 'doing']
+      pending = [s for s in subtasks if s.get('state') == 'pending']
+      change = self.rng.random() < self.advance
+      if doing:
+         number = doing[0]['step']
+         state = f"Subtask NO.{number} changes from doing to done." if change else f"Subtask NO.{number} keeps state of doing."
+      elif pending:
+         number = pending[0]['step']
+         state = f"Subtask NO.{number} changes from pending to doing." if change else f"Subtask NO.{number} keeps state of pending."
+      else:
+         state = f"Subtask NO.{subtasks[-1]['step'] if subtasks else 1} keeps state of done."
+      if subtasks and not pending and (not doing or (change and len(doing) == 1 and doing[0] is subtasks[-1])):
+         action = '[STOP]'
+      else:
+         action = self.rng.choice(FAKE_ACTIONS)
+      return f"<thought> Fake backend decision. </thought>\n<action> {action} </action>\n<state> {state} </state>"
+
+   def chat(self, **request):
+      latency, load = self.sample_latency(request.get('model'))
+      time.sleep(latency + load)
+      return self.respond(request, latency, load)
+
+   def preload(self, model):
+      with self.lock:
+         load = 0.0 if model in self.loaded else self.load_time
+         self.loaded.add(model)
+      time.sleep(load)
+      return load
+
+   def async_client(self):
+      return FakeAsyncClient(self)
+
+
+class FakeAsyncClient:
+
+   def __init__(self, backend):
+      self.backend = backend
+
+   async def chat(self, **request):
+      latency, load = self.backend.sample_latency(request.get('model'))
+      await asyncio.sleep(latency + load)
+      return self.backend.respond(request, latency, load)
+
+
+def get_backend(name, host=None, latency='0', completion_tokens='normal:150,40', seed=0, keep_alive=None, load_time=0.0, stream='False', num_predict=None, tail_words=0):
+   if name == 'ollama':
+      return OllamaBackend(host, keep_alive, stream, num_predict)
+   if name == 'fake':
+      return FakeBackend(latency, completion_tokens, seed=seed, load_time=load_time, tail_words=tail_words)
+   raise ValueError(f"Invalid backend: {name}")
@@ -0,0 +1,50 @@
+# MDE-AgriVLN - The Model Calling Module
+#
+# STL_requests and decide_requests are generators: they yield one chat
+# request ({'model': ..., 'messages': ..., 'stop_tags': ...}) at a time and
+# receive the response back through send(). run_chat drives them with a
+# blocking chat function, run_chat_async with an async client (see
+# backend.py), so the episode logic is written once for both runners.
+
+import asyncio
+
+from mde_agrivln.backend import OllamaBackend
+from mde_agrivln.tracing import span
+
+
+def run_chat(requests, chat=None):
+   if chat is None:
+      chat = OllamaBackend().chat
+   try:
+      request = next(requests)
+      while True:
+         with span('chat', model=request['model']):
+            response = chat(**request)
+         request = requests.send(response)
+   except StopIteration as stop:
+      return stop.value
+   finally:
+      # after a failed call the generator is closed, which flushes its journals
+      requests.close()
+
+
+def _advance(requests, response):
+   # one step of the generator as (done, value), StopIteration cannot cross a Future
+   try:
+      return False, requests.send(response)
+   except StopIteration as stop:
+      return True, stop.value
+
+
+async def run_chat_async(requests, client):
+   # the generator's own work (depth, rendering, JSON) runs in a worker
+   # thread, so the event loop only waits on the model server
+   try:
+      done, request = await asyncio.to_thread(_advance, requests, None)
+      while not done:
+         with span('chat', model=request['model']):
+            response = await client.chat(**request)
+         done, request = await asyncio.to_thread(_advance, requests, response)
+      return request
+   finally:
+      await asyncio.to_thread(requests.close)
@@ -0,0 +1,85 @@
+# MDE-AgriVLN - The Checkpoint Module
+#
+# Resumes an interrupted episode from runs/{exp}/{place}_{id}. A step t of
+# decide is committed once the subtask snapshot of the next step is in
+# log.jsonl: the journal writer appends the token and predict records of t
+# before it, in order. Resuming drops the records of the step that was cut
+# off, restarts decide at the time of the last snapshot and counts the [STOP]
+# actions already made. An episode with a readable evaluate.json is complete.
+
+import json
+import os
+
+from mde_agrivln.for_json import time_str_to_float
+from mde_agrivln.journal import read_journal, reset_journal
+
+
+def is_episode_complete(dir_path):
+   try:
+      with open(os.path.join(dir_path, "evaluate.json"), "r") as f:
+         result = json.load(f)
+   except (FileNotFoundError, json.JSONDecodeError):
+      return False
+   return all(name in result for name in ["SR", "NE", "ISR"])
+
+
+def get_resume_point(dir_path, time_keys):
+   # (resume time, committed predictions), None when the episode has no subtask list yet
+   try:
+      with open(os.path.join(dir_path, "STL.json"), "r") as f:
+         json.load(f)
+   except (FileNotFoundError, json.JSONDecodeError):
+      return None
+   snapshots = read_journal(os.path.join(dir_path, "log.jsonl"))
+   if len(snapshots) == 0:
+      return None
+   resume_time = max((snapshot["time"] for snapshot in snapshots), key=time_str_to_float)
+
+   # the last prediction of each time step before the resume time
+   predictions = {}
+   for record in read_journal(os.path.join(dir_path, "predict.jsonl")):
+      if time_str_to_float(record["time"]) < time_str_to_float(resume_time):
+         predictions[record["time"]] = record
+   # a step without its prediction was not committed, resume there
+   for time_key in time_keys:
+      if time_str_to_float(time_key) >= time_str_to_float(resume_time):
+         break
+      if time_key not in predictions:
+         resume_time = time_key
+         break
+   committed = [
+      predictions[time_key] for time_key in time_keys
+      if time_key in predictions and time_str_to_float(time_key) < time_str_to_float(resume_time)
+   ]
+   return resume_time, committed
+
+
+def truncate_journals(dir_path, resume_time, predictions=()):
+   # keep the snapshots up to the resume time and the records of the steps before it
+   resume_value = time_str_to_float(resume_time)
+   log_path = os.path.join(dir_path, "log.jsonl")
+   if os.path.exists(log_path):
+      reset_journal(log_path, [
+         snapshot for snapshot in read_journal(log_path)
+         if time_str_to_float(snapshot["time"]) <= resume_value
+      ])
+   reset_journal(os.path.join(dir_path, "predict.jsonl"), predictions)
+   token_path = os.path.join(dir_path, "token.jsonl")
+   if os.path.exists(token_path):
+      tokens = {}
+      for record in read_journal(token_path):
+         if time_str_to_float(record["time"]) < resume_value:
+            tokens[record["time"]] = record
+      reset_journal(token_path, sorted(tokens.values(), key=lambda record: time_str_to_float(record["time"])))
+
+
+def resume_journals(dir_path, time_keys):
+   # returns (resume time, [STOP] actions so far) and truncates the journals to match
+   resume_point = get_resume_point(dir_path, time_keys)
+   if resume_point is None:
+      resume_time, predictions = "0'0", []
+   else:
+      resume_time, predictions = resume_point
+   truncate_journals(dir_path, resume_time, predictions)
+   stop_quantity = sum(record["action"] == '[STOP]' for record in predictions)
+   return resume_time, stop_quantity
@@ -0,0 +1,295 @@
+# MDE-AgriVLN - The Dataset Index Module
+#
+# A SQLite index of dataset/ and of every {estimater}/output/, so episodes can
+# be listed, filtered and checked without parsing the dataset again. Per
+# episode it records the instruction, path length, STOP start time, frame
+# count, the frames missing for the decision loop, and per estimater the depth
+# frames available and missing. An episode is only scanned again when its
+# label.json, info.json, frames/ or depth directory changed.
+#
+# Example:
+#    python -m mde_agrivln.dataset_index -p farm -e depth_pro
+#    python -m mde_agrivln.dataset_index --min_length 5 --max_length 20 --rebuild
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+
+from mde_agrivln.depth_store import INDEX_NAME, STORE_NAME, get_depth_dir, list_depth_times
+from mde_agrivln.episode import Episode, get_label_error
+
+
+INDEX_PATH = "dataset/index.sqlite"
+
+# bump when the schema or what is recorded changes, the index is then rebuilt
+INDEX_VERSION = 1
+
+ESTIMATERS = ['depth_pro', 'depth_anything_v2', 'pixel-perfect-depth', 'depth_anything_v2_small']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+   key TEXT PRIMARY KEY,
+   value TEXT
+);
+CREATE TABLE IF NOT EXISTS episodes (
+   place TEXT,
+   id INTEGER,
+   instruction TEXT,
+   length REAL,
+   stop_start_time REAL,
+   frame_count INTEGER,
+   missing_frames INTEGER,
+   label_error TEXT,
+   stamp TEXT,
+   PRIMARY KEY (place, id)
+);
+CREATE TABLE IF NOT EXISTS depth (
+   place TEXT,
+   id INTEGER,
+   estimater TEXT,
+   depth_count INTEGER,
+   missing_depth INTEGER,
+   stamp TEXT,
+   PRIMARY KEY (place, id, estimater)
+);
+"""
+
+
+def get_stamp(paths):
+   # modification times of the files and directories an entry was scanned from
+   stamp = []
+   for path in paths:
+      try:
+         stamp.append(os.stat(path).st_mtime_ns)
+      except FileNotFoundError:
+         stamp.append(None)
+   return json.dumps(stamp)
+
+
+def get_episode_stamp(place, id):
+   dir_path = f"dataset/{place}_{id}"
+   return get_stamp([f"{dir_path}/label.json", f"{dir_path}/info.json", f"{dir_path}/frames"])
+
+
+def get_depth_stamp(place, id, estimater):
+   depth_dir = get_depth_dir(place, id, estimater)
+   return get_stamp([depth_dir, os.path.join(depth_dir, STORE_NAME), os.path.join(depth_dir, INDEX_NAME)])
+
+
+def is_writable(index_path):
+   if os.path.exists(index_path):
+      return os.access(index_path, os.W_OK)
+   return os.access(os.path.dirname(index_path) or ".", os.W_OK)
+
+
+def open_index(index_path=INDEX_PATH, rebuild=False):
+   # without a writable dataset/ (e.g. a read-only mount) the index lives in memory for this run
+   conn = None
+   if is_writable(index_path):
+      try:
+         conn = sqlite3.connect(index_path)
+         # a read-only file opens fine, the first write fails
+         conn.execute("BEGIN IMMEDIATE")
+         conn.rollback()
+      except sqlite3.OperationalError:
+         conn = None
+   if conn is None:
+      print(f'[WARNING] {index_path} cannot be written, the dataset index is kept in memory.')
+      conn = sqlite3.connect(":memory:")
+   conn.row_factory = sqlite3.Row
+   version = None
+   if not rebuild:
+      try:
+         row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+         version = int(row["value"]) if row is not None else None
+      except sqlite3.OperationalError:
+         pass
+   if version != INDEX_VERSION:
+      with conn:
+         conn.executescript("DROP TABLE IF EXISTS meta; DROP TABLE IF EXISTS episodes; DROP TABLE IF EXISTS depth;")
+         conn.executescript(SCHEMA)
+         conn.execute("INSERT INTO meta VALUES ('version', ?)", (str(INDEX_VERSION),))
+   return conn
+
+
+def list_dataset_episodes(place=None):
+   episodes = []
+   if not os.path.isdir("dataset"):
+      return episodes
+   for entry in os.scandir("dataset"):
+      match = re.fullmatch(r"(.+)_(\d+)", entry.name)
+      if match is None or not entry.is_dir():
+         continue
+      if place is not None and match.group(1) != place:
+         continue
+      episodes.append((match.group(1), int(match.group(2))))
+   return sorted(episodes)
+
+
+def scan_episode(place, id):
+   # returns the row of the episodes table, and the time keys depth is needed for
+   try:
+      episode = Episode.load(place, id)
+   except (OSError, ValueError, KeyError) as e:
+      return (place, id, None, None, None, 0, 0, f"Cannot load the episode: {e!r}"), []
+   try:
+      label_error = get_label_error(episode.labels)
+   except (KeyError, IndexError, TypeError) as e:
+      label_error = f"Malformed label.json: {e!r}"
+   return (
+      place, id, episode.info.get("instruction"), episode.path_length, episode.stop_start_time,
+      len(episode.frame_keys), len(episode.missing_frames()), label_error
+   ), episode.time_keys
+
+
+def scan_depth(place, id, estimater, time_keys):
+   depth_dir = get_depth_dir(place, id, estimater)
+   available = set(list_depth_times(place, id, estimater))
+   index_path = os.path.join(depth_dir, INDEX_NAME)
+   if os.path.isfile(index_path) and os.path.isfile(os.path.join(depth_dir, STORE_NAME)):
+      with open(index_path, "r") as f:
+         available.update(json.load(f)["time_keys"])
+   return len(available), sum(time_key not in available for time_key in time_keys)
+
+
+def refresh_index(conn, place=None, estimaters=ESTIMATERS):
+   # rescans the episodes whose files changed, returns how many were scanned
+   episodes = list_dataset_episodes(place)
+   known = {
+      (row["place"], row["id"]): row["stamp"]
+      for row in conn.execute("SELECT place, id, stamp FROM episodes")
+      if place is None or row["place"] == place
+   }
+   known_depth = {
+      (row["place"], row["id"], row["estimater"]): row["stamp"]
+      for row in conn.execute("SELECT place, id, estimater, stamp FROM depth")
+   }
+   estimaters = [estimater for estimater in estimaters if os.path.isdir(f"{estimater}/output")]
+
+   scanned = 0
+   with conn:
+      for episode_place, episode_id in episodes:
+         stamp = get_episode_stamp(episode_place, episode_id)
+         episode_changed = known.pop((episode_place, episode_id), None) != stamp
+         time_keys = None
+         if episode_changed:
+            row, time_keys = scan_episode(episode_place, episode_id)
+            conn.execute("INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row + (stamp,))
+            scanned += 1
+         for estimater in estimaters:
+            depth_stamp = get_depth_stamp(episode_place, episode_id, estimater)
+            # the missing depth frames also depend on the time keys of the labels
+            if not episode_changed and known_depth.get((episode_place, episode_id, estimater)) == depth_stamp:
+               continue
+            if time_keys is None:
+               time_keys = scan_episode(episode_place, episode_id)[1]
+            depth_count, missing_depth = scan_depth(episode_place, episode_id, estimater, time_keys)
+            conn.execute(
+               "INSERT OR REPLACE INTO depth VALUES (?, ?, ?, ?, ?, ?)",
+               (episode_place, episode_id, estimater, depth_count, missing_depth, depth_stamp)
+            )
+      # episodes removed from dataset/
+      for episode_place, episode_id in known:
+         conn.execute("DELETE FROM episodes WHERE place = ? AND id = ?", (episode_place, episode_id))
+         conn.execute("DELETE FROM depth WHERE place = ? AND id = ?", (episode_place, episode_id))
+   return scanned
+
+
+def query_episodes(conn, place=None, id_range=None, estimater=None, min_length=None, max_length=None):
+   query = """
+      SELECT e.*, d.depth_count, d.missing_depth FROM episodes e
+      LEFT JOIN depth d ON d.place = e.place AND d.id = e.id AND d.estimater = ?
+      WHERE 1 = 1
+   """
+   params = [estimater]
+   if place is not None:
+      query += " AND e.place = ?"
+      params.append(place)
+   if min_length is not None:
+      query += " AND e.length >= ?"
+      params.append(min_length)
+   if max_length is not None:
+      query += " AND e.length <= ?"
+      params.append(max_length)
+   query += " ORDER BY e.place, e.id"
+   rows = [dict(row) for row in conn.execute(query, params)]
+   if id_range is not None:
+      ids = set(id_range)
+      rows = [row for row in rows if row["id"] in ids]
+   return rows
+
+
+def get_episode_problem(row, estimater):
+   # None when the episode can be run with this estimater
+   if row["label_error"] is not None:
+      return row["label_error"]
+   if row["missing_frames"] > 0:
+      return f"{row['missing_frames']} frames missing"
+   if row["depth_count"] is None:
+      return f"no {estimater} depth"
+   if row["missing_depth"] > 0:
+      return f"{row['missing_depth']} {estimater} depth frames missing"
+   return None
+
+
+def select_episodes(place, id_range, estimater, min_length=None, max_length=None, index_path=INDEX_PATH):
+   # the IDs of id_range that exist, pass the filters and have everything decide needs
+   conn = open_index(index_path)
+   try:
+      scanned = refresh_index(conn, place)
+      found = {row["id"] for row in query_episodes(conn, place, id_range, estimater)}
+      rows = query_episodes(conn, place, id_range, estimater, min_length, max_length)
+   finally:
+      conn.close()
+   if scanned > 0:
+      print(f'[INFO] Dataset index: {scanned} episodes scanned.')
+
+   selected = []
+   for row in rows:
+      problem = get_episode_problem(row, estimater)
+      if problem is not None:
+         print(f'[WARNING] {place}_{row["id"]} is skipped: {problem}.')
+      else:
+         selected.append(row["id"])
+   for id in id_range:
+      if id not in found:
+         print(f'[WARNING] {place}_{id} is skipped: not in the dataset.')
+   print(f'[INFO] {len(selected)} of {len(id_range)} episodes selected.')
+   return selected
+
+
+if __name__ == '__main__':
+
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-p", "--place", type=str, required=False, help="Only this place")
+   parser.add_argument("-i", "--id_range", type=int, nargs='+', required=False, help="Only this ID range")
+   parser.add_argument("-e", "--estimater", type=str, required=False, default='depth_pro', help="Estimater whose depth is checked")
+   parser.add_argument("--min_length", type=float, required=False, help="Minimum path length")
+   parser.add_argument("--max_length", type=float, required=False, help="Maximum path length")
+   parser.add_argument("--rebuild", action='store_true', help="Scan every episode again")
+   args = parser.parse_args()
+
+   if args.estimater not in ESTIMATERS:
+      print('[ERROR] Invalid estimater.')
+      sys.exit(1)
+
+   id_range = args.id_range
+   if id_range is not None and len(id_range) == 2:
+      id_range = list(range(id_range[0], id_range[1] + 1))
+
+   conn = open_index(rebuild=args.rebuild)
+   scanned = refresh_index(conn, args.place)
+   rows = query_episodes(conn, args.place, id_range, args.estimater, args.min_length, args.max_length)
+   conn.close()
+
+   print(f'[INFO] {INDEX_PATH}: {scanned} episodes scanned.')
+   print(f'{"episode":<16}{"length":>8}{"STOP":>8}{"frames":>8}{"depth":>8}  problem')
+   for row in rows:
+      problem = get_episode_problem(row, args.estimater)
+      length = f'{row["length"]:.1f}' if row["length"] is not None else '-'
+      stop = f'{row["stop_start_time"]:.1f}' if row["stop_start_time"] is not None else '-'
+      depth = row["depth_count"] if row["depth_count"] is not None else '-'
+      print(f'{row["place"] + "_" + str(row["id"]):<16}{length:>8}{stop:>8}{row["frame_count"]:>8}{depth:>8}  {problem or ""}')
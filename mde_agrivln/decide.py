@@ -1,24 +1,29 @@
 # MDE-AgriVLN - The Decision Making Module
 
-import ollama
 import re
 import sys
-import os
 import json
-import time
-
-from mde_agrivln.read_depth import read_depth
-from mde_agrivln.render import render_depth_map
-from mde_agrivln.for_json import get_stop_start_time, clean_format_stl_state, append_action
-
-
-# system prompt
-def get_system_prompt(representation, frame_ratio=None):
-
-   if representation == 'matrix':
-
-      if frame_ratio == [16, 9]:
-         system_prompt = """
+from string import Template
+from concurrent.futures import ThreadPoolExecutor
+
+from mde_agrivln.chat import run_chat
+from mde_agrivln.read_depth import read_depth_episode
+from mde_agrivln.render_cache import load_render_cache, save_render_cache, render_cached
+from mde_agrivln.for_json import append_action
+from mde_agrivln.episode import load_episode
+from mde_agrivln.checkpoint import resume_journals, truncate_journals
+from mde_agrivln.depth_store import parse_time_key
+from mde_agrivln.tracing import span, bind_trace
+from mde_agrivln.journal import JournalWriter, export_episode
+from mde_agrivln.subtask_state import SubtaskState
+from mde_agrivln.step_gate import GATE_DEPTH_RATIO, load_thumbnail
+from mde_agrivln.hyperparameter import get_hyperparameter
+from mde_agrivln.image_cache import get_image_payload
+from mde_agrivln.depth_encoding import format_depth_matrix, get_depth_matrix_description
+
+
+# system prompt, the same for every representation but the depth inputs
+SYSTEM_PROMPT = Template("""
 You are an expert in Vision-and-Language Navigation (VLN) for guiding an agricultural robot. Your mission is to understand both the previous subtask list and the current camera image, to make decision for next action and update subtask list. 
 
 To accomplish the mission, you need: 
@@ -49,12 +54,11 @@ Subtask List format:
    ...
 ]
 
-In addition, the monocular depth estimation result is provided to assist spatial understanding, represented in the depth matrix format. 
+$depth_intro
 
 For input, you will be provided with: 
 - Subtask List from the previous time step.
-- Depth matrix in absolute metric scale (in meters) after downsampling from 640×360 to 16×9.
-- RGB image from robot's camera (a super wide angle lens with 13mm focal length) feed on the current time step. 
+$inputs
 
 Output format:
 <thought> {your reasoning process about why this action is appropriate} </thought>
@@ -68,228 +72,39 @@ Here is a correct example for output format:
 
 Important:
 The <action> tag must reflect your final, reasoned decision. If you revise your choice during <thought>, make sure to update <action> accordingly.
-      """
-      
-      elif frame_ratio == [32, 18]:
-         system_prompt = """
-You are an expert in Vision-and-Language Navigation (VLN) for guiding an agricultural robot. Your mission is to understand both the previous subtask list and the current camera image, to make decision for next action and update subtask list. 
+$indent""")
 
-To accomplish the mission, you need: 
-1. Understand both the previous subtask list and the current camera image. 
-2. Select the most reasonable next action from: [FORWARD], [LEFT ROTATE], [RIGHT ROTATE], or [STOP]. The actions [LEFT ROTATE] and [RIGHT ROTATE] refer to the robot physically rotating its body in place (not camera panning or sliding the image). 
-3. Explain your decision clearly: why you chose the action, and why you keep or change the state of subtask list. Please be logical, observant and practical, as if you were physically navigating the robot.
-4. Update the subtask list.
+DEPTH_INTROS = {
+   'matrix': "In addition, the monocular depth estimation result is provided to assist spatial understanding, represented in the depth matrix format. ",
+   'map': "In addition, the monocular depth estimation results are provided to assist spatial understanding, represented in the depth map format. ",
+   'hybrid': "In addition, the monocular depth estimation results are provided to assist spatial understanding, represented in two formats: a depth matrix and a depth map. "
+}
 
-Subtask List rules: 
-- The Subtask List provided to you is from the previous time step.
-- One Subtask List consists of several subtasks, and all subtasks should be completed one by one in order.
-- Every subtask has three types of state: pending, doing, and done. 
-- When there is a subtask in state of doing, you only need focus on this subtask. Through the understanding on both the subtask description and the camera image, carefully reason whether this subtask is completed, i.e., the end condition is satisfied. If true, change the state from doing to done. If false, keep the state of doing. 
-- When there is no subtasks in state of doing, you only need focus on the first subtask among all subtasks in state of pending. Through the understanding on both the subtask description and the camera image, carefully reason whether this subtask should start, i.e., the start condition is satisfied. If true, change the state from pending to doing. If false, keep the state of pending.
-- You cannot skip the state of doing and directly change the state from pending to done, i.e., state of doing is a necessary procedure. 
-- You **must not** execute action [STOP] unless all subtasks have been completed, i.e., in state of done.
-- Do **not** confuse "seeing the object" with "reaching the object".
+RGB_INPUT = "- RGB image from robot's camera (a super wide angle lens with 13mm focal length) feed on the current time step. "
+DEPTH_MAP_INPUT = "- Depth map in relative metric scale rendered into RGB representation, in which objects are rendered from red to blue according to their distance from near to far."
 
-Subtask List format:
-[
-   {
-      "step": "serial number of the subtask",
-      "subtask": "description of the subtask",
-      "start_condition": "condition to start",
-      "end_condition": "condition to end",
-      "state": "pending/doing/done"
-   },
-   ...
-]
-
-In addition, the monocular depth estimation result is provided to assist spatial understanding, represented in the depth matrix format. 
-
-For input, you will be provided with: 
-- Subtask List from the previous time step.
-- Depth matrix in absolute metric scale (in meters) after downsampling from 640×360 to 32×18.
-- RGB image from robot's camera (a super wide angle lens with 13mm focal length) feed on the current time step. 
-
-Output format:
-<thought> {your reasoning process about why this action is appropriate} </thought>
-<action> [{the selected action}] </action>
-<state> Subtask NO.{number of subtask} changes from {old state} to {new state} (if state changes). or Subtask NO.{number of subtask} keeps state of {old state} (if no state changes). </state>
-
-Here is a correct example for output format: 
-<thought> The robot needs to move forward to reach the yellow bench... </thought>  
-<action> [FORWARD] </action> 
-<state> Subtask NO.2 changes from pending to doing. </state>
-
-Important:
-The <action> tag must reflect your final, reasoned decision. If you revise your choice during <thought>, make sure to update <action> accordingly.
-      """
-      
-      elif frame_ratio == [64, 36]:
-         system_prompt = """
-You are an expert in Vision-and-Language Navigation (VLN) for guiding an agricultural robot. Your mission is to understand both the previous subtask list and the current camera image, to make decision for next action and update subtask list. 
-
-To accomplish the mission, you need: 
-1. Understand both the previous subtask list and the current camera image. 
-2. Select the most reasonable next action from: [FORWARD], [LEFT ROTATE], [RIGHT ROTATE], or [STOP]. The actions [LEFT ROTATE] and [RIGHT ROTATE] refer to the robot physically rotating its body in place (not camera panning or sliding the image). 
-3. Explain your decision clearly: why you chose the action, and why you keep or change the state of subtask list. Please be logical, observant and practical, as if you were physically navigating the robot.
-4. Update the subtask list.
-
-Subtask List rules: 
-- The Subtask List provided to you is from the previous time step.
-- One Subtask List consists of several subtasks, and all subtasks should be completed one by one in order.
-- Every subtask has three types of state: pending, doing, and done. 
-- When there is a subtask in state of doing, you only need focus on this subtask. Through the understanding on both the subtask description and the camera image, carefully reason whether this subtask is completed, i.e., the end condition is satisfied. If true, change the state from doing to done. If false, keep the state of doing. 
-- When there is no subtasks in state of doing, you only need focus on the first subtask among all subtasks in state of pending. Through the understanding on both the subtask description and the camera image, carefully reason whether this subtask should start, i.e., the start condition is satisfied. If true, change the state from pending to doing. If false, keep the state of pending.
-- You cannot skip the state of doing and directly change the state from pending to done, i.e., state of doing is a necessary procedure. 
-- You **must not** execute action [STOP] unless all subtasks have been completed, i.e., in state of done.
-- Do **not** confuse "seeing the object" with "reaching the object".
-
-Subtask List format:
-[
-   {
-      "step": "serial number of the subtask",
-      "subtask": "description of the subtask",
-      "start_condition": "condition to start",
-      "end_condition": "condition to end",
-      "state": "pending/doing/done"
-   },
-   ...
-]
-
-In addition, the monocular depth estimation result is provided to assist spatial understanding, represented in the depth matrix format. 
-
-For input, you will be provided with: 
-- Subtask List from the previous time step.
-- Depth matrix in absolute metric scale (in meters) after downsampling from 640×360 to 64×36.
-- RGB image from robot's camera (a super wide angle lens with 13mm focal length) feed on the current time step. 
-
-Output format:
-<thought> {your reasoning process about why this action is appropriate} </thought>
-<action> [{the selected action}] </action>
-<state> Subtask NO.{number of subtask} changes from {old state} to {new state} (if state changes). or Subtask NO.{number of subtask} keeps state of {old state} (if no state changes). </state>
-
-Here is a correct example for output format: 
-<thought> The robot needs to move forward to reach the yellow bench... </thought>  
-<action> [FORWARD] </action> 
-<state> Subtask NO.2 changes from pending to doing. </state>
-
-Important:
-The <action> tag must reflect your final, reasoned decision. If you revise your choice during <thought>, make sure to update <action> accordingly.
-      """
-      
-      else:
-         print('[ERROR] Invalid frame ratio.')
 
+def get_system_prompt(representation, frame_ratio=None, encoding='json', pooling='point'):
+   if frame_ratio is None:
+      frame_ratio = [16, 9]
+   if representation == 'matrix':
+      inputs = [get_depth_matrix_description(frame_ratio, encoding, pooling), RGB_INPUT]
    elif representation == 'map':
-      system_prompt = """
-You are an expert in Vision-and-Language Navigation (VLN) for guiding an agricultural robot. Your mission is to understand both the previous subtask list and the current camera image, to make decision for next action and update subtask list. 
-
-To accomplish the mission, you need: 
-1. Understand both the previous subtask list and the current camera image. 
-2. Select the most reasonable next action from: [FORWARD], [LEFT ROTATE], [RIGHT ROTATE], or [STOP]. The actions [LEFT ROTATE] and [RIGHT ROTATE] refer to the robot physically rotating its body in place (not camera panning or sliding the image). 
-3. Explain your decision clearly: why you chose the action, and why you keep or change the state of subtask list. Please be logical, observant and practical, as if you were physically navigating the robot.
-4. Update the subtask list.
-
-Subtask List rules: 
-- The Subtask List provided to you is from the previous time step.
-- One Subtask List consists of several subtasks, and all subtasks should be completed one by one in order.
-- Every subtask has three types of state: pending, doing, and done. 
-- When there is a subtask in state of doing, you only need focus on this subtask. Through the understanding on both the subtask description and the camera image, carefully reason whether this subtask is completed, i.e., the end condition is satisfied. If true, change the state from doing to done. If false, keep the state of doing. 
-- When there is no subtasks in state of doing, you only need focus on the first subtask among all subtasks in state of pending. Through the understanding on both the subtask description and the camera image, carefully reason whether this subtask should start, i.e., the start condition is satisfied. If true, change the state from pending to doing. If false, keep the state of pending.
-- You cannot skip the state of doing and directly change the state from pending to done, i.e., state of doing is a necessary procedure. 
-- You **must not** execute action [STOP] unless all subtasks have been completed, i.e., in state of done.
-- Do **not** confuse "seeing the object" with "reaching the object".
-
-Subtask List format:
-[
-   {
-      "step": "serial number of the subtask",
-      "subtask": "description of the subtask",
-      "start_condition": "condition to start",
-      "end_condition": "condition to end",
-      "state": "pending/doing/done"
-   },
-   ...
-]
-
-In addition, the monocular depth estimation results are provided to assist spatial understanding, represented in the depth map format. 
-
-For input, you will be provided with: 
-- Subtask List from the previous time step.
-- RGB image from robot's camera (a super wide angle lens with 13mm focal length) feed on the current time step. 
-- Depth map in relative metric scale rendered into RGB representation, in which objects are rendered from red to blue according to their distance from near to far.
-
-Output format:
-<thought> {your reasoning process about why this action is appropriate} </thought>
-<action> [{the selected action}] </action>
-<state> Subtask NO.{number of subtask} changes from {old state} to {new state} (if state changes). or Subtask NO.{number of subtask} keeps state of {old state} (if no state changes). </state>
-
-Here is a correct example for output format: 
-<thought> The robot needs to move forward to reach the yellow bench... </thought>  
-<action> [FORWARD] </action> 
-<state> Subtask NO.2 changes from pending to doing. </state>
-
-Important:
-The <action> tag must reflect your final, reasoned decision. If you revise your choice during <thought>, make sure to update <action> accordingly.
-   """
-
+      inputs = [RGB_INPUT, DEPTH_MAP_INPUT]
    elif representation == 'hybrid':
-      system_prompt = """
-You are an expert in Vision-and-Language Navigation (VLN) for guiding an agricultural robot. Your mission is to understand both the previous subtask list and the current camera image, to make decision for next action and update subtask list. 
-
-To accomplish the mission, you need: 
-1. Understand both the previous subtask list and the current camera image. 
-2. Select the most reasonable next action from: [FORWARD], [LEFT ROTATE], [RIGHT ROTATE], or [STOP]. The actions [LEFT ROTATE] and [RIGHT ROTATE] refer to the robot physically rotating its body in place (not camera panning or sliding the image). 
-3. Explain your decision clearly: why you chose the action, and why you keep or change the state of subtask list. Please be logical, observant and practical, as if you were physically navigating the robot.
-4. Update the subtask list.
-
-Subtask List rules: 
-- The Subtask List provided to you is from the previous time step.
-- One Subtask List consists of several subtasks, and all subtasks should be completed one by one in order.
-- Every subtask has three types of state: pending, doing, and done. 
-- When there is a subtask in state of doing, you only need focus on this subtask. Through the understanding on both the subtask description and the camera image, carefully reason whether this subtask is completed, i.e., the end condition is satisfied. If true, change the state from doing to done. If false, keep the state of doing. 
-- When there is no subtasks in state of doing, you only need focus on the first subtask among all subtasks in state of pending. Through the understanding on both the subtask description and the camera image, carefully reason whether this subtask should start, i.e., the start condition is satisfied. If true, change the state from pending to doing. If false, keep the state of pending.
-- You cannot skip the state of doing and directly change the state from pending to done, i.e., state of doing is a necessary procedure. 
-- You **must not** execute action [STOP] unless all subtasks have been completed, i.e., in state of done.
-- Do **not** confuse "seeing the object" with "reaching the object".
-
-Subtask List format:
-[
-   {
-      "step": "serial number of the subtask",
-      "subtask": "description of the subtask",
-      "start_condition": "condition to start",
-      "end_condition": "condition to end",
-      "state": "pending/doing/done"
-   },
-   ...
-]
-
-In addition, the monocular depth estimation results are provided to assist spatial understanding, represented in two formats: a depth matrix and a depth map. 
-
-For input, you will be provided with: 
-- Subtask List from the previous time step.
-- Depth matrix in absolute metric scale (in meters) after downsampling from 640×360 to 16×9.
-- RGB image from robot's camera (a super wide angle lens with 13mm focal length) feed on the current time step. 
-- Depth map in relative metric scale rendered into RGB representation, in which objects are rendered from red to blue according to their distance from near to far.
-
-Output format:
-<thought> {your reasoning process about why this action is appropriate} </thought>
-<action> [{the selected action}] </action>
-<state> Subtask NO.{number of subtask} changes from {old state} to {new state} (if state changes). or Subtask NO.{number of subtask} keeps state of {old state} (if no state changes). </state>
-
-Here is a correct example for output format: 
-<thought> The robot needs to move forward to reach the yellow bench... </thought>  
-<action> [FORWARD] </action> 
-<state> Subtask NO.2 changes from pending to doing. </state>
-
-Important:
-The <action> tag must reflect your final, reasoned decision. If you revise your choice during <thought>, make sure to update <action> accordingly.
-   """
-   return system_prompt
+      inputs = [get_depth_matrix_description(frame_ratio, encoding, pooling), RGB_INPUT, DEPTH_MAP_INPUT]
+   else:
+      print('[ERROR] Invalid representation.')
+      sys.exit(1)
+   return SYSTEM_PROMPT.substitute(
+      depth_intro=DEPTH_INTROS[representation],
+      inputs="\n".join(inputs),
+      indent=" " * 6 if representation == 'matrix' else " " * 3
+   )
 
 
 # user prompt
-def get_user_prompt(STL, depth_matrix, representation):
+def get_user_prompt(STL, depth_matrix, representation, encoding='json'):
    # map: subtask list only
    if representation == 'map':
       user_prompt = f"""
@@ -299,9 +114,7 @@ def get_user_prompt(STL, depth_matrix, representation):
       """
    # matrix or hybrid: subtask list + depth matrix
    else:
-      depth_matrix_formatted = "[\n" + "\n".join(
-         ["  " + json.dumps(row) + "," for row in depth_matrix]
-      ) + "\n]"
+      depth_matrix_formatted = format_depth_matrix(depth_matrix, encoding)
       user_prompt = f"""
 <subtask_list>
 {json.dumps(STL, indent=3, ensure_ascii=False)}
@@ -351,217 +164,243 @@ def update_subtask_state(new_STL, number, old_state, new_state):
    return new_STL
 
 
-def append_stl_state(state_path, new_entry):
-   try:
-      with open(state_path, 'r') as f:
-         data = json.load(f)
-   except FileNotFoundError:
-      data = []
-   data.append(new_entry)
-   with open(state_path, 'w') as f:
-      json.dump(data, f, indent=3, separators=(",", ": "))
-
-
-def load_json(path):
-   with open(path, 'r') as f:
-      return json.load(f)
-   
+def decide(my_model, exp, place, id, representation, frame_ratio, estimater, if_token, if_pipeline='False', chat=None, encoding='json', pooling='point', episode=None, if_resume='False', gate=None):
+   return run_chat(decide_requests(my_model, exp, place, id, representation, frame_ratio, estimater, if_token, if_pipeline, encoding, pooling, episode, if_resume, gate), chat)
 
-def merge_stl_and_state(stl_path, state_path, current_time):
-   STL = load_json(stl_path)
-   STL_states = load_json(state_path)
 
-   def time_str_to_float(time_str):
-      minutes, tenths = time_str.split("'")
-      return int(minutes) + int(tenths) / 10
+def decide_requests(my_model, exp, place, id, representation, frame_ratio, estimater, if_token, if_pipeline='False', encoding='json', pooling='point', episode=None, if_resume='False', gate=None):
 
-   current_time_val = time_str_to_float(current_time)
-   closest_state = None
-   for state_snapshot in STL_states:
-      snapshot_time = time_str_to_float(state_snapshot['time'])
-      if snapshot_time <= current_time_val:
-         closest_state = state_snapshot
-      else:
-         break
-   if closest_state is None:
-      raise ValueError(f"No matching STL state found for time {current_time}")
-   state_dict = {s['step']: s['state'] for s in closest_state['subtask_list']}
-   merged_STL = []
-   for subtask in STL:
-      step = subtask['step']
-      merged_subtask = dict(subtask)
-      merged_subtask['state'] = state_dict.get(step, "unknown")  # fallback
-      merged_STL.append(merged_subtask)
-   return merged_STL
-
-
-def decide(my_model, exp, place, id, representation, frame_ratio, estimater, if_token):
-
-   t_a = 0
-   t_b = 0
    t_b_interval = 2
-   FPS = 5.0
-   safe_redundancy = 2
-   # frame_ratio = [16, 9]  # frame ratio of depth matrix after sampling
+   # frame_ratio = [16, 9]  # frame ratio of depth matrix after sampling, see get_frame_ratio
 
-   label_path = f"dataset/{place}_{id}/label.json"
-   with open(label_path, "r") as f:
-      labels = json.load(f)
+   # STOP start time, max time and time keys (FPS 5.0, safe redundancy 2) come with the episode
+   if episode is None:
+      episode = load_episode(place, id)
 
-   stop_start_time = get_stop_start_time(labels)
+   stop_start_time = episode.stop_start_time
    print("[INFO] Label STOP begins at: ", stop_start_time)
-   max_time = float(stop_start_time) + (1 / FPS) * safe_redundancy
+   max_time = episode.max_time
    print(f'[INFO] Max time step: {max_time}')
 
-   stop_quantity = 0
-
-   while float(t_a) + float(t_b) / 10.0 < max_time:
+   time_keys = episode.time_keys
 
-      t = f'{t_a}\'{t_b}'  # time
-
-      STL_path = f"runs/{exp}/{place}_{id}/STL.json"
-      log_path = f"runs/{exp}/{place}_{id}/log.json"
-      STL = merge_stl_and_state(STL_path, log_path, current_time=t)
-
-      # depth matrix
+   # resumed: start after the last committed step, the records of a step cut off are dropped
+   dir_path = f"runs/{exp}/{place}_{id}"
+   if if_resume == 'True':
+      start_time, stop_quantity = resume_journals(dir_path, time_keys)
+      if start_time != "0'0":
+         print(f"[INFO] {place}_{id} resumes at {start_time} after {stop_quantity} [STOP].")
+   else:
+      start_time, stop_quantity = "0'0", 0
+      truncate_journals(dir_path, start_time)
+   t_a, t_b = parse_time_key(start_time)
+   step = time_keys.index(start_time) if start_time in time_keys else len(time_keys)
+
+   # sample the depth matrices of all remaining time steps in one batch
+   if representation != 'map':
+      with span('decide.read_depth'):
+         depth_matrices = read_depth_episode(place, id, frame_ratio, estimater, time_keys[step:], pooling)
+
+   # the step gate compares the depth matrix, for the map representation a point sampled grid
+   episode_gate = gate.for_episode() if gate is not None else None
+   if episode_gate is not None:
       if representation != 'map':
-         depth_matrix = read_depth(place, id, [t_a, t_b], frame_ratio, estimater)
+         gate_depth_matrices = depth_matrices
       else:
-         depth_matrix = None
-      
-      # depth map
-      if representation != 'matrix':
-         npz_path = f"{estimater}/output/{place}_{id}/frame_{t_a}'{t_b}.npz"
-         map_path = f"{estimater}/output/{place}_{id}/frame_{t_a}'{t_b}.png"
-         my_cmap = 'turbo_r'  # option: Spectral, viridis, turbo_r
-         if render_depth_map(npz_path, map_path, my_cmap) == True:
-            print(f"[INFO] Depth map saved to: {map_path}.")
-         else:
-            print('[ERROR] Fail to render the depth map.')
-            sys.exit(1)
-         time.sleep(0.1)
-
-      if t_a == 0 and t_b == 0:
-         print('[INFO] user prompt:')
-         print(get_user_prompt(STL, depth_matrix, representation))
-
-      # camera image
-      image_path = f"dataset/{place}_{id}/frames/frame_{t}.jpg"
-
-      # message
-      if representation == 'matrix':
-         messages = [
-            {
-               'role': 'system',
-               'content': get_system_prompt(representation, frame_ratio)
-            },
-            {
-               'role': 'user',
-               'content': get_user_prompt(STL, depth_matrix, representation),
-               'images': [image_path]
-            }
-         ]
-      elif representation == 'map':
-         messages = [
-            {
-               'role': 'system',
-               'content': get_system_prompt(representation)
-            },
-            {
-               'role': 'user',
-               'content': get_user_prompt(STL, None, representation),
-               'images': [image_path, map_path]
-            }
-         ]
-      elif representation == 'hybrid':
-         messages = [
-            {
-               'role': 'system',
-               'content': get_system_prompt(representation)
-            },
-            {
-               'role': 'user',
-               'content': get_user_prompt(STL, depth_matrix, representation),
-               'images': [image_path, map_path]
-            }
+         with span('decide.read_depth'):
+            gate_depth_matrices = read_depth_episode(place, id, GATE_DEPTH_RATIO, estimater, time_keys[step:], 'point')
+
+   # depth maps already rendered from the same depth and colormap are reused
+   if representation != 'matrix':
+      my_cmap = get_hyperparameter('cmap')
+      render_cache = load_render_cache(place, id, estimater)
+      # saved once after the loop, not after every rendered frame
+      rendered_count = 0
+
+   def prepare_frame(t):
+      # everything of step t that does not depend on the subtask list
+      nonlocal rendered_count
+      with span('decide.prepare_frame', t=t):
+         frame = {
+            "depth_matrix": depth_matrices[t] if representation != 'map' else None,
+            "image_path": episode.frame_path(t),
+            "map_path": None
+         }
+         if representation != 'matrix':
+            with span('decide.render_depth_map', t=t):
+               map_path, rendered = render_cached(place, id, t, estimater, my_cmap, render_cache)
+            if rendered:
+               rendered_count += 1
+               print(f"[INFO] Depth map saved to: {map_path}.")
+            else:
+               print(f"[INFO] Depth map is up to date: {map_path}.")
+            frame["map_path"] = map_path
+         # base64 payloads from the image cache instead of paths ollama would encode again
+         frame["images"] = [
+            get_image_payload(path)
+            for path in [frame["image_path"], frame["map_path"]]
+            if path is not None
          ]
-      else:
-         print('[ERROR] Invalid representation.')
-         sys.exit(1)
-
-      response = ollama.chat(model=my_model, messages=messages)
-      message = response['message']['content']
-
-      if if_token == 'True':
-         
-         token_prompt = response.prompt_eval_count
-         token_completion = response.eval_count
+         if episode_gate is not None:
+            frame["thumbnail"] = load_thumbnail(frame["image_path"])
+            frame["gate_depth"] = gate_depth_matrices[t]
+         return frame
+
+   # pipelined: step t+1 (render, image encoding) is prepared on a worker thread while step t waits on the VLM
+   if if_pipeline == 'True':
+      prefetcher = ThreadPoolExecutor(max_workers=1)
+      prefetch_frame = bind_trace(prepare_frame)
+      next_frame = prefetcher.submit(prefetch_frame, time_keys[step]) if step < len(time_keys) else None
+
+   # the subtask list lives in memory, snapshots go to log.jsonl in the background
+   STL_path = f"runs/{exp}/{place}_{id}/STL.json"
+   log_path = f"runs/{exp}/{place}_{id}/log.jsonl"
+   predict_path = f"runs/{exp}/{place}_{id}/predict.jsonl"
+   token_path = f"runs/{exp}/{place}_{id}/token.jsonl"
+   journal_writer = JournalWriter()
+   subtask_state = SubtaskState.from_files(STL_path, log_path, journal_writer)
+   subtask_state.restore(f'{t_a}\'{t_b}')
+
+   # also on a failed call: what was committed reaches the journals before a resume reads them
+   try:
+      while float(t_a) + float(t_b) / 10.0 < max_time and stop_quantity < 3:
 
-         token_path = f"runs/{exp}/{place}_{id}/token.json"
+         t = f'{t_a}\'{t_b}'  # time
 
-         # Create directory if it doesn't exist
-         os.makedirs(os.path.dirname(token_path), exist_ok=True)
+         STL = subtask_state.current
 
-         # If file exists, load it; otherwise start a new list
-         if os.path.exists(token_path):
-            with open(token_path, "r") as token_f:
-               try:
-                  data = json.load(token_f)
-               except json.JSONDecodeError:
-                  data = []
+         # depth matrix, depth map and camera image
+         if if_pipeline == 'True':
+            with span('decide.wait_frame', t=t):
+               frame = next_frame.result()
+            if step + 1 < len(time_keys):
+               next_frame = prefetcher.submit(prefetch_frame, time_keys[step + 1])
          else:
-            data = []
-
-         # Append the new record
-         data.append({
-            "place": place,
-            "time": t,
-            "token_prompt": token_prompt,
-            "token_completion": token_completion
-         })
-
-         # Save back to JSON
-         with open(token_path, "w") as token_f:
-            json.dump(data, token_f, indent=4)
-
-      result = extract(message)
-      action = result['action']
-      thought = result['thought']
-      state = result['state']
-      predict_path = f"runs/{exp}/{place}_{id}/predict.json"
-      append_action(predict_path, t, action, thought, state)
-
-      if state == None:
-         new_STL = STL
-         print('[WARNING] State = None.')
-      else:
-         if 'keep' in state:
+            frame = prepare_frame(t)
+         step += 1
+         depth_matrix = frame["depth_matrix"]
+
+         if t_a == 0 and t_b == 0:
+            print('[INFO] user prompt:')
+            print(get_user_prompt(STL, depth_matrix, representation, encoding))
+
+         # unchanged scene: the previous action is reused and the subtask list is kept
+         reused = None
+         if episode_gate is not None:
+            with span('decide.gate', t=t):
+               reused, image_change, depth_change = episode_gate.check(frame["thumbnail"], frame["gate_depth"])
+
+         if reused is not None:
+            thought = f"The scene is unchanged since {reused} (image change {image_change:.3f}, depth change {depth_change:.3f}), the previous decision is reused."
+            append_action(predict_path, t, action, thought, None, journal_writer, reused)
             new_STL = STL
-         if 'change' in state:
-            number, old_state, new_state = extract_state(state)
-            new_STL = update_subtask_state(STL, number, old_state, new_state)
-
-      print(f'{place}_{id}, {t_a}.{t_b}, {action}')
-      if if_token == 'True':
-         print(f'Token: ({token_prompt}, {token_completion})')
-
-      t_b += t_b_interval
-      if t_b == 10:
-         t_b = 0
-         t_a += 1
-
-      new_STL_slimmed = [
-         {"step": item["step"], "state": item["state"]}
-         for item in new_STL
-      ]
-      next_STL_state = {
-         "time": f"{t_a}'{t_b}",
-         "subtask_list": new_STL_slimmed
-      }
-      append_stl_state(log_path, next_STL_state)
-      clean_format_stl_state(log_path)
+            print(f'{place}_{id}, {t_a}.{t_b}, {action} (reused)')
+
+         else:
+            # message
+            with span('decide.prompt', t=t):
+               if representation == 'matrix':
+                  messages = [
+                     {
+                        'role': 'system',
+                        'content': get_system_prompt(representation, frame_ratio, encoding, pooling)
+                     },
+                     {
+                        'role': 'user',
+                        'content': get_user_prompt(STL, depth_matrix, representation, encoding),
+                        'images': frame["images"]
+                     }
+                  ]
+               elif representation == 'map':
+                  messages = [
+                     {
+                        'role': 'system',
+                        'content': get_system_prompt(representation)
+                     },
+                     {
+                        'role': 'user',
+                        'content': get_user_prompt(STL, None, representation),
+                        'images': frame["images"]
+                     }
+                  ]
+               elif representation == 'hybrid':
+                  messages = [
+                     {
+                        'role': 'system',
+                        'content': get_system_prompt(representation, frame_ratio, encoding, pooling)
+                     },
+                     {
+                        'role': 'user',
+                        'content': get_user_prompt(STL, depth_matrix, representation, encoding),
+                        'images': frame["images"]
+                     }
+                  ]
+               else:
+                  print('[ERROR] Invalid representation.')
+                  sys.exit(1)
+
+            response = yield {'model': my_model, 'messages': messages, 'stop_tags': ['thought', 'action', 'state']}
+            message = response['message']['content']
+
+            with span('decide.parse', t=t):
+               if if_token == 'True':
+         
+                  token_prompt = response.prompt_eval_count
+                  token_completion = response.eval_count
+
+                  # Append the new record
+                  journal_writer.append(token_path, {
+                     "place": place,
+                     "time": t,
+                     "token_prompt": token_prompt,
+                     "token_completion": token_completion
+                  })
+
+               result = extract(message)
+               action = result['action']
+               thought = result['thought']
+               state = result['state']
+               append_action(predict_path, t, action, thought, state, journal_writer)
+
+               if state == None:
+                  new_STL = STL
+                  print('[WARNING] State = None.')
+               else:
+                  if 'keep' in state:
+                     new_STL = STL
+                  if 'change' in state:
+                     number, old_state, new_state = extract_state(state)
+                     new_STL = update_subtask_state(STL, number, old_state, new_state)
+
+               print(f'{place}_{id}, {t_a}.{t_b}, {action}')
+               if if_token == 'True':
+                  print(f'Token: ({token_prompt}, {token_completion})')
+
+            if episode_gate is not None:
+               episode_gate.called(t, frame["thumbnail"], frame["gate_depth"], action)
+
+         t_b += t_b_interval
+         if t_b == 10:
+            t_b = 0
+            t_a += 1
+
+         subtask_state.commit(f"{t_a}'{t_b}", new_STL)
       
-      if action == '[STOP]':
-         stop_quantity += 1
-      if stop_quantity >= 3:
-         break
+         if action == '[STOP]':
+            stop_quantity += 1
+         if stop_quantity >= 3:
+            break
+
+   finally:
+      if if_pipeline == 'True':
+         prefetcher.shutdown(wait=True)
+      journal_writer.close()
+      if representation != 'matrix' and rendered_count > 0:
+         save_render_cache(place, id, estimater, render_cache)
+
+   if episode_gate is not None:
+      print(episode_gate.summary(f'{place}_{id}'))
+
+   # predict.json, log.json and token.json in their usual layout
+   with span('decide.export'):
+      export_episode(f"runs/{exp}/{place}_{id}")
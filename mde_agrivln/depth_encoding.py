@@ -0,0 +1,64 @@
+# MDE-AgriVLN - The Depth Matrix Encoding Module
+#
+# How the depth matrix is written into the user prompt, and the matching
+# input line of the system prompt. Everything but `json` trades precision
+# for prompt tokens:
+#
+#    json:   JSON rows of floats in meters, two decimals (the original format)
+#    dm:     JSON rows of integers in decimeters
+#    row:    one line per row, meters with one decimal, separated by spaces
+#    bucket: one line per row, one digit per cell, the distance bucket of the cell
+
+import json
+
+
+ENCODINGS = ['json', 'dm', 'row', 'bucket']
+
+# upper edges of the buckets 0 to 8 in meters, bucket 9 is everything farther
+BUCKET_EDGES = [1, 2, 3, 4, 6, 8, 12, 16, 24]
+
+
+def get_bucket(value):
+   for i, edge in enumerate(BUCKET_EDGES):
+      if value < edge:
+         return i
+   return len(BUCKET_EDGES)
+
+
+def get_bucket_legend():
+   legend = [f"0 (<{BUCKET_EDGES[0]} m)"]
+   for i in range(1, len(BUCKET_EDGES)):
+      legend.append(f"{i} ({BUCKET_EDGES[i - 1]}-{BUCKET_EDGES[i]} m)")
+   legend.append(f"{len(BUCKET_EDGES)} (≥{BUCKET_EDGES[-1]} m)")
+   return ", ".join(legend)
+
+
+def format_depth_matrix(depth_matrix, encoding='json'):
+   if encoding == 'json':
+      return "[\n" + "\n".join(
+         ["  " + json.dumps(row) + "," for row in depth_matrix]
+      ) + "\n]"
+   if encoding == 'dm':
+      return "[\n" + "\n".join(
+         [json.dumps([int(round(value * 10)) for value in row], separators=(",", ":")) + "," for row in depth_matrix]
+      ) + "\n]"
+   if encoding == 'row':
+      return "\n".join(" ".join(f"{value:.1f}" for value in row) for row in depth_matrix)
+   if encoding == 'bucket':
+      return "\n".join("".join(str(get_bucket(value)) for value in row) for row in depth_matrix)
+   raise ValueError(f"Invalid encoding: {encoding}")
+
+
+def get_depth_matrix_description(frame_ratio, encoding='json', pooling='point'):
+   size = f"640×360 to {frame_ratio[0]}×{frame_ratio[1]}"
+   if pooling != 'point':
+      size = f"{size} by the {pooling} of each cell"
+   if encoding == 'json':
+      return f"- Depth matrix in absolute metric scale (in meters) after downsampling from {size}."
+   if encoding == 'dm':
+      return f"- Depth matrix in absolute metric scale (in decimeters, as integers) after downsampling from {size}."
+   if encoding == 'row':
+      return f"- Depth matrix in absolute metric scale (in meters, one decimal) after downsampling from {size}, written as one line per row from top to bottom, with the values separated by spaces."
+   if encoding == 'bucket':
+      return f"- Depth matrix after downsampling from {size}, written as one line per row from top to bottom, with one digit per value for its distance: {get_bucket_legend()}."
+   raise ValueError(f"Invalid encoding: {encoding}")
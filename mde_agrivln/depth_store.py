@@ -0,0 +1,179 @@
+# MDE-AgriVLN - The Depth Store Module
+#
+# Packs all frame_*.npz of one episode into a single memory-mapped array:
+#    {estimater}/output/{place}_{id}/depth.npy          (frames, height, width)
+#    {estimater}/output/{place}_{id}/depth_index.json   time keys, dtype and scale
+# float32 keeps the original values, float16 halves the size, uint16 stores
+# depth / scale with a per-episode scale.
+
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import numpy as np
+
+
+STORE_NAME = "depth.npy"
+INDEX_NAME = "depth_index.json"
+STORE_DTYPES = ['float32', 'float16', 'uint16']
+
+_open_stores = {}
+
+
+def get_depth_dir(place, id, estimater):
+   return f"{estimater}/output/{place}_{id}"
+
+
+def parse_time_key(time_key):
+   # "3'4" -> (3, 4)
+   t_a, t_b = time_key.split("'")
+   return int(t_a), int(t_b)
+
+
+def list_depth_times(place, id, estimater):
+   # time keys of all frame_*.npz of an episode, in time order
+   pattern = re.compile(r"frame_(\d+'\d+)\.npz$")
+   time_keys = []
+   for path in glob.glob(os.path.join(get_depth_dir(place, id, estimater), "frame_*.npz")):
+      match = pattern.search(os.path.basename(path))
+      if match:
+         time_keys.append(match.group(1))
+   return sorted(time_keys, key=parse_time_key)
+
+
+def load_npz_depth(npz_path):
+   with np.load(npz_path, allow_pickle=True) as data:
+      possible_keys = [k for k in data.keys() if 'depth' in k.lower()]
+      if not possible_keys:
+         raise KeyError("No depth-related array found in the .npz file.")
+      return data[possible_keys[0]]
+
+
+class EpisodeDepthStore:
+
+   def __init__(self, depth_dir):
+      with open(os.path.join(depth_dir, INDEX_NAME), "r") as f:
+         index = json.load(f)
+      self.depth_dir = depth_dir
+      self.time_keys = index["time_keys"]
+      self.rows = {time_key: i for i, time_key in enumerate(self.time_keys)}
+      self.dtype = index["dtype"]
+      self.scale = index["scale"]
+      self.depth = np.load(os.path.join(depth_dir, STORE_NAME), mmap_mode='r')
+
+   def __contains__(self, time_key):
+      return time_key in self.rows
+
+   def dequantize(self, array):
+      if self.dtype == 'uint16':
+         return array.astype(np.float32) * np.float32(self.scale)
+      return array
+
+   def raw(self, time_key):
+      # zero-copy view into the memory map, still in the stored dtype
+      return self.depth[self.rows[time_key]]
+
+   def get(self, time_key):
+      return self.dequantize(self.raw(time_key))
+
+   def get_many(self, time_keys):
+      rows = [self.rows[time_key] for time_key in time_keys]
+      return self.dequantize(self.depth[rows])
+
+   def sample(self, time_keys, pixel_rows, pixel_cols):
+      # grid samples of several frames, read straight from the memory map
+      rows = [self.rows[time_key] for time_key in time_keys]
+      return self.dequantize(self.depth[np.ix_(rows, pixel_rows, pixel_cols)])
+
+
+def open_episode_store(place, id, estimater):
+   # returns None when the episode has not been packed
+   depth_dir = get_depth_dir(place, id, estimater)
+   store_path = os.path.join(depth_dir, STORE_NAME)
+   index_path = os.path.join(depth_dir, INDEX_NAME)
+   if not (os.path.isfile(store_path) and os.path.isfile(index_path)):
+      return None
+   stamp = (os.stat(store_path).st_mtime_ns, os.stat(index_path).st_mtime_ns)
+   cached = _open_stores.get(depth_dir)
+   if cached is None or cached[0] != stamp:
+      cached = (stamp, EpisodeDepthStore(depth_dir))
+      _open_stores[depth_dir] = cached
+   return cached[1]
+
+
+def load_depth(place, id, time_key, estimater):
+   store = open_episode_store(place, id, estimater)
+   if store is not None and time_key in store:
+      return store.get(time_key)
+   return load_npz_depth(f"{get_depth_dir(place, id, estimater)}/frame_{time_key}.npz")
+
+
+def pack_episode(place, id, estimater, dtype='float32'):
+
+   if dtype not in STORE_DTYPES:
+      print(f'[ERROR] Invalid dtype: {dtype}.')
+      return False
+
+   depth_dir = get_depth_dir(place, id, estimater)
+   time_keys = list_depth_times(place, id, estimater)
+   if len(time_keys) == 0:
+      print(f'[ERROR] No depth frames found in {depth_dir}.')
+      return False
+
+   def frame(time_key):
+      return load_npz_depth(f"{depth_dir}/frame_{time_key}.npz")
+
+   first = frame(time_keys[0])
+
+   scale = None
+   if dtype == 'uint16':
+      max_depth = max(float(np.nanmax(frame(time_key))) for time_key in time_keys)
+      scale = max_depth / np.iinfo(np.uint16).max if max_depth > 0 else 1.0
+
+   # write to temporary files first, so readers never see a half-packed store
+   store_path = os.path.join(depth_dir, STORE_NAME)
+   index_path = os.path.join(depth_dir, INDEX_NAME)
+   store_tmp = store_path + ".tmp.npy"
+   index_tmp = index_path + ".tmp"
+
+   store = np.lib.format.open_memmap(store_tmp, mode='w+', dtype=dtype, shape=(len(time_keys),) + first.shape)
+   for i, time_key in enumerate(time_keys):
+      depth = first if i == 0 else frame(time_key)
+      if dtype == 'uint16':
+         depth = np.clip(np.rint(np.nan_to_num(depth) / scale), 0, np.iinfo(np.uint16).max)
+      store[i] = depth
+   store.flush()
+   del store
+
+   with open(index_tmp, "w") as f:
+      json.dump({"time_keys": time_keys, "dtype": dtype, "scale": scale, "shape": list(first.shape)}, f, indent=3)
+   os.replace(store_tmp, store_path)
+   os.replace(index_tmp, index_path)
+
+   size = os.path.getsize(store_path) / 1024 ** 2
+   print(f'[INFO] {len(time_keys)} frames packed to {store_path} ({dtype}, {size:.1f} MB).')
+   return True
+
+
+if __name__ == '__main__':
+
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-p", "--place", type=str, required=True, help="Place")
+   parser.add_argument("-i", "--id_range", type=int, nargs='+', required=True, help="ID range")
+   parser.add_argument("-e", "--estimater", type=str, required=True, help="Monocular depth estimation model")
+   parser.add_argument("-d", "--dtype", type=str, required=False, default='float32', help="Store dtype: float32, float16 or uint16")
+   args = parser.parse_args()
+
+   if len(args.id_range) == 2:
+      id_range = list(range(args.id_range[0], args.id_range[1] + 1))
+   else:
+      id_range = args.id_range
+
+   failed = 0
+   for id in id_range:
+      if pack_episode(args.place, id, args.estimater, args.dtype) == False:
+         failed += 1
+   if failed > 0:
+      sys.exit(1)
@@ -0,0 +1,256 @@
+# MDE-AgriVLN - The Endpoint Pool Module
+#
+# Spreads the model calls of an experiment over several ollama hosts. Each
+# call goes to the healthy host with the fewest requests in flight, among the
+# hosts that have the model (as listed by /api/tags; a host listing no models
+# is asked anyway). Every host keeps its own ollama.Client, so connections are
+# reused. A host whose call fails on the connection or with a server error is
+# ejected for a while and the call is retried on another host. A background
+# thread checks the hosts every few seconds, a host that does not answer is
+# out of rotation until it does again.
+#
+# Example:
+#    python home_mde_agrivln.py -p farm -i 1 20 -r matrix -e depth_pro -c 8 --host http://box1:11434 http://box2:11434
+
+import asyncio
+import threading
+import time
+
+import httpx
+import ollama
+
+from mde_agrivln.backend import OllamaBackend, OllamaAsyncClient, parse_keep_alive
+
+
+HEALTH_INTERVAL = 10.0
+HEALTH_TIMEOUT = 5.0
+EJECT_SECONDS = 30.0
+
+# returned by acquire when every host that could take the call is at its in-flight cap
+BUSY = object()
+
+
+def normalize_model(model):
+   return model if ':' in model else f"{model}:latest"
+
+
+def is_endpoint_error(error):
+   # errors of the host rather than of the request
+   if isinstance(error, ollama.ResponseError):
+      return error.status_code >= 500
+   return isinstance(error, (ConnectionError, httpx.TransportError))
+
+
+class Endpoint:
+
+   def __init__(self, host, keep_alive=None, stream='False', num_predict=None):
+      self.host = host
+      self.backend = OllamaBackend(host, keep_alive, stream, num_predict)
+      self.health_client = ollama.Client(host=host, timeout=HEALTH_TIMEOUT)
+      self.async_client = None
+      # None until the first health check: the models are unknown
+      self.models = None
+      self.missing = set()
+      self.outstanding = 0
+      self.healthy = True
+      self.ejected_until = 0.0
+      self.calls = 0
+      self.failures = 0
+
+   def has_model(self, model):
+      if normalize_model(model) in self.missing:
+         return False
+      return not self.models or normalize_model(model) in self.models
+
+   def check(self):
+      # returns True when the host answers /api/tags
+      try:
+         response = self.health_client.list()
+      except Exception:
+         return False
+      self.models = {normalize_model(model.model) for model in response.models if model.model}
+      self.missing.clear()
+      return True
+
+
+class EndpointPool:
+
+   def __init__(self, hosts, keep_alive=None, stream='False', num_predict=None, health_interval=HEALTH_INTERVAL, eject_seconds=EJECT_SECONDS, max_outstanding=None):
+      self.endpoints = [Endpoint(host, parse_keep_alive(keep_alive), stream, num_predict) for host in hosts]
+      self.keep_alive = parse_keep_alive(keep_alive)
+      self.stream = stream
+      self.num_predict = num_predict
+      self.eject_seconds = eject_seconds
+      # at most this many calls in flight per host, None for no cap
+      self.max_outstanding = max_outstanding
+      self.lock = threading.Lock()
+      self.released = threading.Condition(self.lock)
+      self.next = 0
+      self.check_health()
+      self.stopped = threading.Event()
+      if health_interval:
+         self.health_thread = threading.Thread(target=self._run_health_checks, args=(health_interval,), daemon=True)
+         self.health_thread.start()
+
+   def _run_health_checks(self, interval):
+      while not self.stopped.wait(interval):
+         self.check_health()
+
+   def check_health(self):
+      for endpoint in self.endpoints:
+         ok = endpoint.check()
+         with self.lock:
+            if ok and not endpoint.healthy:
+               print(f'[INFO] {endpoint.host} is back in rotation.')
+            elif not ok and endpoint.healthy:
+               print(f'[WARNING] {endpoint.host} fails the health check, taken out of rotation.')
+            endpoint.healthy = ok
+
+   def close(self):
+      self.stopped.set()
+
+   def acquire(self, model, tried=()):
+      # the healthy endpoint with the fewest calls in flight, ties in turn
+      with self.lock:
+         now = time.monotonic()
+         candidates = [
+            endpoint for endpoint in self.endpoints
+            if endpoint.healthy and endpoint.ejected_until <= now and endpoint not in tried and endpoint.has_model(model)
+         ]
+         if not candidates:
+            return None
+         if self.max_outstanding is not None:
+            candidates = [endpoint for endpoint in candidates if endpoint.outstanding < self.max_outstanding]
+            if not candidates:
+               return BUSY
+         least = min(endpoint.outstanding for endpoint in candidates)
+         candidates = [endpoint for endpoint in candidates if endpoint.outstanding == least]
+         endpoint = candidates[self.next % len(candidates)]
+         self.next += 1
+         endpoint.outstanding += 1
+         endpoint.calls += 1
+         return endpoint
+
+   def release(self, endpoint, model, error=None):
+      with self.lock:
+         endpoint.outstanding -= 1
+         self.released.notify_all()
+         if error is None:
+            return
+         endpoint.failures += 1
+         if isinstance(error, ollama.ResponseError) and error.status_code == 404:
+            # the host does not have the model
+            endpoint.missing.add(normalize_model(model))
+         elif is_endpoint_error(error):
+            endpoint.ejected_until = time.monotonic() + self.eject_seconds
+            print(f'[WARNING] {endpoint.host} failed ({error!r}), taken out of rotation for {self.eject_seconds:.0f} s.')
+
+   def should_retry(self, error):
+      return is_endpoint_error(error) or (isinstance(error, ollama.ResponseError) and error.status_code == 404)
+
+   def no_endpoint(self, model, error):
+      message = f"No endpoint left for {model}"
+      if error is not None:
+         raise RuntimeError(message) from error
+      raise RuntimeError(message)
+
+   def chat(self, **request):
+      model = request.get('model')
+      tried = []
+      error = None
+      checked = False
+      while True:
+         endpoint = self.acquire(model, tried)
+         if endpoint is BUSY:
+            with self.released:
+               self.released.wait(0.1)
+            continue
+         if endpoint is None and not checked:
+            # every host is out: check once whether one is back before giving up
+            self.check_health()
+            checked = True
+            continue
+         if endpoint is None:
+            self.no_endpoint(model, error)
+         tried.append(endpoint)
+         try:
+            response = endpoint.backend.chat(**request)
+         except Exception as e:
+            self.release(endpoint, model, e)
+            if not self.should_retry(e):
+               raise
+            error = e
+            continue
+         self.release(endpoint, model)
+         return response
+
+   def preload(self, model):
+      # load the model on every host that can serve it, returns the longest load
+      loads = []
+      for endpoint in self.endpoints:
+         if not endpoint.healthy or not endpoint.has_model(model):
+            continue
+         try:
+            loads.append(endpoint.backend.preload(model))
+         except Exception as e:
+            print(f'[WARNING] Fail to preload {model} on {endpoint.host}: {e!r}')
+      return max(loads, default=0.0)
+
+   def async_client(self):
+      return PoolAsyncClient(self)
+
+   def summary(self):
+      parts = []
+      for endpoint in self.endpoints:
+         state = 'healthy' if endpoint.healthy and endpoint.ejected_until <= time.monotonic() else 'out of rotation'
+         parts.append(f'{endpoint.host} {endpoint.calls} calls, {endpoint.failures} failures, {state}')
+      return '[INFO] Endpoints: ' + '; '.join(parts)
+
+
+class PoolAsyncClient:
+
+   def __init__(self, pool):
+      self.pool = pool
+      self.released = None
+
+   def get_client(self, endpoint):
+      # one ollama.AsyncClient per host, created in the running event loop
+      if endpoint.async_client is None:
+         endpoint.async_client = OllamaAsyncClient(ollama.AsyncClient(host=endpoint.host), self.pool.keep_alive, self.pool.stream, self.pool.num_predict)
+      return endpoint.async_client
+
+   async def chat(self, **request):
+      model = request.get('model')
+      tried = []
+      error = None
+      checked = False
+      if self.released is None:
+         self.released = asyncio.Condition()
+      while True:
+         endpoint = self.pool.acquire(model, tried)
+         if endpoint is BUSY:
+            async with self.released:
+               await self.released.wait()
+            continue
+         if endpoint is None and not checked:
+            await asyncio.to_thread(self.pool.check_health)
+            checked = True
+            continue
+         if endpoint is None:
+            self.pool.no_endpoint(model, error)
+         tried.append(endpoint)
+         try:
+            response = await self.get_client(endpoint).chat(**request)
+         except Exception as e:
+            await self.release(endpoint, model, e)
+            if not self.pool.should_retry(e):
+               raise
+            error = e
+            continue
+         await self.release(endpoint, model)
+         return response
+
+   async def release(self, endpoint, model, error=None):
+      self.pool.release(endpoint, model, error)
+      async with self.released:
+         self.released.notify_all()
@@ -0,0 +1,117 @@
+# MDE-AgriVLN - The Episode Module
+#
+# Everything known about dataset/{place}_{id} before a run: the labels, the
+# instruction and path length of info.json, the frames on disk, and what
+# follows from them (STOP start time, max time, time keys of the decision
+# loop). Loaded once per episode and shared by STL, decide and evaluate;
+# load_episode reuses a loaded episode while label.json and info.json are
+# unchanged.
+
+import json
+import os
+
+from mde_agrivln.for_json import get_stop_start_time, get_max_time, get_time_keys
+
+
+VALID_ACTIONS = {"[FORWARD]", "[LEFT ROTATE]", "[RIGHT ROTATE]", "[STOP]", "[WAIT]"}
+
+_episodes = {}
+
+
+def get_label_error(labels):
+   # None when the labels are usable
+   for i in range(len(labels)):
+      entry = labels[i]
+      if entry["action"] not in VALID_ACTIONS:
+         return f"Action NO. {i} is invalid: {entry['action']}"
+      if i < len(labels) - 1:
+         end_time = round(labels[i]["time_range"][1], 3)
+         next_start_time = round(labels[i + 1]["time_range"][0], 3)
+         if end_time != next_start_time:
+            return f"Time steps {i} and {i+1} are not connected: {end_time} ≠ {next_start_time}"
+   if get_stop_start_time(labels) is None:
+      return "No [STOP] label."
+   return None
+
+
+def check_label_format(labels):
+   error = get_label_error(labels)
+   if error is not None:
+      print(f"[ERROR] {error}")
+      return False
+   return True
+
+
+class Episode:
+
+   def __init__(self, place, id, labels, info, frame_keys, FPS=5.0, safe_redundancy=2, t_b_interval=2):
+      self.place = place
+      self.id = id
+      self.labels = labels
+      self.info = info
+      self.frame_keys = frame_keys
+      self.stop_start_time = get_stop_start_time(labels)
+      self.max_time = get_max_time(self.stop_start_time, FPS, safe_redundancy) if self.stop_start_time is not None else None
+      self.time_keys = get_time_keys(self.max_time, t_b_interval) if self.max_time is not None else []
+
+   @property
+   def name(self):
+      return f"{self.place}_{self.id}"
+
+   @property
+   def dir_path(self):
+      return f"dataset/{self.place}_{self.id}"
+
+   @property
+   def label_path(self):
+      return f"{self.dir_path}/label.json"
+
+   @property
+   def info_path(self):
+      return f"{self.dir_path}/info.json"
+
+   @property
+   def instruction(self):
+      return self.info['instruction']
+
+   @property
+   def path_length(self):
+      return self.info.get("length")
+
+   def frame_path(self, time_key):
+      return f"{self.dir_path}/frames/frame_{time_key}.jpg"
+
+   def missing_frames(self):
+      # time steps of the decision loop without a camera frame
+      frame_keys = set(self.frame_keys)
+      return [time_key for time_key in self.time_keys if time_key not in frame_keys]
+
+   def check(self):
+      return check_label_format(self.labels)
+
+   @classmethod
+   def load(cls, place, id):
+      dir_path = f"dataset/{place}_{id}"
+      with open(f"{dir_path}/label.json", "r") as f:
+         labels = json.load(f)
+      with open(f"{dir_path}/info.json", "r") as f:
+         info = json.load(f)
+      frames_dir = f"{dir_path}/frames"
+      frame_keys = []
+      if os.path.isdir(frames_dir):
+         frame_keys = [
+            name[len("frame_"):-len(".jpg")] for name in os.listdir(frames_dir)
+            if name.startswith("frame_") and name.endswith(".jpg")
+         ]
+      return cls(place, id, labels, info, frame_keys)
+
+
+def load_episode(place, id):
+   dir_path = f"dataset/{place}_{id}"
+   stamp = tuple(os.stat(f"{dir_path}/{name}").st_mtime_ns for name in ["label.json", "info.json"])
+   cached = _episodes.get((place, id))
+   if cached is not None and cached[0] == stamp:
+      return cached[1]
+   episode = Episode.load(place, id)
+   _episodes[(place, id)] = (stamp, episode)
+   return episode
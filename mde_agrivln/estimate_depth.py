@@ -0,0 +1,213 @@
+# MDE-AgriVLN - The Depth Estimation Module
+#
+# Runs the monocular depth estimator in-process on CPU, so a new episode needs
+# no separate pass with the estimater's own repository. The camera frames of
+# the decision loop are read in batches, estimated by a small metric
+# Depth Anything V2 checkpoint from transformers and written to
+#    {estimater}/output/{place}_{id}/frame_{t}.npz
+# which read_depth consumes as usual. The estimater has its own name
+# (depth_anything_v2_small), so it never mixes with the externally produced
+# depth_anything_v2, and the checkpoint is recorded in estimate_depth.json of
+# each output directory: depth of another checkpoint is never added to.
+# Frames that already have depth, as npz or in the packed store, are skipped.
+# The next batch is decoded on a worker thread while the current one is
+# estimated.
+#
+# Example:
+#    python -m mde_agrivln.estimate_depth -p farm -i 1 20
+#    python -m mde_agrivln.estimate_depth -p farm -i 1 20 -b 8 --threads 16 --pack float16
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from mde_agrivln.depth_store import STORE_DTYPES, get_depth_dir, list_depth_times, open_episode_store, pack_episode
+from mde_agrivln.episode import load_episode
+
+
+# estimaters run in-process, with their transformers checkpoint small enough for CPU
+CHECKPOINTS = {
+   'depth_anything_v2_small': 'depth-anything/Depth-Anything-V2-Metric-Outdoor-Small-hf'
+}
+
+RECORD_NAME = "estimate_depth.json"
+
+
+class DepthEstimator:
+
+   def __init__(self, checkpoint, threads=None):
+      try:
+         import torch
+         from transformers import AutoImageProcessor, AutoModelForDepthEstimation
+      except ImportError:
+         print('[ERROR] Depth estimation needs torch and transformers, see requirements.txt.')
+         sys.exit(1)
+      if threads is not None:
+         torch.set_num_threads(threads)
+      self.torch = torch
+      self.checkpoint = checkpoint
+      self.processor = AutoImageProcessor.from_pretrained(checkpoint)
+      self.model = AutoModelForDepthEstimation.from_pretrained(checkpoint).eval()
+      print(f'[INFO] Depth estimator: {checkpoint} on CPU with {torch.get_num_threads()} threads')
+
+   def estimate(self, images):
+      # metric depth of each image at its own size, float32
+      inputs = self.processor(images=images, return_tensors="pt")
+      with self.torch.inference_mode():
+         outputs = self.model(**inputs)
+      results = self.processor.post_process_depth_estimation(outputs, target_sizes=[(image.height, image.width) for image in images])
+      return [result["predicted_depth"].float().numpy() for result in results]
+
+
+def load_images(paths):
+   images = []
+   for path in paths:
+      with Image.open(path) as image:
+         images.append(image.convert('RGB'))
+   return images
+
+
+def save_npz_depth(npz_path, depth):
+   # write to a temporary file first, a cut off run leaves no broken frame behind
+   with open(npz_path + ".tmp", "wb") as f:
+      np.savez(f, depth=depth)
+   os.replace(npz_path + ".tmp", npz_path)
+
+
+def load_record(depth_dir):
+   # the checkpoint the depth of an output directory comes from, None if unknown
+   try:
+      with open(os.path.join(depth_dir, RECORD_NAME), "r") as f:
+         return json.load(f)["checkpoint"]
+   except (FileNotFoundError, json.JSONDecodeError, KeyError):
+      return None
+
+
+def save_record(depth_dir, checkpoint):
+   with open(os.path.join(depth_dir, RECORD_NAME), "w") as f:
+      json.dump({"checkpoint": checkpoint}, f, indent=3)
+
+
+def unpack_missing(place, id, estimater, store):
+   # frames only kept in the store, written back so pack_episode finds them again
+   depth_dir = get_depth_dir(place, id, estimater)
+   for time_key in store.time_keys:
+      npz_path = f"{depth_dir}/frame_{time_key}.npz"
+      if not os.path.isfile(npz_path):
+         save_npz_depth(npz_path, np.asarray(store.get(time_key)))
+
+
+def get_todo_times(place, id, estimater, episode):
+   # time steps of the decision loop with a camera frame but without depth
+   depth_dir = get_depth_dir(place, id, estimater)
+   store = open_episode_store(place, id, estimater)
+   missing_frames = set(episode.missing_frames())
+   return [
+      time_key for time_key in episode.time_keys
+      if time_key not in missing_frames
+      and not (store is not None and time_key in store)
+      and not os.path.isfile(f"{depth_dir}/frame_{time_key}.npz")
+   ]
+
+
+def estimate_episode(estimator, place, id, estimater, batch_size=4, pack=None):
+   # returns the number of estimated frames, None when the episode cannot be loaded
+   try:
+      episode = load_episode(place, id)
+   except (FileNotFoundError, KeyError, ValueError) as e:
+      print(f'[ERROR] {place}_{id} cannot be loaded: {e!r}')
+      return None
+   depth_dir = get_depth_dir(place, id, estimater)
+   store = open_episode_store(place, id, estimater)
+   has_depth = store is not None or len(list_depth_times(place, id, estimater)) > 0
+   recorded = load_record(depth_dir)
+   if has_depth and recorded != estimator.checkpoint:
+      print(f'[ERROR] {depth_dir} holds depth of {recorded or "an unknown model"}, not of {estimator.checkpoint}.')
+      return None
+   todo = get_todo_times(place, id, estimater, episode)
+   print(f'[INFO] {place}_{id}: {len(episode.time_keys)} time steps, {len(todo)} to estimate.')
+   if len(todo) == 0:
+      if pack is not None and store is None and has_depth:
+         if pack_episode(place, id, estimater, pack) == False:
+            return None
+      return 0
+   os.makedirs(depth_dir, exist_ok=True)
+   save_record(depth_dir, estimator.checkpoint)
+
+   batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+   start = time.perf_counter()
+   with ThreadPoolExecutor(max_workers=1) as loader:
+      next_images = loader.submit(load_images, [episode.frame_path(t) for t in batches[0]])
+      for i, batch in enumerate(batches):
+         images = next_images.result()
+         if i + 1 < len(batches):
+            next_images = loader.submit(load_images, [episode.frame_path(t) for t in batches[i + 1]])
+         for time_key, depth in zip(batch, estimator.estimate(images)):
+            save_npz_depth(f"{depth_dir}/frame_{time_key}.npz", depth)
+   elapsed = time.perf_counter() - start
+   print(f'[INFO] {place}_{id}: {len(todo)} frames in {elapsed:.1f} s ({len(todo) / elapsed:.2f} frames/s).')
+
+   # an existing store does not have the new frames, it is packed again in its own dtype;
+   # pack_episode reads the npz files, so the frames only in the store are written out first
+   if pack is not None or store is not None:
+      if store is not None:
+         unpack_missing(place, id, estimater, store)
+      if pack_episode(place, id, estimater, pack or store.dtype) == False:
+         return None
+   return len(todo)
+
+
+if __name__ == '__main__':
+
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-p", "--place", type=str, required=True, help="Place")
+   parser.add_argument("-i", "--id_range", type=int, nargs='+', required=True, help="ID range")
+   parser.add_argument("-e", "--estimater", type=str, required=False, default='depth_anything_v2_small', help="Monocular depth estimation model run in-process")
+   parser.add_argument("--checkpoint", type=str, required=False, help="Transformers checkpoint instead of the estimater's default")
+   parser.add_argument("-b", "--batch_size", type=int, required=False, default=4, help="Frames estimated at once")
+   parser.add_argument("--threads", type=int, required=False, help="Number of CPU threads of torch")
+   parser.add_argument("--pack", type=str, required=False, help="Pack every estimated episode into the depth store: float32, float16 or uint16")
+   args = parser.parse_args()
+
+   if len(args.id_range) == 2:
+      id_range = list(range(args.id_range[0], args.id_range[1] + 1))
+   else:
+      id_range = args.id_range
+
+   # depth_pro and the others are produced externally, their output is never written here
+   if args.estimater not in CHECKPOINTS:
+      print(f'[ERROR] {args.estimater} cannot be run in-process, choose from {list(CHECKPOINTS)}.')
+      sys.exit(1)
+
+   if args.batch_size < 1:
+      print('[ERROR] Invalid batch size.')
+      sys.exit(1)
+
+   if args.threads is not None and args.threads < 1:
+      print('[ERROR] Invalid threads.')
+      sys.exit(1)
+
+   if args.pack is not None and args.pack not in STORE_DTYPES:
+      print('[ERROR] Invalid pack dtype.')
+      sys.exit(1)
+
+   estimator = DepthEstimator(args.checkpoint or CHECKPOINTS[args.estimater], args.threads)
+   failed = 0
+   estimated = 0
+   start = time.perf_counter()
+   for id in id_range:
+      count = estimate_episode(estimator, args.place, id, args.estimater, args.batch_size, args.pack)
+      if count is None:
+         failed += 1
+      else:
+         estimated += count
+   elapsed = time.perf_counter() - start
+   print(f'[INFO] {estimated} frames estimated in {elapsed:.1f} s.')
+   if failed > 0:
+      sys.exit(1)
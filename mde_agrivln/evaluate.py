@@ -2,10 +2,13 @@
 
 import json
 import os
-import time
+import numpy as np
 
-from mde_agrivln.for_json import get_stop_start_time
+from mde_agrivln.episode import load_episode
 from mde_agrivln.hyperparameter import get_hyperparameter
+from mde_agrivln.journal import export_episode
+from mde_agrivln.subtask_state import SnapshotIndex
+from mde_agrivln.tracing import span
 
 
 def time_str_to_float(time_str):
@@ -13,21 +16,30 @@ def time_str_to_float(time_str):
    return int(minutes) + int(tenths) / 10
 
 
-def judge_predictions(predict_path, label_path):
+def match_labels(pred_times, labels):
+   # index of the first label whose [start, end) holds each time, -1 if none
+   starts = np.array([label["time_range"][0] for label in labels], dtype=np.float64)
+   ends = np.array([label["time_range"][1] for label in labels], dtype=np.float64)
+   pred_times = np.asarray(pred_times, dtype=np.float64)
+   if len(labels) == 0:
+      return np.full(len(pred_times), -1)
+   if np.all(ends >= starts) and np.all(starts[1:] >= ends[:-1]):
+      # ordered, non-overlapping labels: the last label starting at or before t
+      idx = np.searchsorted(starts, pred_times, side='right') - 1
+      hit = (idx >= 0) & (pred_times < ends[np.maximum(idx, 0)])
+      return np.where(hit, idx, -1)
+   # overlapping labels: first match in label order, as a full comparison matrix
+   inside = (starts[None, :] <= pred_times[:, None]) & (pred_times[:, None] < ends[None, :])
+   return np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+
+
+def judge_predictions(predict_path, labels):
    with open(predict_path, 'r') as f:
       predictions = json.load(f)
-   with open(label_path, 'r') as f:
-      labels = json.load(f)
-   for pred in predictions:
-      pred_time = time_str_to_float(pred["time"])
+   match_idxs = match_labels([time_str_to_float(pred["time"]) for pred in predictions], labels)
+   for pred, match_idx in zip(predictions, match_idxs.tolist()):
       pred_action = pred["action"]
-      match_idx = None
-      for i, label in enumerate(labels):
-         start, end = label["time_range"]
-         if start <= pred_time < end:
-            match_idx = i
-            break
-      if match_idx is not None:
+      if match_idx >= 0:
          label_action = labels[match_idx]["action"]
          if label_action == "[WAIT]":
             prev_action = labels[match_idx - 1]["action"] if match_idx > 0 else None
@@ -97,23 +109,55 @@ def calculate_relative_NE(label_list, stop_t, label_stop_t, speed, path_length=-
 def calculate_ISR(STL_state_list, stop_t, STL_path):
    with open(STL_path, "r", encoding="utf-8") as f:
       total = len(json.load(f))
-   def time_str_to_float(time_str):
-      minutes, tenths = time_str.split("'")
-      return int(minutes) + int(tenths) / 10
-   latest_subtask_list = None
-   max_time = -1.0
-   for entry in STL_state_list:
-      t = time_str_to_float(entry["time"])
-      if t <= stop_t and t > max_time:
-         max_time = t
-         latest_subtask_list = entry["subtask_list"]
-   if latest_subtask_list is None:
+   snapshot = SnapshotIndex(STL_state_list).at(stop_t)
+   if snapshot is None:
       print('[ERROR] The latest subtask list is none.')
       return (0, total)
+   latest_subtask_list = snapshot["subtask_list"]
    done_count = sum(1 for s in latest_subtask_list if s["state"] == "done")
    return (done_count, total)
 
 
+def scan_results(results, stop_start_time, interval, threshold, accuracy_threshold):
+   # every tick t from threshold / 2 to the label stop time, checking in order:
+   #    a [STOP] predicted at t -> valid_stop at t
+   #    accuracy of the judges in [t - threshold, t] below the threshold -> deviation
+   ticks = []
+   t = threshold / 2
+   while t <= stop_start_time:
+      ticks.append(t)
+      t = round(t + interval, 1)
+   if len(ticks) == 0:
+      return -1.0, 'no_stop'
+
+   tick_ends = np.array([round(t, 1) for t in ticks])
+   tick_starts = np.array([round(max(0.0, t - threshold), 1) for t in ticks])
+
+   stop_times = [item["time"] for item in results if item["action"] == "[STOP]"]
+   is_stop = np.isin(tick_ends, stop_times)
+
+   # windowed accuracy from prefix sums over the results sorted by time
+   times = np.array([item["time"] for item in results], dtype=np.float64)
+   judges = np.array([item["judge"] == "True" for item in results], dtype=np.int64)
+   order = np.argsort(times, kind='stable')
+   times = times[order]
+   true_prefix = np.concatenate([[0], np.cumsum(judges[order])])
+   left = np.searchsorted(times, tick_starts, side='left')
+   right = np.searchsorted(times, tick_ends, side='right')
+   count = right - left
+   true_count = true_prefix[right] - true_prefix[left]
+   accuracy = np.divide(true_count, count, out=np.ones(len(ticks)), where=count > 0)
+   is_deviation = (count > 0) & (accuracy < accuracy_threshold)
+
+   events = np.flatnonzero(is_stop | is_deviation)
+   if len(events) == 0:
+      return -1.0, 'no_stop'
+   first = events[0]
+   if is_stop[first]:
+      return ticks[first], 'valid_stop'
+   return round(ticks[first] - threshold * 0.5, 1), 'deviation'
+
+
 def json_evaluate(save_path, exp, place, id, SR, NE, ISR, stop_t, type, path_length, label_stop_time):
    data = {
       "exp": exp,
@@ -127,74 +171,53 @@ def json_evaluate(save_path, exp, place, id, SR, NE, ISR, stop_t, type, path_len
       "label_stop_time": label_stop_time
    }
    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-   with open(save_path, 'w') as f:
+   # a complete evaluate.json marks a finished episode (see checkpoint.py)
+   with open(save_path + ".tmp", 'w') as f:
       json.dump(data, f, indent=3)
+   os.replace(save_path + ".tmp", save_path)
    print(f"[INFO] Evaluation result is saved to: {save_path}")
 
 
-def evaluate(exp, place, id):
+def evaluate(exp, place, id, episode=None):
 
    interval = get_hyperparameter('interval')
-   stop_t = -1.0
    threshold = get_hyperparameter('threshold')
    speed = get_hyperparameter('speed')
    SR_threshold = get_hyperparameter('SR_threshold')
    accuracy_threshold = get_hyperparameter('accuracy_threshold')
 
-   t = threshold / 2
-
    # path
    predict_path = f"runs/{exp}/{place}_{id}/predict.json"
-   label_path = f"dataset/{place}_{id}/label.json"
    STL_path = f"runs/{exp}/{place}_{id}/STL.json"
    log_path = f"runs/{exp}/{place}_{id}/log.json"
-   info_path = f"dataset/{place}_{id}/info.json"
    evaluate_path = f"runs/{exp}/{place}_{id}/evaluate.json"
 
-   # judge first
-   judge_predictions(predict_path, label_path)
-   time.sleep(0.1)
+   # the journals are the source of truth, also after an interrupted run
+   with span('evaluate.export'):
+      export_episode(f"runs/{exp}/{place}_{id}")
 
-   results = load_judged_results(predict_path)
-   results = convert_time_to_float(results)
+   # labels and path length
+   if episode is None:
+      episode = load_episode(place, id)
+   labels = episode.labels
 
-   with open(label_path, "r") as f:
-      labels = json.load(f)
-
-   stop_start_time = get_stop_start_time(labels)
-   print(f'Label stop time: {stop_start_time}')
-
-   type = 'no_stop'
-
-   while t <= stop_start_time:
-
-      if any(item["time"] == round(t, 1) and item["action"] == "[STOP]" for item in results):
-         stop_t = t
-         type = 'valid_stop'
-         break
-
-      start_check = round(max(0.0, t - threshold), 1)
-      recent_judges = [
-         item for item in results
-         if start_check <= item["time"] <= round(t, 1)
-      ]
+   # judge first
+   with span('evaluate.judge'):
+      judge_predictions(predict_path, labels)
 
-      if len(recent_judges) > 0:
-         true_count = sum(1 for item in recent_judges if item["judge"] == "True")
-         accuracy = true_count / len(recent_judges)
+      results = load_judged_results(predict_path)
+      results = convert_time_to_float(results)
 
-         if accuracy < accuracy_threshold:
-            stop_t = round(t - threshold * 0.5, 1)
-            type = 'deviation'
-            break
+   stop_start_time = episode.stop_start_time
+   print(f'Label stop time: {stop_start_time}')
 
-      t = round(t + interval, 1)
+   with span('evaluate.scan'):
+      stop_t, type = scan_results(results, stop_start_time, interval, threshold, accuracy_threshold)
 
    print(f'Predicted stop time: {stop_t}')
    print(f'Type: {type}')
 
-   with open(info_path, 'r') as f:
-      path_length = json.load(f).get("length")
+   path_length = episode.path_length
 
    if type == 'no_stop':
       SR = 0
@@ -202,8 +225,7 @@ def evaluate(exp, place, id):
       RNE = 0
       stop_t = stop_start_time
    if type == 'valid_stop' or type == 'deviation':
-      label_list = json.load(open(label_path))
-      RNE, NE = calculate_relative_NE(label_list, stop_t, stop_start_time, speed, path_length)
+      RNE, NE = calculate_relative_NE(labels, stop_t, stop_start_time, speed, path_length)
       if NE < SR_threshold:
          SR = 1
       else:
@@ -214,10 +236,11 @@ def evaluate(exp, place, id):
    print(f'RNE: {round(RNE, 3)}')
    print(f'NE: {NE}')
 
-   with open(log_path, "r") as f:
-      STL_state_list = json.load(f)
+   with span('evaluate.ISR'):
+      with open(log_path, "r") as f:
+         STL_state_list = json.load(f)
 
-   done, total = calculate_ISR(STL_state_list, stop_t, STL_path)
+      done, total = calculate_ISR(STL_state_list, stop_t, STL_path)
    if type == 'no_stop':
       done = total - 1
    elif SR == 1:
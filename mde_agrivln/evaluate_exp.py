@@ -0,0 +1,256 @@
+# MDE-AgriVLN - The Experiment Evaluation Module
+#
+# Evaluates every episode of runs/{exp} in a process pool and aggregates SR,
+# NE and ISR per place and overall into runs/{exp}/summary.json. An episode
+# is skipped when its inputs (predict, log, STL, label and info) and the
+# evaluation hyperparameters are the same as at its last evaluation, as
+# recorded in runs/{exp}/evaluate_index.json.
+#
+# Example:
+#    python -m mde_agrivln.evaluate_exp -x MDE-AgriVLN-matrix-depth_pro
+#    python -m mde_agrivln.evaluate_exp -x MDE-AgriVLN-matrix-depth_pro -p farm --force
+#
+# With --baseline, each experiment is also compared with the baseline on the
+# episodes both have: the change of SR, NE and ISR, and the share of steps
+# that reused the previous decision instead of calling the VLM (step_gate.py).
+#    python -m mde_agrivln.evaluate_exp -x MDE-AgriVLN-matrix-depth_pro-gate0.03-0.05-4 --baseline MDE-AgriVLN-matrix-depth_pro
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from mde_agrivln.evaluate import evaluate
+from mde_agrivln.hyperparameter import get_hyperparameter
+
+
+# bump when the metrics change, every episode is then evaluated again
+EVALUATE_VERSION = 1
+
+EVALUATE_HYPERPARAMETERS = ['interval', 'threshold', 'speed', 'SR_threshold', 'accuracy_threshold']
+
+INDEX_NAME = "evaluate_index.json"
+SUMMARY_NAME = "summary.json"
+
+
+def list_episodes(exp, place=None, id_range=None):
+   episodes = []
+   for name in sorted(os.listdir(f"runs/{exp}")):
+      match = re.fullmatch(r"(.+)_(\d+)", name)
+      if match is None or not os.path.isdir(f"runs/{exp}/{name}"):
+         continue
+      episode_place, episode_id = match.group(1), int(match.group(2))
+      if place is not None and episode_place != place:
+         continue
+      if id_range is not None and episode_id not in id_range:
+         continue
+      if not any(os.path.exists(f"runs/{exp}/{name}/predict{ext}") for ext in [".jsonl", ".json"]):
+         continue
+      episodes.append((episode_place, episode_id))
+   episodes.sort(key=lambda episode: (episode[0], episode[1]))
+   return episodes
+
+
+def get_input_paths(exp, place, id):
+   dir_path = f"runs/{exp}/{place}_{id}"
+   paths = []
+   # the journals are the source of truth when they exist
+   for name in ["predict", "log"]:
+      journal_path = os.path.join(dir_path, f"{name}.jsonl")
+      paths.append(journal_path if os.path.exists(journal_path) else os.path.join(dir_path, f"{name}.json"))
+   paths.append(os.path.join(dir_path, "STL.json"))
+   paths.append(f"dataset/{place}_{id}/label.json")
+   paths.append(f"dataset/{place}_{id}/info.json")
+   return paths
+
+
+def get_fingerprint(exp, place, id):
+   digest = hashlib.sha1()
+   settings = [EVALUATE_VERSION] + [get_hyperparameter(name) for name in EVALUATE_HYPERPARAMETERS]
+   digest.update(json.dumps(settings).encode())
+   for path in get_input_paths(exp, place, id):
+      digest.update(path.encode())
+      try:
+         with open(path, "rb") as f:
+            digest.update(hashlib.sha1(f.read()).digest())
+      except FileNotFoundError:
+         digest.update(b"missing")
+   return digest.hexdigest()
+
+
+def load_index(exp):
+   try:
+      with open(f"runs/{exp}/{INDEX_NAME}", "r") as f:
+         return json.load(f)
+   except (FileNotFoundError, json.JSONDecodeError):
+      return {}
+
+
+def save_index(exp, index):
+   index_path = f"runs/{exp}/{INDEX_NAME}"
+   with open(index_path + ".tmp", "w") as f:
+      json.dump(index, f, indent=3, sort_keys=True)
+   os.replace(index_path + ".tmp", index_path)
+
+
+def evaluate_quietly(exp, place, id):
+   # runs in a worker process, the per-episode prints would interleave
+   try:
+      with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+         evaluate(exp, place, id)
+   except Exception as e:
+      return place, id, None, repr(e)
+   # fingerprint after evaluating: evaluate rewrites predict.json and log.json from their journals
+   return place, id, get_fingerprint(exp, place, id), None
+
+
+def evaluate_experiment(exp, place=None, id_range=None, workers=None, force=False):
+   episodes = list_episodes(exp, place, id_range)
+   index = load_index(exp)
+
+   todo = [
+      (episode_place, episode_id) for episode_place, episode_id in episodes
+      if force or index.get(f"{episode_place}_{episode_id}") != get_fingerprint(exp, episode_place, episode_id)
+      or not os.path.exists(f"runs/{exp}/{episode_place}_{episode_id}/evaluate.json")
+   ]
+   print(f'[INFO] {exp}: {len(episodes)} episodes, {len(todo)} to evaluate, {len(episodes) - len(todo)} up to date.')
+
+   failed = []
+   if todo:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         futures = [executor.submit(evaluate_quietly, exp, episode_place, episode_id) for episode_place, episode_id in todo]
+         for future in futures:
+            episode_place, episode_id, fingerprint, error = future.result()
+            if error is not None:
+               print(f'[ERROR] {episode_place}_{episode_id} fails to evaluate: {error}')
+               index.pop(f"{episode_place}_{episode_id}", None)
+               failed.append((episode_place, episode_id))
+            else:
+               index[f"{episode_place}_{episode_id}"] = fingerprint
+      save_index(exp, index)
+
+   return summarize_experiment(exp, [episode for episode in episodes if episode not in failed])
+
+
+def get_summary(exp, episodes):
+   groups = {}
+   for episode_place, episode_id in episodes:
+      with open(f"runs/{exp}/{episode_place}_{episode_id}/evaluate.json", "r") as f:
+         result = json.load(f)
+      done, total = result["ISR"]
+      row = (result["SR"], result["NE"], done / total if total > 0 else 0.0)
+      groups.setdefault(episode_place, []).append(row)
+      groups.setdefault("overall", []).append(row)
+
+   summary = {}
+   for name, rows in groups.items():
+      summary[name] = {
+         "episodes": len(rows),
+         "SR": round(sum(row[0] for row in rows) / len(rows), 4),
+         "NE": round(sum(row[1] for row in rows) / len(rows), 4),
+         "ISR": round(sum(row[2] for row in rows) / len(rows), 4)
+      }
+   if "overall" in summary:
+      summary["overall"] = summary.pop("overall")
+   return summary
+
+
+def summarize_experiment(exp, episodes):
+   summary = get_summary(exp, episodes)
+   with open(f"runs/{exp}/{SUMMARY_NAME}", "w") as f:
+      json.dump(summary, f, indent=3)
+   return summary
+
+
+def count_reused(exp, place, id):
+   # (steps, steps reused without a VLM call) of an evaluated episode
+   with open(f"runs/{exp}/{place}_{id}/predict.json", "r") as f:
+      predictions = json.load(f)
+   return len(predictions), sum(1 for pred in predictions if "reused" in pred)
+
+
+def compare_experiments(exp, baseline, place=None, id_range=None):
+   shared = [
+      episode for episode in list_episodes(exp, place, id_range)
+      if episode in list_episodes(baseline, place, id_range)
+      and os.path.exists(f"runs/{exp}/{episode[0]}_{episode[1]}/evaluate.json")
+      and os.path.exists(f"runs/{baseline}/{episode[0]}_{episode[1]}/evaluate.json")
+   ]
+   if not shared:
+      return {}
+   summary = get_summary(exp, shared)
+   baseline_summary = get_summary(baseline, shared)
+
+   steps = {}
+   for episode_place, episode_id in shared:
+      counts = count_reused(exp, episode_place, episode_id)
+      for name in [episode_place, "overall"]:
+         total, reused = steps.get(name, (0, 0))
+         steps[name] = (total + counts[0], reused + counts[1])
+
+   comparison = {}
+   for name, row in summary.items():
+      total, reused = steps[name]
+      comparison[name] = {
+         "episodes": row["episodes"],
+         "steps": total,
+         "reused": reused,
+         "SR_delta": round(row["SR"] - baseline_summary[name]["SR"], 4),
+         "NE_delta": round(row["NE"] - baseline_summary[name]["NE"], 4),
+         "ISR_delta": round(row["ISR"] - baseline_summary[name]["ISR"], 4)
+      }
+   return comparison
+
+
+def print_comparison(exp, baseline, comparison):
+   print(f'[INFO] {exp} against {baseline}')
+   print(f'{"place":<12}{"episodes":>10}{"steps":>8}{"reused":>8}{"dSR":>9}{"dNE":>9}{"dISR":>9}')
+   for name, row in comparison.items():
+      print(
+         f'{name:<12}{row["episodes"]:>10}{row["steps"]:>8}{row["reused"]:>8}'
+         f'{row["SR_delta"]:>+9.3f}{row["NE_delta"]:>+9.3f}{row["ISR_delta"]:>+9.3f}'
+      )
+
+
+def print_summary(exp, summary):
+   print(f'[INFO] {exp}')
+   print(f'{"place":<12}{"episodes":>10}{"SR":>9}{"NE":>9}{"ISR":>9}')
+   for name, row in summary.items():
+      print(f'{name:<12}{row["episodes"]:>10}{row["SR"]:>9.3f}{row["NE"]:>9.3f}{row["ISR"]:>9.3f}')
+
+
+if __name__ == '__main__':
+
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-x", "--exp", type=str, nargs='+', required=True, help="Experiment names under runs/")
+   parser.add_argument("-p", "--place", type=str, required=False, help="Only this place")
+   parser.add_argument("-i", "--id_range", type=int, nargs='+', required=False, help="Only this ID range")
+   parser.add_argument("-j", "--workers", type=int, required=False, help="Number of evaluation processes")
+   parser.add_argument("--force", action='store_true', help="Evaluate every episode, also the unchanged ones")
+   parser.add_argument("--baseline", type=str, required=False, help="Experiment to compare SR, NE and ISR with")
+   args = parser.parse_args()
+
+   id_range = args.id_range
+   if id_range is not None and len(id_range) == 2:
+      id_range = list(range(id_range[0], id_range[1] + 1))
+
+   for exp in [*args.exp, args.baseline]:
+      if exp is not None and not os.path.isdir(f"runs/{exp}"):
+         print(f'[ERROR] runs/{exp} does not exist.')
+         sys.exit(1)
+
+   if args.baseline is not None:
+      evaluate_experiment(args.baseline, args.place, id_range, args.workers, args.force)
+   for exp in args.exp:
+      summary = evaluate_experiment(exp, args.place, id_range, args.workers, args.force)
+      print_summary(exp, summary)
+      if args.baseline is not None:
+         comparison = compare_experiments(exp, args.baseline, args.place, id_range)
+         if not comparison:
+            print(f'[WARNING] {exp} and {args.baseline} have no evaluated episode in common.')
+         else:
+            print_comparison(exp, args.baseline, comparison)
@@ -1,7 +1,8 @@
 # MDE-AgriVLN - The Assistant Functions for JSON
 
 import json
-import os
+
+from mde_agrivln.journal import append_record
 
 
 def save_subtasks_to_file(subtask_list, filename="subtasks.json"):
@@ -23,21 +24,22 @@ def load_subtasks_from_file(filename="subtasks.json"):
       return []
 
 
-def append_action(action_file, time_value, action_value, thought, state):
-   if os.path.exists(action_file):
-      with open(action_file, 'r') as f:
-         data = json.load(f)
-   else:
-      data = []
-   data.append({
+def append_action(action_file, time_value, action_value, thought, state, writer=None, reused=None):
+   # action_file is the predict.jsonl journal, one record per line
+   record = {
       "time": time_value,
       "action": action_value,
       "thought": thought,
       "state": state,
       "judge": 'null'
-   })
-   with open(action_file, 'w') as f:
-      json.dump(data, f, indent=3)
+   }
+   # the time step whose decision was reused without a VLM call (see step_gate.py)
+   if reused is not None:
+      record["reused"] = reused
+   if writer is not None:
+      writer.append(action_file, record)
+   else:
+      append_record(action_file, record)
 
 
 def get_stop_start_time(label_list):
@@ -47,15 +49,25 @@ def get_stop_start_time(label_list):
    return None
 
 
-def clean_format_stl_state(filepath="STL_state.json"):
-   with open(filepath, "r", encoding="utf-8") as f:
-      data = json.load(f)
-   with open(filepath, "w", encoding="utf-8") as f:
-      f.write("[\n")
-      for i, entry in enumerate(data):
-         f.write("  {\n")
-         f.write(f"    \"time\": \"{entry['time']}\",\n")
-         subtask_str = json.dumps(entry['subtask_list'], separators=(",", ": "))
-         f.write(f"    \"subtask_list\": {subtask_str}\n")
-         f.write("  }" + (",\n" if i < len(data) - 1 else "\n"))
-      f.write("]\n")
+def time_str_to_float(time_str):
+   minutes, tenths = time_str.split("'")
+   return int(minutes) + int(tenths) / 10
+
+
+def get_max_time(stop_start_time, FPS=5.0, safe_redundancy=2):
+   # the decision loop runs a few frames past the labelled STOP
+   return float(stop_start_time) + (1 / FPS) * safe_redundancy
+
+
+def get_time_keys(max_time, t_b_interval=2):
+   # all time steps "t_a't_b" visited by the decision loop before max_time
+   time_keys = []
+   t_a = 0
+   t_b = 0
+   while float(t_a) + float(t_b) / 10.0 < max_time:
+      time_keys.append(f"{t_a}'{t_b}")
+      t_b += t_b_interval
+      if t_b == 10:
+         t_b = 0
+         t_a += 1
+   return time_keys
@@ -7,7 +7,8 @@ def get_hyperparameter(name):
       "threshold": 4.0,  # time range
       "speed": 1.3,
       "SR_threshold": 2.0,
-      "accuracy_threshold": 0.5
+      "accuracy_threshold": 0.5,
+      "cmap": 'turbo_r'  # depth map colormap, option: Spectral, viridis, turbo_r
    }
 
    return hyperparameter_dic[name]
@@ -0,0 +1,103 @@
+# MDE-AgriVLN - The Image Payload Cache Module
+#
+# Keeps the base64 payload of every image sent to the VLM, keyed by the file
+# path, modification time and size, so a camera frame or depth map is read
+# and encoded once instead of on every request. The in-memory tier is an LRU
+# bounded in bytes. With a cache directory, payloads are also written to disk
+# and shared by every process using the same directory, e.g. a sweep over
+# representations and estimaters on the same dataset.
+
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+class ImageCache:
+
+   def __init__(self, max_bytes=256 * 1024 ** 2, cache_dir=None):
+      self.max_bytes = max_bytes
+      self.cache_dir = cache_dir
+      self.entries = OrderedDict()
+      self.size = 0
+      self.hits = 0
+      self.misses = 0
+      self.lock = threading.Lock()
+      if cache_dir is not None:
+         os.makedirs(cache_dir, exist_ok=True)
+
+   def get(self, path):
+      stat = os.stat(path)
+      key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+      with self.lock:
+         payload = self.entries.get(key)
+         if payload is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+      payload = self._load_shared(key)
+      if payload is None:
+         with open(path, "rb") as f:
+            payload = base64.b64encode(f.read()).decode()
+         self._save_shared(key, payload)
+         with self.lock:
+            self.misses += 1
+      else:
+         with self.lock:
+            self.hits += 1
+
+      self._put(key, payload)
+      return payload
+
+   def _put(self, key, payload):
+      with self.lock:
+         if key in self.entries:
+            return
+         self.entries[key] = payload
+         self.size += len(payload)
+         while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+   def _shared_path(self, key):
+      digest = hashlib.sha1(f"{key[0]}:{key[1]}:{key[2]}".encode()).hexdigest()
+      return os.path.join(self.cache_dir, digest[:2], f"{digest}.b64")
+
+   def _load_shared(self, key):
+      if self.cache_dir is None:
+         return None
+      try:
+         with open(self._shared_path(key), "r") as f:
+            return f.read()
+      except FileNotFoundError:
+         return None
+
+   def _save_shared(self, key, payload):
+      if self.cache_dir is None:
+         return
+      shared_path = self._shared_path(key)
+      os.makedirs(os.path.dirname(shared_path), exist_ok=True)
+      tmp_path = f"{shared_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+      with open(tmp_path, "w") as f:
+         f.write(payload)
+      os.replace(tmp_path, shared_path)
+
+
+_image_cache = ImageCache()
+
+
+def configure_image_cache(max_mb=256, cache_dir=None):
+   global _image_cache
+   _image_cache = ImageCache(int(max_mb * 1024 ** 2), cache_dir)
+   return _image_cache
+
+
+def get_image_payload(path):
+   return _image_cache.get(path)
+
+
+def get_image_cache():
+   return _image_cache
@@ -0,0 +1,131 @@
+# MDE-AgriVLN - The Journal Module
+#
+# predict, log and token records are appended as one JSON object per line
+# to predict.jsonl, log.jsonl and token.jsonl, so each step costs one short
+# write instead of rewriting the whole file. Each line is flushed and synced
+# before the call returns, so a killed run keeps every completed line.
+# export_episode() writes predict.json, log.json and token.json in their
+# usual layout for evaluate and other readers.
+
+import json
+import os
+import queue
+import sys
+import threading
+
+
+JOURNAL_NAMES = ['predict', 'log', 'token']
+
+
+def get_journal_path(json_path):
+   return os.path.splitext(json_path)[0] + ".jsonl"
+
+
+def append_record(journal_path, record):
+   line = json.dumps(record, ensure_ascii=False) + "\n"
+   with open(journal_path, "a+b") as f:
+      # a line cut off by a crash must not swallow the next record
+      if f.tell() > 0:
+         f.seek(-1, os.SEEK_END)
+         if f.read(1) != b"\n":
+            line = "\n" + line
+      f.write(line.encode("utf-8"))
+      f.flush()
+      os.fsync(f.fileno())
+
+
+class JournalWriter:
+   # appends records on a background thread, so the caller never waits on disk
+
+   def __init__(self):
+      self.queue = queue.Queue()
+      self.thread = threading.Thread(target=self._run, daemon=True)
+      self.thread.start()
+
+   def _run(self):
+      while True:
+         item = self.queue.get()
+         if item is None:
+            break
+         journal_path, record = item
+         try:
+            append_record(journal_path, record)
+         except OSError as e:
+            print(f'[ERROR] Fail to append to {journal_path}: {e}')
+
+   def append(self, journal_path, record):
+      self.queue.put((journal_path, record))
+
+   def close(self):
+      # returns once every queued record is on disk
+      self.queue.put(None)
+      self.thread.join()
+
+
+def reset_journal(journal_path, records=()):
+   tmp_path = journal_path + ".tmp"
+   with open(tmp_path, "w", encoding="utf-8") as f:
+      for record in records:
+         f.write(json.dumps(record, ensure_ascii=False) + "\n")
+      f.flush()
+      os.fsync(f.fileno())
+   os.replace(tmp_path, journal_path)
+
+
+def read_journal(journal_path):
+   records = []
+   if not os.path.exists(journal_path):
+      return records
+   with open(journal_path, "r", encoding="utf-8") as f:
+      for i, line in enumerate(f):
+         line = line.strip()
+         if not line:
+            continue
+         try:
+            records.append(json.loads(line))
+         except json.JSONDecodeError:
+            print(f'[WARNING] Skip unreadable line {i + 1} of {journal_path}.')
+   return records
+
+
+def write_stl_state(filepath, data):
+   with open(filepath, "w", encoding="utf-8") as f:
+      f.write("[\n")
+      for i, entry in enumerate(data):
+         f.write("  {\n")
+         f.write(f"    \"time\": \"{entry['time']}\",\n")
+         subtask_str = json.dumps(entry['subtask_list'], separators=(",", ": "))
+         f.write(f"    \"subtask_list\": {subtask_str}\n")
+         f.write("  }" + (",\n" if i < len(data) - 1 else "\n"))
+      f.write("]\n")
+
+
+def export_journal(journal_path, json_path, name):
+   records = read_journal(journal_path)
+   tmp_path = json_path + ".tmp"
+   if name == 'log':
+      write_stl_state(tmp_path, records)
+   else:
+      with open(tmp_path, "w") as f:
+         json.dump(records, f, indent=4 if name == 'token' else 3)
+   os.replace(tmp_path, json_path)
+   return len(records)
+
+
+def export_episode(dir_path):
+   # rewrite predict.json, log.json and token.json from their journals
+   for name in JOURNAL_NAMES:
+      journal_path = os.path.join(dir_path, f"{name}.jsonl")
+      if os.path.exists(journal_path):
+         export_journal(journal_path, os.path.join(dir_path, f"{name}.json"), name)
+
+
+if __name__ == '__main__':
+
+   # python -m mde_agrivln.journal runs/{exp}/{place}_{id} [...]
+   if len(sys.argv) < 2:
+      print('[ERROR] Give at least one episode directory.')
+      sys.exit(1)
+   for dir_path in sys.argv[1:]:
+      export_episode(dir_path)
+      print(f'[INFO] Journals exported in {dir_path}.')
@@ -0,0 +1,128 @@
+# MDE-AgriVLN - The Mock Server Module
+#
+# A local stand-in for the ollama HTTP API, answering /api/chat with the fake
+# backend. Point --host at it to measure the whole client path (HTTP, JSON,
+# image upload) and to run throughput tests on a machine without a GPU.
+# Requests are served on threads, so concurrent clients overlap like they
+# would with OLLAMA_NUM_PARALLEL.
+#
+# Example:
+#    python -m mde_agrivln.mock_server --port 11435 --latency lognormal:2.0,0.3
+#    python home_mde_agrivln.py -p farm -i 1 5 -r matrix -e depth_pro --host http://127.0.0.1:11435 -c 4
+
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mde_agrivln.backend import FakeBackend
+
+
+def make_handler(backend, models=(), fail_rate=0.0):
+
+   class MockHandler(BaseHTTPRequestHandler):
+
+      protocol_version = 'HTTP/1.1'
+
+      def log_message(self, format, *args):
+         pass
+
+      def send_json(self, data, status=200):
+         body = json.dumps(data).encode()
+         self.send_response(status)
+         self.send_header('Content-Type', 'application/json')
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+
+      def do_GET(self):
+         if self.path == '/api/version':
+            self.send_json({'version': 'mock'})
+         elif self.path in ['/api/tags', '/api/ps']:
+            self.send_json({'models': [{'name': model, 'model': model} for model in models]})
+         else:
+            self.send_json({'error': 'not found'}, 404)
+
+      def do_HEAD(self):
+         self.send_response(200)
+         self.send_header('Content-Length', '0')
+         self.end_headers()
+
+      def do_POST(self):
+         length = int(self.headers.get('Content-Length', 0))
+         request = json.loads(self.rfile.read(length) or b'{}')
+         if self.path == '/api/chat' and fail_rate > 0 and backend.rng.random() < fail_rate:
+            # a failing inference box, for testing the endpoint pool
+            self.send_json({'error': 'mock failure'}, 500)
+         elif self.path == '/api/chat':
+            self.chat(request)
+         elif self.path == '/api/generate':
+            # an empty prompt only loads the model
+            load = backend.preload(request.get('model'))
+            self.send_json({'model': request.get('model'), 'response': '', 'done': True, 'done_reason': 'load', 'load_duration': int(load * 1e9)})
+         else:
+            self.send_json({'error': 'not found'}, 404)
+
+      def chat(self, request):
+         latency, load = backend.sample_latency(request.get('model'))
+         response = backend.respond(request, latency, load).model_dump(exclude_none=True)
+         if request.get('stream', True) == False:
+            time.sleep(latency + load)
+            self.send_json(response)
+            return
+         # streamed as NDJSON, one word per chunk: the load and the prompt
+         # take a fifth of the latency, the words share the rest
+         time.sleep(load + latency * 0.2)
+         self.send_response(200)
+         self.send_header('Content-Type', 'application/x-ndjson')
+         self.send_header('Transfer-Encoding', 'chunked')
+         self.end_headers()
+         words = response['message']['content'].split(' ')
+         try:
+            for i, word in enumerate(words):
+               time.sleep(latency * 0.8 / len(words))
+               text = word if i == len(words) - 1 else word + ' '
+               self.write_chunk({'model': response['model'], 'message': {'role': 'assistant', 'content': text}, 'done': False})
+            final = dict(response, message={'role': 'assistant', 'content': ''})
+            self.write_chunk(final)
+            self.wfile.write(b'0\r\n\r\n')
+         except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, like ollama we stop generating
+            self.close_connection = True
+
+      def write_chunk(self, data):
+         line = json.dumps(data).encode() + b'\n'
+         self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+
+   return MockHandler
+
+
+def serve(host='127.0.0.1', port=11435, backend=None, models=(), fail_rate=0.0):
+   if backend is None:
+      backend = FakeBackend()
+   server = ThreadingHTTPServer((host, port), make_handler(backend, models, fail_rate))
+   server.daemon_threads = True
+   return server
+
+
+if __name__ == '__main__':
+
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--bind", type=str, required=False, default='127.0.0.1', help="Address to listen on")
+   parser.add_argument("--port", type=int, required=False, default=11435, help="Port to listen on")
+   parser.add_argument("--latency", type=str, required=False, default='0', help="Latency distribution in seconds")
+   parser.add_argument("--completion_tokens", type=str, required=False, default='normal:150,40', help="Completion token distribution")
+   parser.add_argument("--load_time", type=float, required=False, default=0.0, help="Seconds to load a model on its first call")
+   parser.add_argument("--tail_words", type=int, required=False, default=0, help="Words after the last tag of each response")
+   parser.add_argument("--seed", type=int, required=False, default=0, help="Random seed")
+   parser.add_argument("--models", type=str, nargs='+', required=False, default=[], help="Models listed by /api/tags")
+   parser.add_argument("--fail_rate", type=float, required=False, default=0.0, help="Share of chat requests answered with a server error")
+   args = parser.parse_args()
+
+   server = serve(args.bind, args.port, FakeBackend(args.latency, args.completion_tokens, seed=args.seed, load_time=args.load_time, tail_words=args.tail_words), args.models, args.fail_rate)
+   print(f'[INFO] Mock ollama server on http://{args.bind}:{args.port}')
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   server.server_close()
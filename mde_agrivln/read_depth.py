@@ -1,27 +1,108 @@
 # MDE-AgriVLN - The Depth Reading Module
+#
+# Downsamples each depth frame to a grid of frame_ratio = [width, height]
+# cells. Pooling gives the value of a cell:
+#    point:  the pixel at the cell center (the original sampling)
+#    mean:   the mean of all pixels of the cell
+#    median: the median of all pixels of the cell
 
 import numpy as np
 from typing import List
 
+from mde_agrivln.depth_store import list_depth_times, load_depth, open_episode_store
 
-def read_depth(place, id, t: List[int], frame_ratio, estimater):
 
-   data = np.load(f"{estimater}/output/{place}_{id}/frame_{t[0]}'{t[1]}.npz", allow_pickle=True)
-   depth_matrix = data["depth"] 
+POOLINGS = ['point', 'mean', 'median']
 
-   frame_width = depth_matrix.shape[1]
-   frame_height = depth_matrix.shape[0]
+# the camera frames are 640×360
+FRAME_SIZE = [640, 360]
 
-   sample_quantity = frame_ratio
-   sample_interval = frame_width / sample_quantity[0]
+# frames pooled at once, bounds the float64 copy of a packed episode
+POOL_CHUNK = 32
 
-   sample_matrix = []
 
-   for y in range(int(sample_interval / 2), frame_height, int(sample_interval)):
-      sample_map_line = []
-      for x in range(int(sample_interval / 2), frame_width, int(sample_interval)):
-         depth_value = depth_matrix[y, x]
-         sample_map_line.append(round(float(depth_value), 2))
-      sample_matrix.append(sample_map_line)
+def get_frame_ratio(width, frame_size=FRAME_SIZE):
+   # a grid with the aspect ratio of the camera frame, e.g. 16 -> [16, 9]
+   return [width, max(1, round(width * frame_size[1] / frame_size[0]))]
 
-   return sample_matrix
\ No newline at end of file
+
+def get_sample_index(size, cells):
+   # pixel at the center of each cell
+   return ((np.arange(cells) + 0.5) * size / cells).astype(int)
+
+
+def get_block_edges(size, cells):
+   return np.linspace(0, size, cells + 1).round().astype(int)
+
+
+def pool_depth(depth_matrix, frame_ratio, pooling='point'):
+   # depth_matrix: (H, W) for one frame or (N, H, W) for a batch of frames
+   height, width = depth_matrix.shape[-2:]
+   if pooling == 'point':
+      rows = get_sample_index(height, frame_ratio[1])
+      cols = get_sample_index(width, frame_ratio[0])
+      return depth_matrix[..., rows[:, None], cols]
+
+   rows = get_block_edges(height, frame_ratio[1])
+   cols = get_block_edges(width, frame_ratio[0])
+   depth_matrix = depth_matrix.astype(np.float64)
+   if pooling == 'mean':
+      sums = np.add.reduceat(np.add.reduceat(depth_matrix, rows[:-1], axis=-2), cols[:-1], axis=-1)
+      return sums / (np.diff(rows)[:, None] * np.diff(cols)[None, :])
+   if pooling == 'median':
+      if height % frame_ratio[1] == 0 and width % frame_ratio[0] == 0:
+         # equal blocks: one median over a (..., h, w, block) view
+         blocks = depth_matrix.reshape(*depth_matrix.shape[:-2], frame_ratio[1], height // frame_ratio[1], frame_ratio[0], width // frame_ratio[0])
+         blocks = np.swapaxes(blocks, -3, -2).reshape(*depth_matrix.shape[:-2], frame_ratio[1], frame_ratio[0], -1)
+         return np.median(blocks, axis=-1)
+      pooled = np.empty(depth_matrix.shape[:-2] + (frame_ratio[1], frame_ratio[0]))
+      for i in range(frame_ratio[1]):
+         for j in range(frame_ratio[0]):
+            pooled[..., i, j] = np.median(depth_matrix[..., rows[i]:rows[i + 1], cols[j]:cols[j + 1]], axis=(-2, -1))
+      return pooled
+   raise ValueError(f"Invalid pooling: {pooling}")
+
+
+def sample_depth(depth_matrix, frame_ratio, pooling='point'):
+   sampled = pool_depth(depth_matrix, frame_ratio, pooling)
+   return np.round(sampled.astype(np.float64), 2).tolist()
+
+
+def read_depth(place, id, t: List[int], frame_ratio, estimater, pooling='point'):
+
+   depth_matrix = load_depth(place, id, f"{t[0]}'{t[1]}", estimater)
+
+   return sample_depth(depth_matrix, frame_ratio, pooling)
+
+
+def read_depth_episode(place, id, frame_ratio, estimater, time_keys=None, pooling='point'):
+
+   store = open_episode_store(place, id, estimater)
+
+   if time_keys is None:
+      time_keys = store.time_keys if store is not None else list_depth_times(place, id, estimater)
+   if len(time_keys) == 0:
+      return {}
+
+   # packed episode: read every frame straight from the memory map
+   if store is not None and all(time_key in store for time_key in time_keys):
+      height, width = store.depth.shape[-2:]
+      if pooling == 'point':
+         rows = get_sample_index(height, frame_ratio[1])
+         cols = get_sample_index(width, frame_ratio[0])
+         sampled = store.sample(time_keys, rows, cols)
+      else:
+         sampled = np.concatenate([
+            pool_depth(store.get_many(time_keys[i:i + POOL_CHUNK]), frame_ratio, pooling)
+            for i in range(0, len(time_keys), POOL_CHUNK)
+         ])
+   else:
+      sampled = np.stack([
+         pool_depth(load_depth(place, id, time_key, estimater), frame_ratio, pooling)
+         for time_key in time_keys
+      ])
+
+   # round and convert the whole episode at once instead of per frame
+   sample_matrices = np.round(sampled.astype(np.float64), 2).tolist()
+
+   return dict(zip(time_keys, sample_matrices))
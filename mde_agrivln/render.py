@@ -1,19 +1,59 @@
 # MDE-AgriVLN - The Depth Map Rendering Function
 
 import numpy as np
-import matplotlib.pyplot as plt
 import os
+from PIL import Image
+
+from mde_agrivln.depth_store import load_npz_depth
+
+
+LUT_SIZE = 256
+
+_colormap_luts = {}
+
+
+def get_colormap_lut(cmap='turbo_r'):
+   # 256 x 3 uint8 table, taken once per process from the matplotlib colormap
+   if cmap not in _colormap_luts:
+      import matplotlib
+      lut = matplotlib.colormaps[cmap].resampled(LUT_SIZE)(np.arange(LUT_SIZE), bytes=True)
+      _colormap_luts[cmap] = np.ascontiguousarray(lut[:, :3])
+   return _colormap_luts[cmap]
+
+
+def normalize_depth(depth):
+   # clip to the 1st and 99th percentiles (one partition for both) and scale to [0, 1]
+   low, high = np.percentile(depth, [1, 99])
+   if high <= low:
+      return np.zeros(depth.shape, dtype=np.float64)
+   depth_vis = np.clip(depth.astype(np.float64), low, high)
+   return (depth_vis - low) / (high - low)
 
 
 def render_depth_map(npz_path, save_path, cmap='turbo_r'):
 
-   data = np.load(npz_path)
+   depth = load_npz_depth(npz_path)
+
+   return render_depth_array(depth, save_path, cmap)
 
-   possible_keys = [k for k in data.keys() if 'depth' in k.lower()]
-   if not possible_keys:
-      raise KeyError("No depth-related array found in the .npz file.")
 
-   depth = data[possible_keys[0]]
+def render_depth_array(depth, save_path, cmap='turbo_r'):
+
+   depth_vis = normalize_depth(depth)
+
+   # same binning as matplotlib: index = floor(x * N), with x == 1 in the last bin
+   lut_index = np.minimum((depth_vis * LUT_SIZE).astype(np.intp), LUT_SIZE - 1)
+   rgb = np.take(get_colormap_lut(cmap), lut_index, axis=0)
+
+   os.makedirs(os.path.dirname(save_path), exist_ok=True)
+   Image.fromarray(rgb).save(save_path, compress_level=1)
+
+   return True
+
+
+def render_depth_array_matplotlib(depth, save_path, cmap='turbo_r'):
+   # the original figure-based renderer, kept as the reference for benchmarks
+   import matplotlib.pyplot as plt
 
    depth_vis = np.clip(depth, np.percentile(depth, 1), np.percentile(depth, 99))
    depth_vis = (depth_vis - depth_vis.min()) / (depth_vis.max() - depth_vis.min())
@@ -29,5 +69,5 @@ def render_depth_map(npz_path, save_path, cmap='turbo_r'):
    os.makedirs(os.path.dirname(save_path), exist_ok=True)
    plt.savefig(save_path, bbox_inches='tight', pad_inches=0)
    plt.close()
-   
+
    return True
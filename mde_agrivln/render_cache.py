@@ -0,0 +1,169 @@
+# MDE-AgriVLN - The Depth Map Render Cache Module
+#
+# Every rendered frame_{t}.png is recorded in render_cache.json next to it,
+# keyed by a hash of the depth data it came from and the colormap. A frame
+# is only rendered again when that key or the PNG itself has changed.
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from mde_agrivln.depth_store import get_depth_dir, load_depth, open_episode_store
+from mde_agrivln.episode import load_episode
+from mde_agrivln.hyperparameter import get_hyperparameter
+from mde_agrivln.render import render_depth_array
+
+
+RENDER_CACHE_NAME = "render_cache.json"
+RENDERER_VERSION = "lut-1"
+
+
+def get_map_path(place, id, time_key, estimater):
+   return f"{get_depth_dir(place, id, estimater)}/frame_{time_key}.png"
+
+
+def load_render_cache(place, id, estimater):
+   cache_path = os.path.join(get_depth_dir(place, id, estimater), RENDER_CACHE_NAME)
+   try:
+      with open(cache_path, "r") as f:
+         return json.load(f)
+   except (FileNotFoundError, json.JSONDecodeError):
+      return {}
+
+
+def matches_png(depth_dir, name, record):
+   try:
+      return os.stat(os.path.join(depth_dir, name)).st_mtime_ns == record["mtime_ns"]
+   except FileNotFoundError:
+      return False
+
+
+def save_render_cache(place, id, estimater, cache):
+   # merged with the file on disk: per frame the record of the PNG on disk wins, so
+   # processes rendering the same episode keep each other's records
+   depth_dir = get_depth_dir(place, id, estimater)
+   cache_path = os.path.join(depth_dir, RENDER_CACHE_NAME)
+   merged = load_render_cache(place, id, estimater)
+   for name, record in cache.items():
+      other = merged.get(name)
+      if other is None or not matches_png(depth_dir, name, other):
+         merged[name] = record
+   tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+   with open(tmp_path, "w") as f:
+      json.dump(merged, f, indent=3)
+   os.replace(tmp_path, cache_path)
+
+
+def get_render_key(place, id, time_key, estimater, cmap):
+   # hash of the depth bytes the map is rendered from, plus the colormap
+   digest = hashlib.sha1()
+   store = open_episode_store(place, id, estimater)
+   if store is not None and time_key in store:
+      digest.update(f"{store.dtype}:{store.scale}:".encode())
+      digest.update(store.raw(time_key).tobytes())
+   else:
+      with open(f"{get_depth_dir(place, id, estimater)}/frame_{time_key}.npz", "rb") as f:
+         digest.update(f.read())
+   digest.update(f":{cmap}:{RENDERER_VERSION}".encode())
+   return digest.hexdigest()
+
+
+def is_up_to_date(cache, map_path, render_key):
+   record = cache.get(os.path.basename(map_path))
+   if record is None or record["key"] != render_key:
+      return False
+   try:
+      return os.stat(map_path).st_mtime_ns == record["mtime_ns"]
+   except FileNotFoundError:
+      return False
+
+
+def record_render(cache, map_path, render_key):
+   cache[os.path.basename(map_path)] = {
+      "key": render_key,
+      "mtime_ns": os.stat(map_path).st_mtime_ns
+   }
+
+
+def render_frame(place, id, time_key, estimater, cmap):
+   map_path = get_map_path(place, id, time_key, estimater)
+   render_depth_array(load_depth(place, id, time_key, estimater), map_path, cmap)
+   return map_path
+
+
+def render_cached(place, id, time_key, estimater, cmap, cache):
+   # returns (map_path, rendered), rendered is False on a cache hit
+   map_path = get_map_path(place, id, time_key, estimater)
+   render_key = get_render_key(place, id, time_key, estimater, cmap)
+   if is_up_to_date(cache, map_path, render_key):
+      return map_path, False
+   render_frame(place, id, time_key, estimater, cmap)
+   record_render(cache, map_path, render_key)
+   return map_path, True
+
+
+def get_episode_time_keys(place, id):
+   # the time steps decide will visit for this episode
+   return load_episode(place, id).time_keys
+
+
+def _render_task(task):
+   place, id, time_key, estimater, cmap = task
+   return render_frame(place, id, time_key, estimater, cmap)
+
+
+def prerender_depth_maps(place, id_range, estimater, cmap=None, workers=None):
+
+   if cmap is None:
+      cmap = get_hyperparameter('cmap')
+
+   caches = {}
+   tasks = []
+   keys = {}
+   for id in id_range:
+      cache = load_render_cache(place, id, estimater)
+      caches[id] = cache
+      for time_key in get_episode_time_keys(place, id):
+         map_path = get_map_path(place, id, time_key, estimater)
+         render_key = get_render_key(place, id, time_key, estimater, cmap)
+         if not is_up_to_date(cache, map_path, render_key):
+            tasks.append((place, id, time_key, estimater, cmap))
+            keys[map_path] = (id, render_key)
+
+   print(f'[INFO] Pre-render: {len(tasks)} depth maps to render, {len(id_range)} episodes.')
+
+   if len(tasks) > 0:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+         for map_path in executor.map(_render_task, tasks, chunksize=4):
+            id, render_key = keys[map_path]
+            record_render(caches[id], map_path, render_key)
+
+   for id in id_range:
+      save_render_cache(place, id, estimater, caches[id])
+
+   return len(tasks)
+
+
+if __name__ == '__main__':
+
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-p", "--place", type=str, required=True, help="Place")
+   parser.add_argument("-i", "--id_range", type=int, nargs='+', required=True, help="ID range")
+   parser.add_argument("-e", "--estimater", type=str, required=True, help="Monocular depth estimation model")
+   parser.add_argument("-c", "--cmap", type=str, required=False, help="Colormap: turbo_r, Spectral or viridis")
+   parser.add_argument("-j", "--workers", type=int, required=False, help="Number of render processes")
+   args = parser.parse_args()
+
+   if len(args.id_range) == 2:
+      id_range = list(range(args.id_range[0], args.id_range[1] + 1))
+   else:
+      id_range = args.id_range
+
+   try:
+      prerender_depth_maps(args.place, id_range, args.estimater, args.cmap, args.workers)
+   except FileNotFoundError as e:
+      print(f'[ERROR] {e}')
+      sys.exit(1)
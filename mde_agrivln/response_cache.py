@@ -0,0 +1,133 @@
+# MDE-AgriVLN - The Response Cache Module
+#
+# Stores every model response on disk under a key made of the model name,
+# the message contents and a hash of each attached image. An identical
+# request is then answered from disk instead of the model server. In replay
+# mode every request must be answered from the cache and a miss is an error,
+# which makes a run reproducible and free of GPU time. The completion token
+# cap (--num_predict) is part of the key. Responses of a stream stopped early
+# (streaming.py) or cut off by the cap are not stored.
+#
+#    {cache_dir}/{key[:2]}/{key}.json
+
+import base64
+import hashlib
+import json
+import os
+import threading
+
+import ollama
+
+
+# request fields that change how a response is delivered, not what it is
+IGNORED_FIELDS = {'stream', 'keep_alive', 'stop_tags'}
+
+
+class ReplayMiss(KeyError):
+   pass
+
+
+def image_digest(image):
+   if isinstance(image, bytes):
+      payload = base64.b64encode(image)
+   elif isinstance(image, str) and len(image) < 4096 and os.path.isfile(image):
+      with open(image, "rb") as f:
+         payload = base64.b64encode(f.read())
+   else:
+      payload = str(image).encode()
+   return hashlib.sha256(payload).hexdigest()
+
+
+def get_request_key(request, num_predict=None):
+   # num_predict is the completion token cap the backend adds (see prepare_request)
+   messages = []
+   for message in request.get('messages', []):
+      message = dict(message)
+      if message.get('images'):
+         message['images'] = [image_digest(image) for image in message['images']]
+      messages.append(message)
+   fields = {k: v for k, v in request.items() if k not in IGNORED_FIELDS and k != 'messages'}
+   if num_predict is not None:
+      fields['options'] = dict(fields.get('options') or {}, num_predict=num_predict)
+   fields['messages'] = messages
+   text = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+   return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def dump_response(response):
+   if hasattr(response, 'model_dump'):
+      return response.model_dump(exclude_none=True)
+   return dict(response)
+
+
+class ResponseCache:
+
+   def __init__(self, cache_dir, replay=False, num_predict=None):
+      self.cache_dir = cache_dir
+      self.replay = replay
+      self.num_predict = num_predict
+      self.hits = 0
+      self.misses = 0
+      self.lock = threading.Lock()
+      os.makedirs(cache_dir, exist_ok=True)
+
+   def _path(self, key):
+      return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+   def get(self, request):
+      key = get_request_key(request, self.num_predict)
+      try:
+         with open(self._path(key), "r") as f:
+            data = json.load(f)
+      except (FileNotFoundError, json.JSONDecodeError):
+         with self.lock:
+            self.misses += 1
+         if self.replay:
+            raise ReplayMiss(f"No cached response for {request.get('model')} request {key[:12]}.")
+         return key, None
+      with self.lock:
+         self.hits += 1
+      return key, ollama.ChatResponse(**data["response"])
+
+   def put(self, key, request, response):
+      # a stream stopped early is cut off and has no token counts, only full responses are kept
+      if getattr(response, 'early_stop', False):
+         return
+      # nor one cut off by the completion token cap
+      if self.num_predict is not None and getattr(response, 'done_reason', None) == 'length':
+         return
+      path = self._path(key)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+      with open(tmp_path, "w") as f:
+         json.dump({"model": request.get('model'), "response": dump_response(response)}, f, ensure_ascii=False)
+      os.replace(tmp_path, path)
+
+   def wrap(self, chat):
+      # a chat function answering from the cache first
+      def cached_chat(**request):
+         key, response = self.get(request)
+         if response is None:
+            response = chat(**request)
+            self.put(key, request, response)
+         return response
+      return cached_chat
+
+   def summary(self):
+      total = self.hits + self.misses
+      return f'[INFO] Response cache: {self.hits}/{total} hits' + (' (replay)' if self.replay else '')
+
+
+class CachedAsyncClient:
+   # same idea as ResponseCache.wrap for an ollama.AsyncClient
+
+   def __init__(self, client, cache):
+      self.client = client
+      self.cache = cache
+
+   async def chat(self, **request):
+      key, response = self.cache.get(request)
+      if response is None:
+         response = await self.client.chat(**request)
+         self.cache.put(key, request, response)
+      return response
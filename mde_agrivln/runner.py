@@ -0,0 +1,211 @@
+# MDE-AgriVLN - The Episode Runner Module
+#
+# run_episode runs STL, decide and evaluate for one episode with blocking
+# chat calls. run_episodes_async runs several episodes at the same time
+# through one async client (see backend.py), at most `concurrency` at once,
+# optionally with their calls queued by a StepScheduler (see scheduler.py). Each
+# episode only writes under runs/{exp}/{place}_{id}. Every model call is timed
+# to timing.jsonl; a ResponseCache can sit in front, and its hits are not
+# model calls.
+
+import asyncio
+import os
+import time
+
+from mde_agrivln.backend import OllamaBackend
+from mde_agrivln.chat import run_chat_async
+from mde_agrivln.checkpoint import get_resume_point, is_episode_complete
+from mde_agrivln.STL import STL, STL_requests
+from mde_agrivln.decide import decide, decide_requests
+from mde_agrivln.episode import load_episode
+from mde_agrivln.evaluate import evaluate
+from mde_agrivln.journal import reset_journal
+from mde_agrivln.response_cache import CachedAsyncClient
+from mde_agrivln.scheduler import StepScheduler
+from mde_agrivln.timing import TimingRecorder
+from mde_agrivln.tracing import span, start_trace, finish_trace
+
+
+STL_RUN_MAX = 3
+
+
+def prepare_episode(exp, place, id):
+   dir_path = f"runs/{exp}/{place}_{id}"
+   os.makedirs(dir_path, exist_ok=True)
+   episode = load_episode(place, id)
+   if episode.check() == False:
+      print(f'[ERROR] {place}_{id} label is wrong.')
+      return None
+   print(f"[INFO] {place}_{id} label is correct.")
+   return episode
+
+
+def get_timing_recorder(exp, place, id, if_resume='False'):
+   timing_path = f"runs/{exp}/{place}_{id}/timing.jsonl"
+   # a resumed episode keeps the timing of the calls before the interruption
+   if if_resume == 'False' or not os.path.exists(timing_path):
+      reset_journal(timing_path)
+   return TimingRecorder(timing_path)
+
+
+def get_trace_path(exp, place, id):
+   return f"runs/{exp}/{place}_{id}/trace.json"
+
+
+def get_resume_state(exp, place, id, episode, if_resume):
+   # 'complete', 'decide' (the subtask list is kept) or 'start'
+   if if_resume == 'False':
+      return 'start'
+   dir_path = f"runs/{exp}/{place}_{id}"
+   if is_episode_complete(dir_path):
+      return 'complete'
+   if get_resume_point(dir_path, episode.time_keys) is not None:
+      return 'decide'
+   return 'start'
+
+
+def preload_models(backend, models):
+   # load every model once before the first episode, so no step pays the load
+   for model in models:
+      try:
+         load = backend.preload(model)
+         print(f'[INFO] {model} loaded ({load:.1f} s).')
+      except Exception as e:
+         print(f'[WARNING] Fail to preload {model}: {e!r}')
+
+
+def run_episode(LLM, VLM, exp, place, id, representation, depth_matrix_ratio, estimater, if_token, if_pipeline='False', chat=None, response_cache=None, encoding='json', pooling='point', if_resume='False', if_trace='False', gate=None):
+
+   episode = prepare_episode(exp, place, id)
+   if episode is None:
+      return False
+   resume_state = get_resume_state(exp, place, id, episode, if_resume)
+   if resume_state == 'complete':
+      print(f'[INFO] {place}_{id} is already evaluated, skipped.')
+      return True
+   print(f'--- {place}_{id} starts ---')
+
+   tracer = start_trace(get_trace_path(exp, place, id)) if if_trace == 'True' else None
+   timing_recorder = get_timing_recorder(exp, place, id, if_resume)
+   try:
+      chat = timing_recorder.wrap(chat)
+      if response_cache is not None:
+         chat = response_cache.wrap(chat)
+
+      # the subtask list module, kept when resuming
+      STL_state = resume_state == 'decide'
+      STL_run = 1
+      while STL_state == False:
+         with span('STL'):
+            STL_state = STL(LLM, exp, place, id, chat, episode)
+         STL_run += 1
+         if STL_run > STL_RUN_MAX:
+            print('[ERROR] Fail to generate STL.')
+            break
+         elif STL_state == False:
+            print('[ERROR] Fail to generate STL. Ready to regenerate.')
+         with span('sleep'):
+            time.sleep(0.1)
+
+      # the decision making module
+      with span('decide'):
+         decide(VLM, exp, place, id, representation, depth_matrix_ratio, estimater, if_token, if_pipeline, chat, encoding, pooling, episode, if_resume, gate)
+      with span('sleep'):
+         time.sleep(0.1)
+
+      # the evaluation module
+      with span('evaluate'):
+         evaluate(exp, place, id, episode)
+      with span('sleep'):
+         time.sleep(1.0)
+
+      print(timing_recorder.summary(f'{place}_{id}'))
+   finally:
+      timing_recorder.close()
+   if tracer is not None:
+      print(finish_trace(tracer).summary(f'{place}_{id}'))
+   print(f'--- {place}_{id} ends ---')
+   return True
+
+
+async def run_episode_async(client, semaphore, LLM, VLM, exp, place, id, representation, depth_matrix_ratio, estimater, if_token, if_pipeline='False', response_cache=None, encoding='json', pooling='point', if_resume='False', if_trace='False', scheduler=None, gate=None):
+
+   async with semaphore:
+
+      episode = await asyncio.to_thread(prepare_episode, exp, place, id)
+      if episode is None:
+         return False
+      resume_state = await asyncio.to_thread(get_resume_state, exp, place, id, episode, if_resume)
+      if resume_state == 'complete':
+         print(f'[INFO] {place}_{id} is already evaluated, skipped.')
+         return True
+      print(f'--- {place}_{id} starts ---')
+
+      tracer = start_trace(get_trace_path(exp, place, id)) if if_trace == 'True' else None
+      timing_recorder = get_timing_recorder(exp, place, id, if_resume)
+      try:
+         client = timing_recorder.wrap_async(client)
+         # the timing leaves out the wait in the scheduler queue, cache hits skip it
+         if scheduler is not None:
+            client = scheduler.client_for(client)
+         if response_cache is not None:
+            client = CachedAsyncClient(client, response_cache)
+
+         # the subtask list module, kept when resuming
+         STL_state = resume_state == 'decide'
+         STL_run = 1
+         while STL_state == False:
+            with span('STL'):
+               STL_state = await run_chat_async(STL_requests(LLM, exp, place, id, episode), client)
+            STL_run += 1
+            if STL_run > STL_RUN_MAX:
+               print(f'[ERROR] {place}_{id} fails to generate STL.')
+               break
+            elif STL_state == False:
+               print(f'[ERROR] {place}_{id} fails to generate STL. Ready to regenerate.')
+
+         # the decision making module
+         with span('decide'):
+            await run_chat_async(decide_requests(VLM, exp, place, id, representation, depth_matrix_ratio, estimater, if_token, if_pipeline, encoding, pooling, episode, if_resume, gate), client)
+
+         # the evaluation module
+         with span('evaluate'):
+            await asyncio.to_thread(evaluate, exp, place, id, episode)
+
+         print(timing_recorder.summary(f'{place}_{id}'))
+      finally:
+         # joins the writer thread, off the event loop
+         await asyncio.to_thread(timing_recorder.close)
+      if tracer is not None:
+         print(finish_trace(tracer).summary(f'{place}_{id}'))
+      print(f'--- {place}_{id} ends ---')
+      return True
+
+
+async def run_episodes_async(LLM, VLM, exp, place, id_range, representation, depth_matrix_ratio, estimater, if_token, concurrency, if_pipeline='False', client=None, response_cache=None, encoding='json', pooling='point', if_resume='False', if_trace='False', inflight=None, endpoints=1, gate=None):
+
+   if client is None:
+      client = OllamaBackend().async_client()
+   semaphore = asyncio.Semaphore(concurrency)
+
+   # with an in-flight cap, the calls of all running episodes share one queue
+   scheduler = None
+   if inflight is not None:
+      scheduler = StepScheduler(inflight, endpoints, concurrency)
+      scheduler.start()
+   start = time.perf_counter()
+
+   tasks = [
+      run_episode_async(client, semaphore, LLM, VLM, exp, place, id, representation, depth_matrix_ratio, estimater, if_token, if_pipeline, response_cache, encoding, pooling, if_resume, if_trace, scheduler, gate)
+      for id in id_range
+   ]
+   results = await asyncio.gather(*tasks, return_exceptions=True)
+
+   if scheduler is not None:
+      await scheduler.stop()
+      print(scheduler.summary(time.perf_counter() - start))
+
+   for id, result in zip(id_range, results):
+      if isinstance(result, BaseException):
+         print(f'[ERROR] {place}_{id} failed: {result!r}')
+   return results
@@ -0,0 +1,93 @@
+# MDE-AgriVLN - The Step Scheduler Module
+#
+# decide is serial within an episode: step t+1 needs the subtask list of step
+# t, so one episode has at most one call in flight and leaves the model server
+# idle while it prepares its next step. The scheduler keeps many episodes
+# going at once and puts the ready calls of all of them into one bounded
+# queue. Calls leave the queue in the order they became ready: an episode has
+# at most one call waiting, so every episode gets its turn before any other
+# gets a second one. At most `inflight` calls per endpoint are sent at the
+# same time, the rest wait in the queue; a server batching parallel requests
+# (OLLAMA_NUM_PARALLEL) then always has work.
+
+import asyncio
+import time
+
+
+class StepScheduler:
+
+   def __init__(self, inflight, endpoints=1, queue_size=None):
+      self.inflight = inflight * endpoints
+      self.queue = asyncio.Queue(maxsize=queue_size or 0)
+      self.slots = asyncio.Semaphore(self.inflight)
+      self.dispatcher = None
+      self.calls = 0
+      self.waited = 0.0
+      self.call_time = 0.0
+
+   def client_for(self, client):
+      return ScheduledClient(self, client)
+
+   def start(self):
+      if self.dispatcher is None:
+         self.dispatcher = asyncio.create_task(self._dispatch())
+
+   async def stop(self):
+      if self.dispatcher is not None:
+         self.dispatcher.cancel()
+         try:
+            await self.dispatcher
+         except asyncio.CancelledError:
+            pass
+         self.dispatcher = None
+
+   async def submit(self, client, request):
+      future = asyncio.get_running_loop().create_future()
+      await self.queue.put((time.perf_counter(), client, request, future))
+      return await future
+
+   async def _dispatch(self):
+      while True:
+         await self.slots.acquire()
+         queued, client, request, future = await self.queue.get()
+         if future.cancelled():
+            self.slots.release()
+            continue
+         self.waited += time.perf_counter() - queued
+         asyncio.create_task(self._call(client, request, future))
+
+   async def _call(self, client, request, future):
+      start = time.perf_counter()
+      try:
+         response = await client.chat(**request)
+      except Exception as e:
+         if not future.cancelled():
+            future.set_exception(e)
+      else:
+         if not future.cancelled():
+            future.set_result(response)
+      finally:
+         self.calls += 1
+         self.call_time += time.perf_counter() - start
+         self.slots.release()
+
+   def summary(self, wall):
+      if self.calls == 0:
+         return '[INFO] Scheduler: no model calls'
+      # the share of the in-flight slots that held a call
+      usage = self.call_time / (wall * self.inflight) if wall > 0 else 0.0
+      return (
+         f'[INFO] Scheduler: {self.calls} calls, at most {self.inflight} in flight, '
+         f'queue wait mean {self.waited / self.calls:.2f} s, slots in use {usage * 100:.0f}% of {wall:.1f} s'
+      )
+
+
+class ScheduledClient:
+   # the async client of one episode, its calls wait in the shared queue
+
+   def __init__(self, scheduler, client):
+      self.scheduler = scheduler
+      self.client = client
+
+   async def chat(self, **request):
+      return await self.scheduler.submit(self.client, request)
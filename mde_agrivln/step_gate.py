@@ -0,0 +1,92 @@
+# MDE-AgriVLN - The Step Gate Module
+#
+# Skips the VLM call of a step when the scene has not changed since the last
+# step that called it, e.g. on a long straight [FORWARD] stretch. Two cheap
+# metrics compare the current step with that reference step:
+#    image: mean absolute difference of 64×36 grayscale thumbnails, 0 to 1
+#    depth: mean relative difference of the depth matrix cells; the map
+#           representation has no depth matrix, it compares a 16×9 point
+#           sampled grid (GATE_DEPTH_RATIO) instead
+# Below both thresholds the step reuses the previous action and keeps the
+# subtask list. A [STOP] or an unparsed action is never reused, and at most
+# max_skip steps in a row are skipped, so a slow drift still reaches the VLM.
+
+import numpy as np
+from PIL import Image
+
+from mde_agrivln.read_depth import get_frame_ratio
+
+
+THUMBNAIL_SIZE = (64, 36)
+
+# depth grid of the gate when the prompt has no depth matrix
+GATE_DEPTH_RATIO = get_frame_ratio(16)
+
+# depth below this is treated as this, the relative difference of near cells stays bounded
+MIN_DEPTH = 0.1
+
+
+def load_thumbnail(image_path):
+   with Image.open(image_path) as image:
+      image.draft('L', THUMBNAIL_SIZE)
+      thumbnail = image.convert('L').resize(THUMBNAIL_SIZE, Image.BILINEAR)
+   return np.asarray(thumbnail, dtype=np.float32) / 255.0
+
+
+def get_image_change(thumbnail, reference):
+   return float(np.mean(np.abs(thumbnail - reference)))
+
+
+def get_depth_change(depth_matrix, reference):
+   depth_matrix = np.asarray(depth_matrix, dtype=np.float64)
+   reference = np.maximum(np.asarray(reference, dtype=np.float64), MIN_DEPTH)
+   return float(np.mean(np.abs(depth_matrix - reference) / reference))
+
+
+class StepGate:
+
+   def __init__(self, image_threshold=0.03, depth_threshold=0.05, max_skip=4):
+      self.image_threshold = image_threshold
+      self.depth_threshold = depth_threshold
+      self.max_skip = max_skip
+
+   def name(self):
+      # experiment name suffix
+      return f"gate{self.image_threshold:g}-{self.depth_threshold:g}-{self.max_skip}"
+
+   def for_episode(self):
+      return EpisodeGate(self)
+
+
+class EpisodeGate:
+   # the reference step of one episode, reset on every VLM call
+
+   def __init__(self, gate):
+      self.gate = gate
+      self.reference = None
+      self.action = None
+      self.run = 0
+      self.steps = 0
+      self.skipped = 0
+
+   def check(self, thumbnail, depth_matrix):
+      # (reused reference time or None, image change, depth change)
+      self.steps += 1
+      if self.reference is None or self.action in [None, '[STOP]'] or self.run >= self.gate.max_skip:
+         return None, None, None
+      time_key, reference_thumbnail, reference_depth = self.reference
+      image_change = get_image_change(thumbnail, reference_thumbnail)
+      depth_change = get_depth_change(depth_matrix, reference_depth)
+      if image_change >= self.gate.image_threshold or depth_change >= self.gate.depth_threshold:
+         return None, image_change, depth_change
+      self.run += 1
+      self.skipped += 1
+      return time_key, image_change, depth_change
+
+   def called(self, time_key, thumbnail, depth_matrix, action):
+      self.reference = (time_key, thumbnail, depth_matrix)
+      self.action = action
+      self.run = 0
+
+   def summary(self, name):
+      return f'[INFO] {name}: {self.skipped} of {self.steps} steps reused the previous decision.'
@@ -0,0 +1,107 @@
+# MDE-AgriVLN - The Streaming Module
+#
+# STL only needs <subtask_list> and decide only needs <thought>, <action> and
+# <state>, so a streamed response can be cut off as soon as these tags are
+# closed (stop_tags of the request). A <think> block of a reasoning model is
+# skipped, tags drafted while thinking do not count.
+#
+#    False: wait for the whole response
+#    True:  stop the generation once the stop tags are closed
+#    probe: read the whole response, but note when the stop tags were closed,
+#           to measure the time and tokens that True would save
+
+import time
+from typing import Optional
+
+import ollama
+
+
+STREAM_MODES = ['False', 'True', 'probe']
+
+
+class StreamedResponse(ollama.ChatResponse):
+   time_to_decision: Optional[float] = None
+   decision_eval_count: Optional[int] = None
+   early_stop: bool = False
+
+
+class TagWatcher:
+
+   def __init__(self, tags):
+      self.closing = [f'</{tag}>' for tag in tags]
+      self.parts = []
+      self.closed = False
+
+   def feed(self, text):
+      self.parts.append(text)
+      # a tag can only have been closed by a chunk with a '>'
+      if not self.closed and '>' in text:
+         content = ''.join(self.parts)
+         if content.lstrip().startswith('<think>'):
+            end = content.find('</think>')
+            content = content[end + len('</think>'):] if end >= 0 else ''
+         self.closed = all(tag in content for tag in self.closing)
+      return self.closed
+
+   @property
+   def content(self):
+      return ''.join(self.parts)
+
+
+class StreamCollector:
+   # the state of one streamed response, shared by the sync and async readers
+
+   def __init__(self, stop_tags, mode):
+      self.watcher = TagWatcher(stop_tags)
+      self.mode = mode
+      self.start = time.perf_counter()
+      self.count = 0
+      self.last = None
+      self.time_to_decision = None
+      self.decision_eval_count = None
+
+   def feed(self, chunk):
+      # returns True when the stream should be closed
+      self.count += 1
+      self.last = chunk
+      if self.watcher.feed(chunk.message.content or '') and self.time_to_decision is None:
+         self.time_to_decision = time.perf_counter() - self.start
+         self.decision_eval_count = self.count
+         return self.mode == 'True' and not chunk.done
+      return False
+
+   def response(self, model, early_stop):
+      last = self.last.model_dump(exclude_none=True) if self.last is not None else {}
+      last.pop('message', None)
+      if early_stop:
+         # no final record: what was generated is all that is known
+         last.update(done=True, done_reason='early_stop', eval_count=self.count)
+      else:
+         last.setdefault('eval_count', self.count)
+      last.setdefault('model', model)
+      return StreamedResponse(
+         **last,
+         message={'role': 'assistant', 'content': self.watcher.content},
+         time_to_decision=self.time_to_decision if self.time_to_decision is not None else time.perf_counter() - self.start,
+         decision_eval_count=self.decision_eval_count if self.decision_eval_count is not None else self.count,
+         early_stop=early_stop
+      )
+
+
+def collect_stream(chunks, stop_tags, mode, model=None):
+   collector = StreamCollector(stop_tags, mode)
+   for chunk in chunks:
+      if collector.feed(chunk):
+         # closing the generator closes the HTTP stream, ollama then stops generating
+         chunks.close()
+         return collector.response(model, True)
+   return collector.response(model, False)
+
+
+async def collect_stream_async(chunks, stop_tags, mode, model=None):
+   collector = StreamCollector(stop_tags, mode)
+   async for chunk in chunks:
+      if collector.feed(chunk):
+         await chunks.aclose()
+         return collector.response(model, True)
+   return collector.response(model, False)
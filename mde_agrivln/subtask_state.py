@@ -0,0 +1,87 @@
+# MDE-AgriVLN - The Subtask State Module
+#
+# Holds the subtask list and every state snapshot of one episode in memory.
+# decide reads and updates the current subtask list in place and commits one
+# snapshot per step, which is appended to log.jsonl by a background writer.
+# Historical snapshots are found by bisection over their times.
+
+import bisect
+import json
+
+from mde_agrivln.for_json import time_str_to_float
+from mde_agrivln.journal import read_journal
+
+
+class SnapshotIndex:
+
+   def __init__(self, snapshots=()):
+      self.times = []
+      self.snapshots = []
+      for snapshot in snapshots:
+         self.add(snapshot)
+
+   def add(self, snapshot):
+      snapshot_time = time_str_to_float(snapshot["time"])
+      # snapshots arrive in time order, insort only guards against stray ones
+      i = bisect.bisect_right(self.times, snapshot_time)
+      self.times.insert(i, snapshot_time)
+      self.snapshots.insert(i, snapshot)
+
+   def at(self, time_value):
+      # the snapshot with the latest time <= time_value (first one on ties)
+      i = bisect.bisect_right(self.times, time_value)
+      if i == 0:
+         return None
+      i = bisect.bisect_left(self.times, self.times[i - 1])
+      return self.snapshots[i]
+
+   def __len__(self):
+      return len(self.snapshots)
+
+
+def merge_snapshot(STL, snapshot):
+   state_dict = {s['step']: s['state'] for s in snapshot['subtask_list']}
+   merged_STL = []
+   for subtask in STL:
+      merged_subtask = dict(subtask)
+      merged_subtask['state'] = state_dict.get(subtask['step'], "unknown")  # fallback
+      merged_STL.append(merged_subtask)
+   return merged_STL
+
+
+class SubtaskState:
+
+   def __init__(self, STL, snapshots, log_path=None, writer=None):
+      self.STL = STL
+      self.index = SnapshotIndex(snapshots)
+      self.log_path = log_path
+      self.writer = writer
+      self.current = None
+
+   @classmethod
+   def from_files(cls, stl_path, log_path, writer=None):
+      with open(stl_path, "r") as f:
+         STL = json.load(f)
+      return cls(STL, read_journal(log_path), log_path, writer)
+
+   def restore(self, current_time):
+      # current subtask list = STL merged with the latest snapshot <= current_time
+      snapshot = self.index.at(time_str_to_float(current_time))
+      if snapshot is None:
+         raise ValueError(f"No matching STL state found for time {current_time}")
+      self.current = merge_snapshot(self.STL, snapshot)
+      return self.current
+
+   def commit(self, next_time, new_STL):
+      self.current = new_STL
+      snapshot = {
+         "time": next_time,
+         "subtask_list": [{"step": item["step"], "state": item["state"]} for item in new_STL]
+      }
+      self.index.add(snapshot)
+      if self.writer is not None and self.log_path is not None:
+         self.writer.append(self.log_path, snapshot)
+      return snapshot
+
+   def snapshot_at(self, time_value):
+      return self.index.at(time_value)
@@ -0,0 +1,109 @@
+# MDE-AgriVLN - The Timing Module
+#
+# Records the latency of every model call of an episode to
+# runs/{exp}/{place}_{id}/timing.jsonl. ollama reports the time spent loading
+# the model (load_duration) apart from the inference itself, so a call that
+# had to load the model is marked as a cold start and its load time is kept
+# out of the steady-state latency. Records are appended on the thread of a
+# JournalWriter, so in async mode the event loop never waits on the fsync.
+
+import statistics
+import threading
+import time
+
+from mde_agrivln.backend import OllamaBackend
+from mde_agrivln.journal import JournalWriter
+
+
+# a warm call still reports a few milliseconds of load_duration
+COLD_LOAD_SECONDS = 0.5
+
+
+def get_seconds(response, name):
+   value = getattr(response, name, None)
+   return value / 1e9 if value else 0.0
+
+
+def get_timing_record(model, wall, response):
+   load = get_seconds(response, 'load_duration')
+   total = get_seconds(response, 'total_duration')
+   record = {
+      "model": model,
+      "wall": round(wall, 3),
+      "load": round(load, 3),
+      "prompt_eval": round(get_seconds(response, 'prompt_eval_duration'), 3),
+      "eval": round(get_seconds(response, 'eval_duration'), 3),
+      "inference": round((total if total else wall) - load, 3),
+      "cold": load >= COLD_LOAD_SECONDS
+   }
+   # streamed responses (see streaming.py)
+   time_to_decision = getattr(response, 'time_to_decision', None)
+   if time_to_decision is not None:
+      record["time_to_decision"] = round(time_to_decision, 3)
+      record["early_stop"] = response.early_stop
+      record["decision_tokens"] = response.decision_eval_count
+      # only known when the rest of the response was read (probe)
+      record["tokens_saved"] = None if response.early_stop else (response.eval_count or 0) - response.decision_eval_count
+   return record
+
+
+class TimingRecorder:
+
+   def __init__(self, timing_path):
+      self.timing_path = timing_path
+      self.records = []
+      self.lock = threading.Lock()
+      self.writer = JournalWriter()
+
+   def record(self, model, wall, response):
+      record = get_timing_record(model, wall, response)
+      with self.lock:
+         self.records.append(record)
+      self.writer.append(self.timing_path, record)
+
+   def close(self):
+      # returns once every record is in timing.jsonl
+      self.writer.close()
+
+   def wrap(self, chat=None):
+      def timed_chat(**request):
+         start = time.perf_counter()
+         response = (chat if chat is not None else OllamaBackend().chat)(**request)
+         self.record(request.get('model'), time.perf_counter() - start, response)
+         return response
+      return timed_chat
+
+   def wrap_async(self, client):
+      return TimedAsyncClient(client, self)
+
+   def summary(self, name):
+      if not self.records:
+         return f'[INFO] {name} timing: no model calls'
+      cold = [r for r in self.records if r["cold"]]
+      parts = [f'{len(self.records)} calls', f'{len(cold)} cold starts']
+      if cold:
+         parts.append('load ' + ', '.join(f'{r["model"]} {r["load"]:.1f} s' for r in cold))
+      for model in dict.fromkeys(r["model"] for r in self.records):
+         steady = [r["inference"] for r in self.records if r["model"] == model]
+         parts.append(f'{model} inference median {statistics.median(steady):.2f} s, max {max(steady):.2f} s')
+      streamed = [r for r in self.records if "time_to_decision" in r]
+      if streamed:
+         parts.append(f'{sum(r["early_stop"] for r in streamed)}/{len(streamed)} stopped early')
+         parts.append(f'time to decision median {statistics.median(r["time_to_decision"] for r in streamed):.2f} s')
+         saved = [r["tokens_saved"] for r in streamed if r["tokens_saved"] is not None]
+         if saved:
+            parts.append(f'{sum(saved)} tokens after the decision')
+      return f'[INFO] {name} timing: ' + '; '.join(parts)
+
+
+class TimedAsyncClient:
+
+   def __init__(self, client, recorder):
+      self.client = client
+      self.recorder = recorder
+
+   async def chat(self, **request):
+      start = time.perf_counter()
+      response = await self.client.chat(**request)
+      self.recorder.record(request.get('model'), time.perf_counter() - start, response)
+      return response
@@ -0,0 +1,135 @@
+# MDE-AgriVLN - The Tracing Module
+#
+# Named spans for the stages of STL, decide and evaluate, written per episode
+# to runs/{exp}/{place}_{id}/trace.json in the Chrome trace event format
+# (open it in chrome://tracing or https://ui.perfetto.dev). The tracer of an
+# episode lives in a context variable, so concurrent episodes keep their own
+# spans. Without a tracer span() returns a shared no-op context manager.
+#
+#    with span('decide.prompt', t=t):
+#       ...
+
+import contextlib
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+
+
+_current = contextvars.ContextVar('tracer', default=None)
+
+_NO_SPAN = contextlib.nullcontext()
+
+# one time origin for all tracers of the process, so their traces line up
+_ORIGIN_NS = time.perf_counter_ns()
+
+
+class Span:
+
+   __slots__ = ('tracer', 'name', 'args', 'start')
+
+   def __init__(self, tracer, name, args):
+      self.tracer = tracer
+      self.name = name
+      self.args = args
+
+   def __enter__(self):
+      self.start = time.perf_counter_ns()
+      return self
+
+   def __exit__(self, *exc):
+      self.tracer.add(self.name, self.start, time.perf_counter_ns(), self.args)
+      return False
+
+
+def span(name, **args):
+   tracer = _current.get()
+   if tracer is None:
+      return _NO_SPAN
+   return Span(tracer, name, args)
+
+
+def bind_trace(function):
+   # for worker threads, which do not inherit the context of the caller
+   tracer = _current.get()
+   if tracer is None:
+      return function
+   def traced(*args, **kwargs):
+      token = _current.set(tracer)
+      try:
+         return function(*args, **kwargs)
+      finally:
+         _current.reset(token)
+   return traced
+
+
+def get_percentile(values, q):
+   # nearest-rank percentile of sorted values
+   return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class Tracer:
+
+   def __init__(self, trace_path):
+      self.trace_path = trace_path
+      self.events = []
+      self.threads = {}
+      self.lock = threading.Lock()
+      self.token = None
+
+   def add(self, name, start_ns, end_ns, args):
+      thread = threading.current_thread()
+      event = {
+         "name": name,
+         "cat": name.split('.')[0],
+         "ph": "X",
+         "ts": (start_ns - _ORIGIN_NS) / 1000,
+         "dur": (end_ns - start_ns) / 1000,
+         "pid": os.getpid(),
+         "tid": thread.ident
+      }
+      if args:
+         event["args"] = args
+      with self.lock:
+         self.threads.setdefault(thread.ident, thread.name)
+         self.events.append(event)
+
+   def save(self):
+      metadata = [
+         {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+         for tid, name in self.threads.items()
+      ]
+      with open(self.trace_path + ".tmp", "w") as f:
+         json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, f, default=str)
+      os.replace(self.trace_path + ".tmp", self.trace_path)
+
+   def summary(self, name):
+      durations = {}
+      for event in self.events:
+         durations.setdefault(event["name"], []).append(event["dur"] / 1000)
+      lines = [
+         f'[INFO] {name} trace: {self.trace_path}',
+         f'{"stage":<24}{"count":>7}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}{"total s":>10}'
+      ]
+      for stage, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+         values.sort()
+         lines.append(
+            f'{stage:<24}{len(values):>7}{get_percentile(values, 50):>10.1f}{get_percentile(values, 90):>10.1f}'
+            f'{get_percentile(values, 99):>10.1f}{values[-1]:>10.1f}{sum(values) / 1000:>10.2f}'
+         )
+      return '\n'.join(lines)
+
+
+def start_trace(trace_path):
+   # traces the rest of the current context (thread or asyncio task)
+   tracer = Tracer(trace_path)
+   tracer.token = _current.set(tracer)
+   return tracer
+
+
+def finish_trace(tracer):
+   _current.reset(tracer.token)
+   tracer.save()
+   return tracer